@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+#   Copyright 2019 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""Benchmark the image uploader against in-process fake registries
+
+A source registry is filled with synthetic images, then each scenario
+uploads them to a fresh target registry and reports images per second,
+MB per second and the requests each registry served. Latency and errors
+can be injected into every registry request.
+
+    tox -e image-benchmark -- --images 20 --layers 8 --shared-ratio 0.5
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+import six
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse
+
+from tripleo_common.image import image_cache
+from tripleo_common.image import image_export
+from tripleo_common.image import image_metrics
+from tripleo_common.image import image_uploader
+
+SCENARIOS = ('copy', 'copy-async', 'sync', 'export', 'discover')
+
+LABEL = 'rdo_version'
+
+ROUTES = (
+    ('ping', re.compile(r'^/v2/?$')),
+    ('manifest', re.compile(r'^/v2/(?P<name>.+)/manifests/(?P<ref>[^/]+)$')),
+    ('upload',
+     re.compile(r'^/v2/(?P<name>.+)/blobs/uploads/(?P<upload>[^/]*)$')),
+    ('blob', re.compile(r'^/v2/(?P<name>.+)/blobs/(?P<digest>[^/]+)$')),
+    ('tags', re.compile(r'^/v2/(?P<name>.+)/tags/list$')),
+)
+
+
+def sha256(data):
+    return 'sha256:%s' % hashlib.sha256(data).hexdigest()
+
+
+class FakeRegistry(object):
+    """Minimal in-memory Docker Registry HTTP API v2
+
+    Blobs are stored once and linked into each repository which pushed or
+    mounted them, so blob checks and cross repository mounts behave like a
+    real registry.
+    """
+
+    def __init__(self, latency=0, error_rate=0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.blobs = {}
+        self.repo_blobs = collections.defaultdict(set)
+        self.manifests = collections.defaultdict(dict)
+        self.uploads = {}
+        self.reset_counts()
+        self.server = None
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests = collections.Counter()
+            self.errors = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def start(self):
+        registry = self
+
+        class Handler(RegistryHandler):
+            pass
+        Handler.registry = registry
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.netloc = '127.0.0.1:%d' % self.server.server_address[1]
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def inject_error(self):
+        if not self.error_rate:
+            return False
+        with self.lock:
+            error = self.random.random() < self.error_rate
+            if error:
+                self.errors += 1
+        return error
+
+    def add_blob(self, name, data):
+        digest = sha256(data)
+        with self.lock:
+            self.blobs[digest] = data
+            self.repo_blobs[name].add(digest)
+        return digest
+
+    def add_manifest(self, name, ref, media_type, data):
+        digest = sha256(data)
+        with self.lock:
+            self.manifests[name][ref] = (media_type, data)
+            self.manifests[name][digest] = (media_type, data)
+        return digest
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class RegistryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    registry = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_HEAD(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_PATCH(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def dispatch(self):
+        reg = self.registry
+        url = parse.urlparse(self.path)
+        self.query = dict(parse.parse_qsl(url.query))
+        body = self.read_body()
+        for kind, route in ROUTES:
+            match = route.match(url.path)
+            if match:
+                break
+        else:
+            kind, match = None, None
+
+        with reg.lock:
+            reg.requests['%s %s' % (self.command, kind)] += 1
+            reg.bytes_in += len(body)
+        if reg.latency:
+            time.sleep(reg.latency)
+        if not match:
+            return self.respond(404)
+        if kind != 'ping' and reg.inject_error():
+            return self.respond(500)
+        handler = getattr(self, '%s_%s' % (self.command.lower(), kind), None)
+        if handler is None:
+            return self.respond(405)
+        handler(body, **match.groupdict())
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            data = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    return six.b('').join(data)
+                data.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else six.b('')
+
+    def respond(self, status, data=six.b(''), headers=None):
+        self.send_response(status)
+        headers = headers or {}
+        headers.setdefault('Docker-Distribution-API-Version', 'registry/2.0')
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD' and data:
+            self.wfile.write(data)
+            with self.registry.lock:
+                self.registry.bytes_out += len(data)
+
+    def upload_location(self, name, upload):
+        return 'http://%s/v2/%s/blobs/uploads/%s' % (
+            self.registry.netloc, name, upload)
+
+    def get_ping(self, body):
+        self.respond(200, six.b('{}'))
+
+    head_ping = get_ping
+
+    def get_manifest(self, body, name, ref):
+        entry = self.registry.manifests.get(name, {}).get(ref)
+        if entry is None:
+            return self.respond(404)
+        media_type, data = entry
+        self.respond(200, data, {
+            'Content-Type': media_type,
+            'Docker-Content-Digest': sha256(data)
+        })
+
+    head_manifest = get_manifest
+
+    def put_manifest(self, body, name, ref):
+        media_type = self.headers.get('Content-Type')
+        digest = self.registry.add_manifest(name, ref, media_type, body)
+        self.respond(201, headers={'Docker-Content-Digest': digest})
+
+    def get_blob(self, body, name, digest):
+        reg = self.registry
+        with reg.lock:
+            data = reg.blobs.get(digest)
+            linked = digest in reg.repo_blobs.get(name, ())
+        if data is None or not linked:
+            return self.respond(404)
+        headers = {'Docker-Content-Digest': digest}
+        byte_range = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if byte_range and self.command == 'GET':
+            data = data[int(byte_range.group(1)):]
+            return self.respond(206, data, headers)
+        self.respond(200, data, headers)
+
+    head_blob = get_blob
+
+    def post_upload(self, body, name, upload):
+        reg = self.registry
+        params = dict(self.query)
+        params.update(parse.parse_qsl(body.decode('utf-8')))
+        mount, source = params.get('mount'), params.get('from')
+        if mount:
+            with reg.lock:
+                mounted = all((mount in reg.blobs,
+                               mount in reg.repo_blobs.get(source, ())))
+                if mounted:
+                    reg.repo_blobs[name].add(mount)
+            if mounted:
+                return self.respond(201, headers={
+                    'Location': '/v2/%s/blobs/%s' % (name, mount),
+                    'Docker-Content-Digest': mount
+                })
+        upload = str(uuid.uuid4())
+        with reg.lock:
+            reg.uploads[upload] = bytearray()
+        self.respond(202, headers={
+            'Location': self.upload_location(name, upload),
+            'Range': '0-0'
+        })
+
+    def get_upload(self, body, name, upload):
+        with self.registry.lock:
+            data = self.registry.uploads.get(upload)
+        if data is None:
+            return self.respond(404)
+        self.respond(204, headers={
+            'Location': self.upload_location(name, upload),
+            'Range': '0-%d' % max(0, len(data) - 1)
+        })
+
+    def patch_upload(self, body, name, upload):
+        with self.registry.lock:
+            data = self.registry.uploads.get(upload)
+            if data is not None:
+                data.extend(body)
+        if data is None:
+            return self.respond(404)
+        self.respond(202, headers={
+            'Location': self.upload_location(name, upload),
+            'Range': '0-%d' % max(0, len(data) - 1)
+        })
+
+    def put_upload(self, body, name, upload):
+        reg = self.registry
+        with reg.lock:
+            data = reg.uploads.pop(upload, None)
+        if data is None:
+            return self.respond(404)
+        data = bytes(data + body)
+        digest = self.query.get('digest')
+        if digest != sha256(data):
+            return self.respond(400)
+        reg.add_blob(name, data)
+        self.respond(201, headers={
+            'Location': '/v2/%s/blobs/%s' % (name, digest),
+            'Docker-Content-Digest': digest
+        })
+
+    def get_tags(self, body, name):
+        refs = self.registry.manifests.get(name)
+        if refs is None:
+            return self.respond(404)
+        tags = sorted(r for r in refs if not r.startswith('sha256:'))
+        headers = {'Content-Type': 'application/json'}
+        last = self.query.get('last')
+        if last:
+            tags = [t for t in tags if t > last]
+        n = self.query.get('n')
+        if n and n.isdigit() and len(tags) > int(n):
+            tags = tags[:int(n)]
+            headers['Link'] = '</v2/%s/tags/list?n=%s&last=%s>; ' \
+                'rel="next"' % (name, n, tags[-1])
+        self.respond(200, json.dumps({'name': name, 'tags': tags}).encode(
+            'utf-8'), headers)
+
+
+def make_layer(size):
+    raw = os.urandom(size)
+    compress = zlib.compressobj(1, zlib.DEFLATED, 31)
+    return raw, compress.compress(raw) + compress.flush()
+
+
+def add_images(registry, count, layers, layer_size, shared_ratio):
+    """Push synthetic images to a fake registry, returning their names
+
+    The first layers of every image are shared, like the base image layers
+    of the overcloud images.
+    """
+    shared = [make_layer(layer_size)
+              for i in range(int(round(layers * shared_ratio)))]
+    names = []
+    for i in range(count):
+        name = 'bench/image-%d' % i
+        image_layers = shared + [make_layer(layer_size)
+                                 for j in range(layers - len(shared))]
+        config = json.dumps({
+            'architecture': 'amd64',
+            'os': 'linux',
+            'created': '2019-01-01T00:00:00Z',
+            'config': {'Labels': {LABEL: 'v%d' % i}},
+            'rootfs': {
+                'type': 'layers',
+                'diff_ids': [sha256(raw) for raw, blob in image_layers]
+            },
+        }).encode('utf-8')
+        manifest = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': image_uploader.MEDIA_MANIFEST_V2,
+            'config': {
+                'mediaType': image_uploader.MEDIA_CONFIG,
+                'size': len(config),
+                'digest': registry.add_blob(name, config),
+            },
+            'layers': [{
+                'mediaType': image_uploader.MEDIA_BLOB_COMPRESSED,
+                'size': len(blob),
+                'digest': registry.add_blob(name, blob),
+            } for raw, blob in image_layers],
+        }, separators=(',', ':')).encode('utf-8')
+        for tag in ('latest', 'v%d' % i):
+            registry.add_manifest(name, tag, image_uploader.MEDIA_MANIFEST_V2,
+                                  manifest)
+        names.append(name)
+    return names
+
+
+def reset_uploader(registries, work_dir):
+    uploader = image_uploader.PythonImageUploader
+    uploader.init_registries_cache()
+    uploader.insecure_registries.update(r.netloc for r in registries)
+    image_metrics.reset()
+    image_cache.CACHE_DIR = tempfile.mkdtemp(dir=work_dir)
+    image_export.IMAGE_EXPORT_DIR = tempfile.mkdtemp(dir=work_dir)
+
+
+def upload(uploader_type, names, source, target, sync=False):
+    manager = image_uploader.ImageUploadManager(sync=sync)
+    uploader = manager.uploader(uploader_type)
+    for name in names:
+        uploader.add_upload_task(image_uploader.UploadTask(
+            image_name='%s:latest' % name,
+            pull_source=source.netloc,
+            push_destination=target.netloc,
+            append_tag=None,
+            modify_role=None,
+            modify_vars=None,
+            dry_run=False,
+            cleanup=image_uploader.CLEANUP_NONE
+        ))
+    uploader.run_tasks()
+
+
+def run_scenario(scenario, names, source, args, work_dir):
+    target = FakeRegistry(args.latency, args.error_rate, args.seed).start()
+    try:
+        reset_uploader([source, target], work_dir)
+        if scenario == 'sync':
+            # the images are already in the target, so only the manifest
+            # digests should be compared
+            upload('python', names, source, target)
+            reset_uploader([source, target], work_dir)
+        elif scenario == 'export':
+            image_uploader.PythonImageUploader.export_registries.add(
+                target.netloc)
+        source.reset_counts()
+        target.reset_counts()
+
+        start = time.time()
+        if scenario == 'discover':
+            image_uploader.PythonImageUploader().discover_image_tags(
+                ['%s/%s:latest' % (source.netloc, n) for n in names], LABEL)
+        elif scenario == 'copy-async':
+            upload('python-async', names, source, target)
+        else:
+            upload('python', names, source, target,
+                   sync=scenario == 'sync')
+        seconds = time.time() - start
+    finally:
+        target.stop()
+
+    return {
+        'scenario': scenario,
+        'images': len(names),
+        'seconds': seconds,
+        'images_per_second': len(names) / seconds,
+        'mb_per_second': source.bytes_out / seconds / 2 ** 20,
+        'source_requests': dict(source.requests),
+        'target_requests': dict(target.requests),
+        'injected_errors': source.errors + target.errors,
+        'caches': image_metrics.summary()['caches'],
+    }
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the image uploader against in-process fake '
+                    'registries',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--images', type=int, default=10,
+                        help='Number of images in the source registry')
+    parser.add_argument('--layers', type=int, default=6,
+                        help='Number of layers in each image')
+    parser.add_argument('--layer-size', type=int, default=2 ** 20,
+                        help='Uncompressed size of each layer in bytes')
+    parser.add_argument('--shared-ratio', type=float, default=0.5,
+                        help='Fraction of the layers shared by every image')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds added to every registry request')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of registry requests which fail with '
+                             'a 500 error')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for the injected errors')
+    parser.add_argument('--iterations', type=int, default=1,
+                        help='Number of times to run each scenario')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        dest='scenarios',
+                        help='Scenario to run, can be repeated. Defaults to '
+                             'all scenarios')
+    parser.add_argument('--json', dest='json_file',
+                        help='File to write the results to as JSON')
+    parser.add_argument('--debug', action='store_true',
+                        help='Show the uploader log')
+    return parser.parse_args(sys.argv[1:])
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.CRITICAL)
+    scenarios = args.scenarios or [
+        s for s in SCENARIOS if six.PY3 or s != 'copy-async']
+
+    work_dir = tempfile.mkdtemp(prefix='image-upload-benchmark-')
+    source = FakeRegistry(args.latency, args.error_rate, args.seed).start()
+    try:
+        names = add_images(source, args.images, args.layers,
+                           args.layer_size, args.shared_ratio)
+        results = []
+        for scenario in scenarios:
+            for i in range(args.iterations):
+                result = run_scenario(scenario, names, source, args,
+                                      work_dir)
+                results.append(result)
+                print('%-10s %6.2fs %8.2f images/s %8.2f MB/s '
+                      'source requests %5d, target requests %5d' % (
+                          scenario, result['seconds'],
+                          result['images_per_second'],
+                          result['mb_per_second'],
+                          sum(result['source_requests'].values()),
+                          sum(result['target_requests'].values())))
+    finally:
+        source.stop()
+        shutil.rmtree(work_dir)
+
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
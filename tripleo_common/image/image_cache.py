@@ -0,0 +1,185 @@
+#   Copyright 2019 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import json
+import os
+import tempfile
+import time
+
+from oslo_log import log as logging
+
+from tripleo_common.image import image_export
+from tripleo_common.image import image_metrics
+
+LOG = logging.getLogger(__name__)
+
+
+CACHE_DIR = '/var/lib/tripleo-container-image-prepare'
+
+# Maximum total size of cached layer blobs, least recently used blobs are
+# evicted when this is exceeded
+BLOB_CACHE_MAX_SIZE = 10 * 2 ** 30
+
+
+def cache_dir(*path):
+    """Return a path inside the cache directory, creating it if needed
+
+    Returns None when the cache directory can not be created or written to,
+    which disables caching for the caller.
+    """
+    if not CACHE_DIR:
+        return None
+    dir_path = os.path.join(CACHE_DIR, *path)
+    image_export.make_dir(dir_path)
+    if not os.access(dir_path, os.W_OK):
+        return None
+    return dir_path
+
+
+def read_json(name, key, ttl):
+    """Read cached JSON data, or return None when missing or expired"""
+    dir_path = cache_dir(name)
+    if not dir_path:
+        return None
+    path = os.path.join(dir_path, '%s.json' % key)
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            os.remove(path)
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_json(name, key, data):
+    dir_path = cache_dir(name)
+    if not dir_path:
+        return
+    path = os.path.join(dir_path, '%s.json' % key)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.%s-' % key)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+
+def blob_path(digest):
+    blob_dir_path = cache_dir('blobs')
+    if not blob_dir_path:
+        return None
+    return os.path.join(blob_dir_path, digest)
+
+
+def blob_exists(digest):
+    path = blob_path(digest)
+    if path is None:
+        return False
+    exists = os.path.isfile(path)
+    image_metrics.cache('blobs', exists)
+    return exists
+
+
+def blob_file(digest):
+    """Return the path of a cached blob and mark it as recently used"""
+    path = blob_path(digest)
+    try:
+        # update the modified time so eviction is least recently used
+        os.utime(path, None)
+    except (OSError, TypeError):
+        return None
+    return path
+
+
+def blob_stream(digest, calc_digest, chunk_size=2 ** 20):
+    path = blob_file(digest)
+    LOG.debug('Reading cached layer: %s' % path)
+
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            calc_digest.update(data)
+            yield data
+
+
+def cache_stream(digest, layer_stream, calc_digest):
+    """Pass through a layer stream while writing it to the blob cache
+
+    The blob is only added to the cache when the stream is fully consumed
+    and calc_digest (updated by the wrapped stream) matches digest.
+    """
+    path = blob_path(digest)
+    if not path:
+        for data in layer_stream:
+            yield data
+        return
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.%s-' % digest)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for data in layer_stream:
+                f.write(data)
+                yield data
+
+        layer_digest = 'sha256:%s' % calc_digest.hexdigest()
+        if layer_digest != digest:
+            LOG.warning('Not caching layer %s, calculated digest %s' %
+                        (digest, layer_digest))
+            return
+        # cached blobs may be linked into the image-serve directory, so
+        # they need to be readable by the web server
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+        LOG.debug('Cached layer: %s' % path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    evict()
+
+
+def evict(max_size=None):
+    """Delete least recently used blobs until the cache fits max_size"""
+    if max_size is None:
+        max_size = BLOB_CACHE_MAX_SIZE
+    blob_dir_path = cache_dir('blobs')
+    if not blob_dir_path:
+        return
+
+    blobs = []
+    total_size = 0
+    for f in os.listdir(blob_dir_path):
+        if f.startswith('.'):
+            # partially written blob
+            continue
+        path = os.path.join(blob_dir_path, f)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # evicted by another process
+            continue
+        blobs.append((stat.st_mtime, stat.st_size, path))
+        total_size += stat.st_size
+
+    for mtime, size, path in sorted(blobs):
+        if total_size <= max_size:
+            break
+        LOG.debug('Evicting cached layer: %s' % path)
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
@@ -14,9 +14,14 @@
 #
 
 import collections
+import fcntl
 import hashlib
 import json
 import os
+import shutil
+import tempfile
+import time
+import uuid
 
 from oslo_log import log as logging
 
@@ -25,6 +30,13 @@ LOG = logging.getLogger(__name__)
 
 IMAGE_EXPORT_DIR = '/var/lib/image-serve'
 
+# Unreferenced files changed within this many seconds are not collected, so
+# the files of exports which are still in progress are kept
+GC_GRACE_PERIOD = 24 * 60 * 60
+
+# Key of collect_garbage results for blob store files not freed by any image
+GC_BLOB_STORE = 'blobs'
+
 
 def make_dir(path):
     if os.path.exists(path):
@@ -36,6 +48,25 @@ def make_dir(path):
         pass
 
 
+def write_file(path, data):
+    """Replace a file with data, so readers never see a partial file
+
+    The data is written to a temporary file, synced to disk, then renamed
+    over path.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def image_tag_from_url(image_url):
     parts = image_url.path.split(':')
     if len(parts) == 1:
@@ -52,67 +83,204 @@ def image_tag_from_url(image_url):
     return image, tag
 
 
-def export_stream(target_url, layer, layer_stream):
-    image, tag = image_tag_from_url(target_url)
-    digest = layer['digest']
-    blob_dir_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'blobs')
-    make_dir(blob_dir_path)
-    blob_path = os.path.join(blob_dir_path, '%s.gz' % digest)
+def blob_store_path(digest):
+    """Return the path of a blob in the content addressed blob store
 
-    LOG.debug('export layer to %s' % blob_path)
+    Every exported blob is stored once in the blob store, and each image
+    which uses it has a hard link to the stored blob.
+    """
+    algorithm, hexdigest = digest.split(':', 1)
+    return os.path.join(IMAGE_EXPORT_DIR, 'blobs', algorithm, hexdigest)
 
-    length = 0
-    calc_digest = hashlib.sha256()
-    with open(blob_path, 'w+b') as f:
-        for chunk in layer_stream:
-            if not chunk:
-                break
-            f.write(chunk)
-            calc_digest.update(chunk)
-            length += len(chunk)
 
-    layer_digest = 'sha256:%s' % calc_digest.hexdigest()
-    LOG.debug('Calculated layer digest: %s' % layer_digest)
+def image_blob_path(image, digest):
+    return os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'blobs',
+                        '%s.gz' % digest)
 
-    # if the original layer is uncompressed the digest may change on export
-    expected_blob_path = os.path.join(blob_dir_path, '%s.gz' % layer_digest)
-    if blob_path != expected_blob_path:
-        os.rename(blob_path, expected_blob_path)
+
+def link_file(source_path, target_path):
+    """Hard link a file, or copy it when linking is not possible
+
+    The link is created under a temporary name and renamed into place, so
+    target_path never refers to a partial copy.
+    """
+    if os.path.exists(target_path):
+        return
+    tmp_path = '%s.%s.tmp' % (target_path, uuid.uuid4().hex)
+    try:
+        try:
+            os.link(source_path, tmp_path)
+        except OSError:
+            # different filesystem, or links not permitted
+            copy_file(source_path, tmp_path)
+        os.rename(tmp_path, target_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def export_existing(target_url, layer):
+    """Link a layer from the blob store into an image
+
+    Returns the layer digest, or None when the layer is not in the blob
+    store, or in the image from an export before the blob store existed.
+    """
+    digest = layer['digest']
+    store_path = blob_store_path(digest)
+    image, tag = image_tag_from_url(target_url)
+    blob_path = image_blob_path(image, digest)
+    if not os.path.exists(store_path) and \
+            not store_existing(blob_path, digest):
+        return None
+    make_dir(os.path.dirname(blob_path))
+    LOG.debug('Linking stored layer to %s' % blob_path)
+    link_file(store_path, blob_path)
+    layer['size'] = os.path.getsize(blob_path)
+    return digest
+
+
+def store_existing(blob_path, digest):
+    """Add a blob exported before the blob store existed to the store
+
+    Older exports wrote blobs in place, so an interrupted export could
+    leave a partial blob. The blob is only stored when its digest matches,
+    and is otherwise removed so the layer is exported again.
+    """
+    if not os.path.exists(blob_path):
+        return False
+    algorithm, hexdigest = digest.split(':', 1)
+    if algorithm != 'sha256':
+        return False
+    calc_digest = hashlib.sha256()
+    with open(blob_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            calc_digest.update(chunk)
+    if calc_digest.hexdigest() != hexdigest:
+        LOG.warning('Removing partial exported blob %s' % blob_path)
+        os.remove(blob_path)
+        return False
+    store_path = blob_store_path(digest)
+    make_dir(os.path.dirname(store_path))
+    LOG.debug('Linking layers: %s -> %s' % (blob_path, store_path))
+    link_file(blob_path, store_path)
+    return True
+
+
+def export_stream(target_url, layer, layer_stream, calc_digest=None):
+    """Write a layer stream to the blob store and link it into an image
+
+    Nothing is read from layer_stream when the blob store already has the
+    layer. When calc_digest is passed it is updated by layer_stream itself,
+    so the stream is not hashed a second time.
+    """
+    if export_existing(target_url, layer):
+        return layer['digest']
+
+    store_dir_path = os.path.join(IMAGE_EXPORT_DIR, 'blobs', 'sha256')
+    make_dir(store_dir_path)
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir_path, prefix='.')
+
+    LOG.debug('export layer to %s' % tmp_path)
+
+    hash_stream = calc_digest is None
+    if hash_stream:
+        calc_digest = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'w+b') as f:
+            for chunk in layer_stream:
+                if not chunk:
+                    break
+                f.write(chunk)
+                if hash_stream:
+                    calc_digest.update(chunk)
+            # a stored blob is trusted to be complete, so it must be on
+            # disk before it is renamed into the store
+            f.flush()
+            os.fsync(f.fileno())
+
+        # if the original layer is uncompressed the digest may change on
+        # export
+        layer_digest = 'sha256:%s' % calc_digest.hexdigest()
+        LOG.debug('Calculated layer digest: %s' % layer_digest)
+        store_path = blob_store_path(layer_digest)
+        if not os.path.exists(store_path):
+            # replacing a stored blob would break its links to images
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, store_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
     layer['digest'] = layer_digest
-    layer['size'] = length
-    return layer_digest
+    return export_existing(target_url, layer)
+
+
+def export_file(target_url, layer, source_path):
+    """Export a local blob file which already has the layer digest
+
+    The file is hard linked into the blob store when possible, and
+    otherwise copied by the kernel, so the layer is not read or hashed in
+    python.
+    """
+    store_path = blob_store_path(layer['digest'])
+    make_dir(os.path.dirname(store_path))
+    LOG.debug('export layer %s to %s' % (source_path, store_path))
+    link_file(source_path, store_path)
+    return export_existing(target_url, layer)
+
+
+def copy_file(source_path, target_path):
+    """Copy a file in the kernel when the platform supports it"""
+    with open(source_path, 'rb') as src, open(target_path, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        try:
+            offset = 0
+            while offset < size:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(
+                        src.fileno(), dst.fileno(), size - offset)
+                elif hasattr(os, 'sendfile'):
+                    copied = os.sendfile(
+                        dst.fileno(), src.fileno(), offset, size - offset)
+                else:
+                    break
+                if not copied:
+                    break
+                offset += copied
+            if offset == size:
+                return
+        except OSError as e:
+            LOG.debug('Falling back to a buffered copy: %s' % e)
+        src.seek(0)
+        dst.seek(0)
+        dst.truncate()
+        shutil.copyfileobj(src, dst)
 
 
 def cross_repo_mount(target_image_url, image_layers, source_layers):
     for layer in source_layers:
-        if layer not in image_layers:
+        if export_existing(target_image_url, {'digest': layer}):
             continue
-
-        image_url = image_layers[layer]
-        image, tag = image_tag_from_url(image_url)
-        dir_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'blobs')
-        blob_path = os.path.join(dir_path, '%s.gz' % layer)
-        if not os.path.exists(blob_path):
-            LOG.debug('Layer not found: %s' % blob_path)
+        if layer not in image_layers:
             continue
 
-        target_image, tag = image_tag_from_url(target_image_url)
-        target_dir_path = os.path.join(
-            IMAGE_EXPORT_DIR, 'v2', target_image, 'blobs')
-        make_dir(target_dir_path)
-        target_blob_path = os.path.join(target_dir_path, '%s.gz' % layer)
-        if os.path.exists(target_blob_path):
-            continue
-        LOG.debug('Linking layers: %s -> %s' % (blob_path, target_blob_path))
-        # make a hard link so the layers can have independent lifecycles
-        os.link(blob_path, target_blob_path)
+        image, tag = image_tag_from_url(image_layers[layer])
+        if store_existing(image_blob_path(image, layer), layer):
+            export_existing(target_image_url, {'digest': layer})
+        else:
+            LOG.debug('Layer not found: %s' % image_blob_path(image, layer))
 
 
 def export_manifest_config(target_url,
                            manifest_str,
                            manifest_type,
-                           config_str):
+                           config_str,
+                           tagged=True):
+    """Export a manifest and its config, then point the tag at it
+
+    Manifests of a manifest list are exported with tagged=False, they
+    are only fetched by digest and are kept by the list referencing them.
+    """
     image, tag = image_tag_from_url(target_url)
     manifest = json.loads(manifest_str)
     if config_str is not None:
@@ -122,8 +290,7 @@ def export_manifest_config(target_url,
         config_digest = manifest['config']['digest']
         config_path = os.path.join(blob_dir_path, config_digest)
 
-        with open(config_path, 'w+') as f:
-            f.write(config_str)
+        write_file(config_path, config_str)
 
     calc_digest = hashlib.sha256()
     calc_digest.update(manifest_str.encode('utf-8'))
@@ -135,36 +302,255 @@ def export_manifest_config(target_url,
     manifest_symlink_path = os.path.join(manifests_path, tag)
     manifest_path = os.path.join(manifest_dir_path, 'index.json')
     htaccess_path = os.path.join(manifest_dir_path, '.htaccess')
-    tags_dir_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'tags')
-    tags_list_path = os.path.join(tags_dir_path, 'list')
 
     make_dir(manifest_dir_path)
-    make_dir(tags_dir_path)
 
     headers = collections.OrderedDict()
     headers['Content-Type'] = manifest_type
     headers['Docker-Content-Digest'] = manifest_digest
     headers['ETag'] = manifest_digest
-    with open(htaccess_path, 'w+') as f:
-        for header in headers.items():
-            f.write('Header set %s "%s"\n' % header)
-
-    with open(manifest_path, 'w+') as f:
-        f.write(manifest_str)
-
-    if os.path.exists(manifest_symlink_path):
-        os.remove(manifest_symlink_path)
-    os.symlink(manifest_dir_path, manifest_symlink_path)
-
-    tags = []
-    for f in os.listdir(manifests_path):
-        f_path = os.path.join(manifests_path, f)
-        if os.path.islink(f_path):
-            tags.append(f)
-
-    tags_data = {
-        "name": image,
-        "tags": tags
-    }
-    with open(tags_list_path, 'w+') as f:
-        json.dump(tags_data, f)
+    write_file(htaccess_path, ''.join(
+        'Header set %s "%s"\n' % header for header in headers.items()))
+
+    # the manifest is written last, a manifest directory without it is
+    # never tagged and is removed by collect_garbage
+    write_file(manifest_path, manifest_str)
+    if not tagged:
+        return
+
+    # replace the tag symlink atomically so the tag never disappears
+    tmp_symlink_path = os.path.join(
+        manifests_path, '.%s.%s.tmp' % (tag, uuid.uuid4().hex))
+    os.symlink(manifest_dir_path, tmp_symlink_path)
+    os.rename(tmp_symlink_path, manifest_symlink_path)
+
+    add_tag(image, tag)
+
+
+def add_tag(image, tag):
+    """Add a tag to the tags list of an exported image
+
+    The list is read and replaced under an exclusive lock, so concurrent
+    exports of the same image do not lose each other's tags, and the new
+    list is renamed into place so readers never see a partial file. The
+    manifests directory is only listed when there is no valid list yet.
+    """
+    manifests_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'manifests')
+    tags_dir_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'tags')
+    tags_list_path = os.path.join(tags_dir_path, 'list')
+    make_dir(tags_dir_path)
+
+    with open(os.path.join(tags_dir_path, '.lock'), 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            with open(tags_list_path, 'r') as f:
+                tags = json.load(f)['tags']
+        except (IOError, OSError, ValueError, KeyError):
+            tags = sorted(
+                f for f in os.listdir(manifests_path)
+                if not f.startswith('.') and
+                os.path.islink(os.path.join(manifests_path, f)))
+        else:
+            if tag in tags:
+                return
+            tags.append(tag)
+
+        tags_data = {
+            "name": image,
+            "tags": tags
+        }
+        write_file(tags_list_path, json.dumps(tags_data))
+
+
+def image_repos():
+    """Return the name of every exported image"""
+    v2_path = os.path.join(IMAGE_EXPORT_DIR, 'v2')
+    images = []
+    for root, dirs, files in os.walk(v2_path):
+        if 'manifests' in dirs:
+            images.append(os.path.relpath(root, v2_path))
+            for d in ('manifests', 'blobs', 'tags'):
+                if d in dirs:
+                    dirs.remove(d)
+    return sorted(images)
+
+
+def collect_garbage(grace_period=GC_GRACE_PERIOD, images=None,
+                    dry_run=False):
+    """Delete exported manifests and blobs which are no longer referenced
+
+    Manifests are referenced by tag symlinks, and blobs by referenced
+    manifests. Unreferenced files are only deleted once they are older
+    than grace_period, so this can run while exports are in progress.
+    Images are collected one at a time, and images can be limited to
+    collect part of the export directory.
+
+    Returns a dict of image name to the bytes freed by deleting its
+    unreferenced files. Blob store entries which no image used are
+    counted under GC_BLOB_STORE. With dry_run nothing is deleted and the
+    bytes which would be freed are returned.
+
+    Blobs exported from the layer blob cache are hard links to the cached
+    file. The cache link does not keep a blob in the store, and it is
+    evicted with the store blob so the space is actually freed.
+    """
+    expire_time = time.time() - grace_period
+    if images is None:
+        images = image_repos()
+
+    # links each inode would lose in a dry run, the image which removed
+    # the last one, and the change time of the inode before any removal
+    removed_links = collections.Counter()
+    inode_images = {}
+    inode_ctimes = {}
+    reclaimable = collections.OrderedDict()
+
+    for image in images:
+        reclaimable[image] = _collect_image_garbage(
+            image, expire_time, dry_run, removed_links, inode_images,
+            inode_ctimes)
+
+    reclaimable[GC_BLOB_STORE] = 0
+    store_path = os.path.join(IMAGE_EXPORT_DIR, 'blobs')
+    for algorithm in _listdir(store_path):
+        algorithm_path = os.path.join(store_path, algorithm)
+        for f in _listdir(algorithm_path):
+            path = os.path.join(algorithm_path, f)
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            inode = (stat.st_dev, stat.st_ino)
+            # removing a link above changed the inode, so it is expired by
+            # its change time from before
+            ctime = inode_ctimes.get(inode, stat.st_ctime)
+            if max(stat.st_mtime, ctime) >= expire_time:
+                continue
+            cache_path = None
+            if not f.startswith('.'):
+                cache_path = _cache_link('%s:%s' % (algorithm, f), stat)
+                links = stat.st_nlink - removed_links[inode]
+                if cache_path:
+                    links -= 1
+                if links > 1:
+                    # still linked from an image
+                    continue
+            image = inode_images.get(inode, GC_BLOB_STORE)
+            reclaimable[image] += stat.st_size
+            _remove(path, dry_run)
+            if cache_path:
+                _remove(cache_path, dry_run)
+    return reclaimable
+
+
+def _cache_link(digest, stat):
+    """Return the path of a cached blob which is a link to a stored blob"""
+    # image_cache imports this module
+    from tripleo_common.image import image_cache
+    if not image_cache.CACHE_DIR:
+        return None
+    path = os.path.join(image_cache.CACHE_DIR, 'blobs', digest)
+    try:
+        cache_stat = os.lstat(path)
+    except OSError:
+        return None
+    if (cache_stat.st_dev, cache_stat.st_ino) != (stat.st_dev, stat.st_ino):
+        return None
+    return path
+
+
+def _collect_image_garbage(image, expire_time, dry_run, removed_links,
+                           inode_images, inode_ctimes):
+    image_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image)
+    manifests_path = os.path.join(image_path, 'manifests')
+    blobs_path = os.path.join(image_path, 'blobs')
+
+    # mark every manifest reachable from a tag, and the blobs they use
+    pending = []
+    for f in _listdir(manifests_path):
+        path = os.path.join(manifests_path, f)
+        if os.path.islink(path):
+            pending.append(os.path.basename(os.readlink(path)))
+    manifests = set()
+    blobs = set()
+    while pending:
+        digest = pending.pop()
+        if digest in manifests:
+            continue
+        manifests.add(digest)
+        try:
+            with open(os.path.join(manifests_path, digest,
+                                   'index.json')) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        if 'config' in manifest:
+            blobs.add(manifest['config']['digest'])
+        for l in manifest.get('layers', []):
+            blobs.add(l['digest'])
+        for l in manifest.get('fsLayers', []):
+            blobs.add(l['blobSum'])
+        for m in manifest.get('manifests', []):
+            pending.append(m['digest'])
+
+    # sweep what is not marked
+    freed = 0
+    for f in _listdir(manifests_path):
+        path = os.path.join(manifests_path, f)
+        if f in manifests or os.path.islink(path):
+            continue
+        if not _expired_stat(path, expire_time):
+            continue
+        for name in _listdir(path):
+            freed += os.lstat(os.path.join(path, name)).st_size
+        LOG.info('Removing unreferenced manifest %s' % path)
+        if not dry_run:
+            shutil.rmtree(path, ignore_errors=True)
+
+    for f in _listdir(blobs_path):
+        digest = f[:-3] if f.endswith('.gz') else f
+        if digest in blobs:
+            continue
+        path = os.path.join(blobs_path, f)
+        stat = _expired_stat(path, expire_time)
+        if not stat:
+            continue
+        inode = (stat.st_dev, stat.st_ino)
+        inode_images[inode] = image
+        inode_ctimes.setdefault(inode, stat.st_ctime)
+        # the links removed so far are only still counted in a dry run
+        if stat.st_nlink - removed_links[inode] == 1:
+            freed += stat.st_size
+        if dry_run:
+            removed_links[inode] += 1
+        _remove(path, dry_run)
+    return freed
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def _expired_stat(path, expire_time):
+    """Return the stat of a path which has not changed since expire_time"""
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return None
+    # the change time is updated when a link is added to a blob
+    if max(stat.st_mtime, stat.st_ctime) >= expire_time:
+        return None
+    return stat
+
+
+def _remove(path, dry_run):
+    LOG.info('Removing unreferenced blob %s' % path)
+    if dry_run:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
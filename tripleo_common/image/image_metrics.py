@@ -0,0 +1,337 @@
+#   Copyright 2019 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import contextlib
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+from oslo_log import log as logging
+
+from tripleo_common.image import image_export
+
+LOG = logging.getLogger(__name__)
+
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0)
+
+PROMETHEUS_PREFIX = 'tripleo_image_prepare'
+STATSD_PREFIX = 'tripleo.image_prepare'
+STATSD_PORT = 8125
+# Metric lines are batched into UDP packets of up to this size
+STATSD_PACKET_SIZE = 1400
+
+_lock = threading.Lock()
+_started = time.time()
+
+# Latency histograms keyed by (registry, method, kind), transferred bytes
+# and seconds keyed by (registry, direction), hits and misses keyed by cache
+# name, and the wall time of each uploaded image
+_requests = {}
+_transfers = {}
+_caches = {}
+_images = {}
+
+
+def reset():
+    """Discard all recorded metrics"""
+    global _started
+    with _lock:
+        _started = time.time()
+        _requests.clear()
+        _transfers.clear()
+        _caches.clear()
+        _images.clear()
+
+
+def request_kind(path):
+    """Return the kind of registry API call for a request path"""
+    if '/manifests/' in path:
+        return 'manifest'
+    if '/blobs/uploads/' in path:
+        return 'upload'
+    if '/blobs/' in path:
+        return 'blob'
+    if path.endswith('/tags/list'):
+        return 'tags'
+    if path.rstrip('/').endswith('/v2'):
+        return 'ping'
+    # token requests go to the realm of the auth challenge
+    return 'auth'
+
+
+def request(registry, method, kind, seconds, error=False):
+    """Record the latency of one registry request
+
+    For streamed responses this is the time until the response headers
+    arrived, the body is recorded with transfer.
+    """
+    key = (registry, method, kind)
+    with _lock:
+        hist = _requests.get(key)
+        if hist is None:
+            hist = {
+                'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                'count': 0,
+                'errors': 0,
+                'sum': 0.0,
+                'max': 0.0,
+            }
+            _requests[key] = hist
+        if error:
+            hist['errors'] += 1
+            return
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(LATENCY_BUCKETS)
+        hist['buckets'][i] += 1
+        hist['count'] += 1
+        hist['sum'] += seconds
+        hist['max'] = max(hist['max'], seconds)
+
+
+def transfer(registry, direction, length, seconds):
+    """Record bytes pulled from or pushed to a registry
+
+    seconds only counts the time spent waiting on the registry, so the
+    rate is not reduced by a slow consumer of the stream.
+    """
+    key = (registry, direction)
+    with _lock:
+        total = _transfers.setdefault(key, [0, 0.0])
+        total[0] += length
+        total[1] += seconds
+
+
+def cache(name, hit):
+    """Record a hit or a miss of a cache lookup"""
+    with _lock:
+        counts = _caches.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+
+@contextlib.contextmanager
+def image_timer(image):
+    """Record the wall time of uploading an image"""
+    started = time.time()
+    try:
+        yield
+    finally:
+        with _lock:
+            _images[image] = time.time() - started
+
+
+def _percentile(hist, fraction):
+    # the upper bound of the bucket holding the percentile, or the largest
+    # latency for the overflow bucket
+    target = hist['count'] * fraction
+    count = 0
+    for i, bucket_count in enumerate(hist['buckets']):
+        count += bucket_count
+        if count >= target and bucket_count:
+            if i < len(LATENCY_BUCKETS):
+                return min(LATENCY_BUCKETS[i], hist['max'])
+            return hist['max']
+    return 0.0
+
+
+def summary():
+    """Return all recorded metrics as a dict which can be dumped as JSON"""
+    with _lock:
+        result = {
+            'duration': time.time() - _started,
+            'requests': {},
+            'transfers': {},
+            'caches': {},
+            'images': dict(_images),
+        }
+        for (registry, method, kind), hist in sorted(_requests.items()):
+            count = hist['count']
+            result['requests'].setdefault(registry, {})[
+                '%s %s' % (method, kind)] = {
+                    'count': count,
+                    'errors': hist['errors'],
+                    'sum': hist['sum'],
+                    'mean': hist['sum'] / count if count else 0.0,
+                    'max': hist['max'],
+                    'p50': _percentile(hist, 0.5),
+                    'p90': _percentile(hist, 0.9),
+                    'p99': _percentile(hist, 0.99),
+                    'buckets': dict(
+                        zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'],
+                            hist['buckets'])),
+            }
+        for (registry, direction), total in sorted(_transfers.items()):
+            length, seconds = total
+            result['transfers'].setdefault(registry, {})[direction] = {
+                'bytes': length,
+                'seconds': seconds,
+                'bytes_per_second': length / seconds if seconds else 0.0,
+            }
+        for name, counts in sorted(_caches.items()):
+            hits, misses = counts
+            result['caches'][name] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': float(hits) / (hits + misses),
+            }
+    return result
+
+
+def write_json(path):
+    """Write the metrics summary to a JSON file"""
+    image_export.write_file(
+        os.path.abspath(path),
+        json.dumps(summary(), indent=2, sort_keys=True))
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items()))
+
+
+def prometheus_text(prefix=PROMETHEUS_PREFIX):
+    """Return the metrics in the Prometheus text exposition format"""
+    data = summary()
+    lines = []
+
+    def metric(name, metric_type, help_text):
+        lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+        lines.append('# TYPE %s_%s %s' % (prefix, name, metric_type))
+
+    metric('request_seconds', 'histogram', 'Registry request latency')
+    for registry, calls in sorted(data['requests'].items()):
+        for call, hist in sorted(calls.items()):
+            method, kind = call.split(' ')
+            count = 0
+            for bound in [str(b) for b in LATENCY_BUCKETS] + ['+Inf']:
+                count += hist['buckets'][bound]
+                lines.append('%s_request_seconds_bucket%s %d' % (
+                    prefix, _labels(registry=registry, method=method,
+                                    kind=kind, le=bound), count))
+            labels = _labels(registry=registry, method=method, kind=kind)
+            lines.append('%s_request_seconds_sum%s %f' % (
+                prefix, labels, hist['sum']))
+            lines.append('%s_request_seconds_count%s %d' % (
+                prefix, labels, hist['count']))
+
+    metric('request_errors_total', 'counter', 'Failed registry requests')
+    for registry, calls in sorted(data['requests'].items()):
+        for call, hist in sorted(calls.items()):
+            method, kind = call.split(' ')
+            lines.append('%s_request_errors_total%s %d' % (
+                prefix, _labels(registry=registry, method=method, kind=kind),
+                hist['errors']))
+
+    for name, key, help_text in (
+            ('transfer_bytes_total', 'bytes', 'Layer bytes transferred'),
+            ('transfer_seconds_total', 'seconds',
+             'Time spent waiting on layer transfers')):
+        metric(name, 'counter', help_text)
+        for registry, directions in sorted(data['transfers'].items()):
+            for direction, total in sorted(directions.items()):
+                lines.append('%s_%s%s %s' % (
+                    prefix, name,
+                    _labels(registry=registry, direction=direction),
+                    total[key]))
+
+    for name, key, help_text in (
+            ('cache_hits_total', 'hits', 'Cache lookup hits'),
+            ('cache_misses_total', 'misses', 'Cache lookup misses')):
+        metric(name, 'counter', help_text)
+        for cache_name, counts in sorted(data['caches'].items()):
+            lines.append('%s_%s%s %d' % (
+                prefix, name, _labels(cache=cache_name), counts[key]))
+
+    metric('image_seconds', 'gauge', 'Wall time of uploading an image')
+    for image, seconds in sorted(data['images'].items()):
+        lines.append('%s_image_seconds%s %f' % (
+            prefix, _labels(image=image), seconds))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, prefix=PROMETHEUS_PREFIX):
+    """Write the metrics for the node exporter textfile collector"""
+    image_export.write_file(os.path.abspath(path), prometheus_text(prefix))
+
+
+def _statsd_name(prefix, *parts):
+    return '.'.join([prefix] + [re.sub(r'[^A-Za-z0-9_-]', '_', p)
+                                for p in parts])
+
+
+def statsd_lines(prefix=STATSD_PREFIX):
+    """Return the metrics as statsd counters, gauges and timers"""
+    data = summary()
+    lines = []
+    for registry, calls in sorted(data['requests'].items()):
+        for call, hist in sorted(calls.items()):
+            name = _statsd_name(prefix, 'request', registry,
+                                call.replace(' ', '_'))
+            lines.append('%s.count:%d|c' % (name, hist['count']))
+            lines.append('%s.errors:%d|c' % (name, hist['errors']))
+            for stat in ('mean', 'p50', 'p90', 'p99', 'max'):
+                lines.append('%s.%s:%d|g' % (
+                    name, stat, hist[stat] * 1000))
+    for registry, directions in sorted(data['transfers'].items()):
+        for direction, total in sorted(directions.items()):
+            name = _statsd_name(prefix, 'transfer', registry, direction)
+            lines.append('%s.bytes:%d|c' % (name, total['bytes']))
+            lines.append('%s.bytes_per_second:%d|g' % (
+                name, total['bytes_per_second']))
+    for cache_name, counts in sorted(data['caches'].items()):
+        name = _statsd_name(prefix, 'cache', cache_name)
+        lines.append('%s.hits:%d|c' % (name, counts['hits']))
+        lines.append('%s.misses:%d|c' % (name, counts['misses']))
+    for image, seconds in sorted(data['images'].items()):
+        lines.append('%s:%d|ms' % (
+            _statsd_name(prefix, 'image'), seconds * 1000))
+    return lines
+
+
+def send_statsd(address, prefix=STATSD_PREFIX):
+    """Send the metrics to a statsd host:port over UDP
+
+    Failures are logged, since metrics must not fail an upload.
+    """
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        host, port = address, STATSD_PORT
+    packets = []
+    packet = ''
+    for line in statsd_lines(prefix):
+        if packet and len(packet) + len(line) + 1 > STATSD_PACKET_SIZE:
+            packets.append(packet)
+            packet = ''
+        packet = packet + '\n' + line if packet else line
+    if packet:
+        packets.append(packet)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for packet in packets:
+            sock.sendto(packet.encode('utf-8'), (host, int(port)))
+    except (socket.error, ValueError) as e:
+        LOG.warning('Sending metrics to statsd %s failed: %s' % (address, e))
+    finally:
+        sock.close()
@@ -14,21 +14,31 @@
 #
 
 import base64
+import collections
 from concurrent import futures
+import contextlib
+import functools
+import gzip
 import hashlib
+import itertools
 import json
 import netifaces
 import os
 import re
 import requests
+from requests import adapters as requests_adapters
 from requests import auth as requests_auth
 import shutil
 import six
 from six.moves.urllib import parse
+import struct
 import subprocess
 import tempfile
 import tenacity
+import threading
+import time
 import yaml
+import zlib
 
 import docker
 try:
@@ -41,7 +51,9 @@ from tripleo_common.actions import ansible
 from tripleo_common.image.base import BaseImageManager
 from tripleo_common.image.exception import ImageNotFoundException
 from tripleo_common.image.exception import ImageUploaderException
+from tripleo_common.image import image_cache
 from tripleo_common.image import image_export
+from tripleo_common.image import image_metrics
 
 
 LOG = logging.getLogger(__name__)
@@ -53,6 +65,20 @@ SECURE_REGISTRIES = (
     'registry-1.docker.io',
 )
 
+# Entry types of tar-split metadata
+TAR_SPLIT_FILE = 1
+TAR_SPLIT_SEGMENT = 2
+
+DEFAULT_COMPRESS_LEVEL = 6
+
+# gzip member header with no file name or modification time, and the final
+# empty deflate block which ends a stream of sync flushed blocks
+GZIP_HEADER = six.b('\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03')
+DEFLATE_END = six.b('\x03\x00')
+
+# Size of the window of previous data a deflate block can refer to
+DEFLATE_WINDOW = 32768
+
 CLEANUP = (
     CLEANUP_FULL, CLEANUP_PARTIAL, CLEANUP_NONE
 ) = (
@@ -79,18 +105,47 @@ MEDIA_TYPES = (
     MEDIA_MANIFEST_V2,
     MEDIA_CONFIG,
     MEDIA_BLOB,
-    MEDIA_BLOB_COMPRESSED
+    MEDIA_BLOB_COMPRESSED,
+    MEDIA_MANIFEST_LIST,
+    MEDIA_OCI_MANIFEST,
+    MEDIA_OCI_INDEX
 ) = (
     'application/vnd.docker.distribution.manifest.v1+json',
     'application/vnd.docker.distribution.manifest.v1+prettyjws',
     'application/vnd.docker.distribution.manifest.v2+json',
     'application/vnd.docker.container.image.v1+json',
     'application/vnd.docker.image.rootfs.diff.tar',
-    'application/vnd.docker.image.rootfs.diff.tar.gzip'
+    'application/vnd.docker.image.rootfs.diff.tar.gzip',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json'
 )
 
+# Manifests which reference a manifest for each platform of an image
+MANIFEST_LIST_TYPES = (MEDIA_MANIFEST_LIST, MEDIA_OCI_INDEX)
+
+# Architecture names used by distributions, and their names in manifest
+# list platforms
+PLATFORM_ARCHITECTURES = {
+    'x86_64': 'amd64',
+    'aarch64': 'arm64',
+}
+
+# Platform which selects every platform of manifest lists
+PLATFORMS_ALL = 'all'
+
 DEFAULT_UPLOADER = 'python'
 
+RATE_LIMITS = (
+    RATE_LIMIT_BYTES, RATE_LIMIT_REQUESTS
+) = (
+    'bytes', 'requests'
+)
+
+
+class UploadResumeException(requests.exceptions.RequestException):
+    """An upload session lost data, so the layer upload must restart"""
+
 
 def get_undercloud_registry():
     addr = 'localhost'
@@ -110,7 +165,9 @@ class ImageUploadManager(BaseImageManager):
 
     def __init__(self, config_files=None,
                  dry_run=False, cleanup=CLEANUP_FULL,
-                 mirrors=None):
+                 mirrors=None, rate_limit_bytes=None,
+                 rate_limit_requests=None, compress_level=None,
+                 compress_workers=None, sync=False, platforms=None):
         if config_files is None:
             config_files = []
         super(ImageUploadManager, self).__init__(config_files)
@@ -119,11 +176,36 @@ class ImageUploadManager(BaseImageManager):
             'skopeo': SkopeoImageUploader(),
             'python': PythonImageUploader()
         }
+        if six.PY3:
+            # the asyncio uploader is only importable on python 3
+            from tripleo_common.image import image_uploader_async
+            self.uploaders['python-async'] = (
+                image_uploader_async.AsyncPythonImageUploader())
         self.dry_run = dry_run
         self.cleanup = cleanup
         if mirrors:
             for uploader in self.uploaders.values():
                 uploader.mirrors.update(mirrors)
+        for uploader in self.uploaders.values():
+            uploader.sync = sync
+        self.rate_limit_bytes = rate_limit_bytes
+        self.rate_limit_requests = rate_limit_requests
+        self.compress_level = compress_level
+        self.compress_workers = compress_workers
+        self.platforms = platforms
+
+    def init_uploaders(self):
+        """Apply the rate limits, compression and platforms of this manager
+
+        These are shared by every uploader of a class, so they are applied
+        when a run starts rather than when a manager is created, which
+        would replace the settings of other managers.
+        """
+        BaseImageUploader.init_rate_limits(self.rate_limit_bytes,
+                                           self.rate_limit_requests)
+        PythonImageUploader.init_compression(self.compress_level,
+                                             self.compress_workers)
+        PythonImageUploader.init_platforms(self.platforms)
 
     def discover_image_tag(self, image, tag_from_label=None,
                            username=None, password=None):
@@ -152,11 +234,21 @@ class ImageUploadManager(BaseImageManager):
         """Start the upload process"""
 
         LOG.info('Using config files: %s' % self.config_files)
+        self.init_uploaders()
 
         uploads = self.load_config_files(self.UPLOADS) or []
         container_images = self.load_config_files(self.CONTAINER_IMAGES) or []
         upload_images = uploads + container_images
 
+        # prime insecure_registries by probing every registry host at once
+        hosts = set()
+        for item in upload_images:
+            hosts.add(BaseImageUploader._image_to_url(
+                item.get('pull_source') or item.get('imagename')).netloc)
+            hosts.add(BaseImageUploader._image_to_url(
+                self.get_push_destination(item)).netloc)
+        BaseImageUploader.prime_insecure_registries(hosts)
+
         for item in upload_images:
             image_name = item.get('imagename')
             uploader = item.get('uploader', DEFAULT_UPLOADER)
@@ -197,11 +289,56 @@ class BaseImageUploader(object):
     export_registries = set()
     push_registries = set()
 
+    # Blobs known to exist in target registries, and the time blobs were
+    # last found to be missing, keyed by (registry, image, digest). Only
+    # what was found during the current run is known, since registries
+    # may be garbage collected between runs
+    registry_blobs = set()
+    missing_blobs = {}
+    missing_blobs_ttl = 60
+
+    # Results of _inspect keyed by image url, with the time they were
+    # fetched. The image details which do not change for a manifest digest
+    # are also cached on disk.
+    inspect_cache = {}
+    inspect_cache_ttl = 600
+    inspect_disk_cache_ttl = 7 * 24 * 60 * 60
+
+    # Authentication challenges keyed by registry, and authenticated
+    # sessions keyed by (registry, realm, scope, username) with the time
+    # their token expires. Sessions for a registry share one connection
+    # pool sized for session_pool_size concurrent requests.
+    auth_challenges = {}
+    auth_sessions = {}
+    auth_adapters = {}
+    auth_lock = threading.Lock()
+    session_pool_size = 16
+    # Tags listed per request when the tags of a repository are needed
+    tags_page_size = 1000
+    # Tokens are replaced this many seconds before they expire
+    token_expiry_margin = 10
+    # Token lifetime when the token server does not specify expires_in
+    token_default_expiry = 60
+
+    # Maximum bytes and requests per second to or from each registry host,
+    # enforced by token buckets keyed by (host, limit)
+    rate_limits = {}
+    rate_limiters = {}
+    rate_limiters_lock = threading.Lock()
+
+    # Connect and read timeouts for detecting insecure registries, and how
+    # long the result is cached on disk
+    registry_probe_timeout = (5, 10)
+    registry_probe_cache_ttl = 24 * 60 * 60
+
     def __init__(self):
         self.upload_tasks = []
         # A mapping of layer hashs to the image which first copied that
         # layer to the target
         self.image_layers = {}
+        # Only upload images whose manifest differs from the target. This
+        # is only implemented by the python uploaders
+        self.sync = False
 
     @classmethod
     def init_registries_cache(cls):
@@ -211,6 +348,44 @@ class BaseImageUploader(object):
         cls.mirrors.clear()
         cls.export_registries.clear()
         cls.push_registries.clear()
+        cls.registry_blobs.clear()
+        cls.missing_blobs.clear()
+        cls.inspect_cache.clear()
+        with cls.auth_lock:
+            cls.auth_challenges.clear()
+            cls.auth_sessions.clear()
+            cls.auth_adapters.clear()
+
+    @classmethod
+    def init_run_cache(cls):
+        """Forget what earlier runs found in the registries"""
+        cls.registry_blobs.clear()
+        cls.missing_blobs.clear()
+
+    @classmethod
+    def init_rate_limits(cls, rate_limit_bytes=None,
+                         rate_limit_requests=None):
+        with cls.rate_limiters_lock:
+            cls.rate_limits.clear()
+            cls.rate_limiters.clear()
+            if rate_limit_bytes:
+                cls.rate_limits[RATE_LIMIT_BYTES] = rate_limit_bytes
+            if rate_limit_requests:
+                cls.rate_limits[RATE_LIMIT_REQUESTS] = rate_limit_requests
+
+    @classmethod
+    def _throttle(cls, url, limit, amount=1):
+        """Wait until amount is allowed by the rate limit for a url's host"""
+        rate = cls.rate_limits.get(limit)
+        if not rate:
+            return
+        key = (parse.urlparse(url).netloc, limit)
+        with cls.rate_limiters_lock:
+            bucket = cls.rate_limiters.get(key)
+            if bucket is None:
+                bucket = TokenBucket(rate)
+                cls.rate_limiters[key] = bucket
+        bucket.consume(amount)
 
     def cleanup(self):
         pass
@@ -286,12 +461,12 @@ class BaseImageUploader(object):
     @classmethod
     def _image_digest(cls, image, session=None):
         image_url = cls._image_to_url(image)
-        i = cls._inspect(image_url, session)
+        i = cls._inspect(image_url, session, tags=False)
         return i.get('Digest')
 
     @classmethod
     def _image_labels(cls, image_url, session=None):
-        i = cls._inspect(image_url, session)
+        i = cls._inspect(image_url, session, tags=False)
         return i.get('Labels', {}) or {}
 
     @classmethod
@@ -315,12 +490,54 @@ class BaseImageUploader(object):
     )
     def authenticate(cls, image_url, username=None, password=None):
         image, tag = cls._image_tag_from_url(image_url)
+        netloc = image_url.netloc
+        with cls.auth_lock:
+            challenge = cls.auth_challenges.get(netloc)
+        if challenge is None:
+            challenge = cls._auth_challenge(image_url)
+            with cls.auth_lock:
+                cls.auth_challenges[netloc] = challenge
+
+        realm, token_param = challenge
+        if realm:
+            token_param = dict(token_param)
+            token_param['scope'] = 'repository:%s:pull' % image[1:]
+        key = (netloc, realm, token_param.get('scope'), username)
+        with cls.auth_lock:
+            cached = cls.auth_sessions.get(key)
+        if cached and (cached[0] is None or time.time() < cached[0]):
+            cls._adapter(netloc)
+            return cached[1]
+
+        session = cls._session(netloc)
+        expires = None
+        if realm:
+            auth = None
+            if username:
+                auth = requests_auth.HTTPBasicAuth(username, password)
+            rauth = session.get(realm, params=token_param, auth=auth,
+                                timeout=30)
+            rauth.raise_for_status()
+            token = rauth.json()
+            session.headers['Authorization'] = 'Bearer %s' % token['token']
+            expires_in = token.get('expires_in') or cls.token_default_expiry
+            expires = time.time() + expires_in - cls.token_expiry_margin
+        with cls.auth_lock:
+            cls.auth_sessions[key] = (expires, session)
+        return session
+
+    @classmethod
+    def _auth_challenge(cls, image_url):
+        """Return the token realm and parameters a registry requires
+
+        The realm is None when the registry does not require authentication.
+        """
         url = cls._build_url(image_url, path='/')
-        session = requests.Session()
+        session = cls._session(image_url.netloc)
         r = session.get(url, timeout=30)
         LOG.debug('%s status code %s' % (url, r.status_code))
         if r.status_code == 200:
-            return session
+            return None, {}
         if r.status_code != 401:
             r.raise_for_status()
         if 'www-authenticate' not in r.headers:
@@ -337,15 +554,34 @@ class BaseImageUploader(object):
         if 'service=' in www_auth:
             token_param['service'] = re.search(
                 'service="(.*?)"', www_auth).group(1)
-        token_param['scope'] = 'repository:%s:pull' % image[1:]
-        auth = None
-        if username:
-            auth = requests_auth.HTTPBasicAuth(username, password)
-        rauth = session.get(realm, params=token_param, auth=auth, timeout=30)
-        rauth.raise_for_status()
-        session.headers['Authorization'] = 'Bearer %s' % rauth.json()['token']
+        return realm, token_param
+
+    @classmethod
+    def _session(cls, netloc):
+        """Return a new session using the connection pool for a registry"""
+        adapter = cls._adapter(netloc)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
         return session
 
+    @classmethod
+    def _adapter(cls, netloc):
+        """Return the adapter for a registry, with a large enough pool
+
+        Adapters are shared by every uploader class, so the pool grows
+        when a class with a larger session_pool_size uses it.
+        """
+        with cls.auth_lock:
+            adapter = cls.auth_adapters.get(netloc)
+            if adapter is None:
+                adapter = RateLimitedAdapter(
+                    cls, pool_maxsize=cls.session_pool_size)
+                cls.auth_adapters[netloc] = adapter
+            else:
+                adapter.grow_pool(cls.session_pool_size)
+        return adapter
+
     @classmethod
     def _build_url(cls, url, path):
         netloc = url.netloc
@@ -378,7 +614,21 @@ class BaseImageUploader(object):
         wait=tenacity.wait_random_exponential(multiplier=1, max=10),
         stop=tenacity.stop_after_attempt(5)
     )
-    def _inspect(cls, image_url, session=None):
+    def _inspect(cls, image_url, session=None, tags=True):
+        """Return the details of an image
+
+        The RepoTags entry is only fetched when tags is True, since listing
+        every tag of a repository can be expensive.
+        """
+        cache_key = image_url.geturl()
+        cached = cls.inspect_cache.get(cache_key)
+        if cached and (not tags or 'RepoTags' in cached[1]) and \
+                time.time() - cached[0] < cls.inspect_cache_ttl:
+            LOG.debug('Using cached inspect for %s' % cache_key)
+            image_metrics.cache('inspect', True)
+            return dict(cached[1])
+        image_metrics.cache('inspect', False)
+
         image, tag = cls._image_tag_from_url(image_url)
         parts = {
             'image': image,
@@ -388,28 +638,38 @@ class BaseImageUploader(object):
         manifest_url = cls._build_url(
             image_url, CALL_MANIFEST % parts
         )
-        tags_url = cls._build_url(
-            image_url, CALL_TAGS % parts
-        )
         manifest_headers = {'Accept': MEDIA_MANIFEST_V2}
 
-        p = futures.ThreadPoolExecutor(max_workers=2)
-        manifest_f = p.submit(
-            session.get, manifest_url, headers=manifest_headers, timeout=30)
-        tags_f = p.submit(session.get, tags_url, timeout=30)
-
-        manifest_r = manifest_f.result()
-        tags_r = tags_f.result()
+        with futures.ThreadPoolExecutor(max_workers=1) as p:
+            # the tags are listed while the manifest and config are fetched
+            tags_f = None
+            if tags:
+                tags_f = p.submit(cls._fetch_tags, image_url, session)
+            result = cls._inspect_manifest(
+                image_url, manifest_url, manifest_headers, parts, session)
+            if tags_f:
+                result['RepoTags'] = tags_f.result()
+        cls.inspect_cache[cache_key] = (time.time(), result)
+        return dict(result)
 
+    @classmethod
+    def _inspect_manifest(cls, image_url, manifest_url, manifest_headers,
+                          parts, session):
+        manifest_r = session.get(
+            manifest_url, headers=manifest_headers, timeout=30)
         if manifest_r.status_code in (403, 404):
             raise ImageNotFoundException('Not found image: %s' %
                                          image_url.geturl())
         manifest_r.raise_for_status()
-        tags_r.raise_for_status()
 
         manifest = manifest_r.json()
         digest = manifest_r.headers['Docker-Content-Digest']
-        if manifest.get('schemaVersion', 2) == 1:
+        details = image_cache.read_json(
+            'inspect', digest, cls.inspect_disk_cache_ttl)
+        image_metrics.cache('inspect_details', bool(details))
+        if details:
+            LOG.debug('Using cached image details for %s' % digest)
+        elif manifest.get('schemaVersion', 2) == 1:
             config = json.loads(manifest['history'][0]['v1Compatibility'])
             layers = list(reversed([l['blobSum']
                                     for l in manifest['fsLayers']]))
@@ -422,34 +682,99 @@ class BaseImageUploader(object):
             }
             config_url = cls._build_url(
                 image_url, CALL_BLOB % parts)
-            config_f = p.submit(
-                session.get, config_url, headers=config_headers, timeout=30)
-            config_r = config_f.result()
+            config_r = session.get(
+                config_url, headers=config_headers, timeout=30)
             config_r.raise_for_status()
             config = config_r.json()
 
-        tags = tags_r.json()['tags']
+        if not details:
+            details = {
+                'Created': config['created'],
+                'DockerVersion': config.get('docker_version', ''),
+                'Labels': config['config']['Labels'],
+                'Architecture': config['architecture'],
+                'Os': config['os'],
+                'Layers': layers,
+            }
+            image_cache.write_json('inspect', digest, details)
 
         image, tag = cls._image_tag_from_url(image_url)
         name = '%s%s' % (image_url.netloc, image)
-        created = config['created']
-        docker_version = config.get('docker_version', '')
-        labels = config['config']['Labels']
-        architecture = config['architecture']
-        image_os = config['os']
 
-        return {
+        result = {
             'Name': name,
             'Tag': tag,
             'Digest': digest,
-            'RepoTags': tags,
-            'Created': created,
-            'DockerVersion': docker_version,
-            'Labels': labels,
-            'Architecture': architecture,
-            'Os': image_os,
-            'Layers': layers,
         }
+        result.update(details)
+        return result
+
+    @classmethod
+    @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        reraise=True,
+        retry=tenacity.retry_if_exception_type(
+            requests.exceptions.RequestException
+        ),
+        wait=tenacity.wait_random_exponential(multiplier=1, max=10),
+        stop=tenacity.stop_after_attempt(5)
+    )
+    def _fetch_tags(cls, image_url, session):
+        """Return every tag of the repository of an image
+
+        Tags are requested in pages of tags_page_size using the n and last
+        parameters, following the Link header to the next page. Registries
+        which don't paginate return every tag in the first response.
+        """
+        image, tag = cls._image_tag_from_url(image_url)
+        url = cls._build_url(image_url, CALL_TAGS % {'image': image})
+        params = {'n': cls.tags_page_size}
+        tags = []
+        while url:
+            r = session.get(url, params=params, timeout=30)
+            r.raise_for_status()
+            page = r.json().get('tags') or []
+            tags.extend(page)
+            next_url = r.links.get('next', {}).get('url')
+            if not page or not next_url:
+                break
+            # the link carries the n and last parameters of the next page
+            url = parse.urljoin(url, next_url)
+            params = None
+        return tags
+
+    @classmethod
+    @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        reraise=True,
+        retry=tenacity.retry_if_exception_type(
+            requests.exceptions.RequestException
+        ),
+        wait=tenacity.wait_random_exponential(multiplier=1, max=10),
+        stop=tenacity.stop_after_attempt(5)
+    )
+    def _fetch_manifest_digest(cls, url, session, multi_arch=True):
+        """Return the manifest digest of an image, or None if it is missing
+
+        Only a HEAD call is made, for the Docker-Content-Digest header.
+        Manifest lists are accepted unless multi_arch is False.
+        """
+        image, tag = cls._image_tag_from_url(url)
+        parts = {
+            'image': image,
+            'tag': tag
+        }
+        url = cls._build_url(
+            url, CALL_MANIFEST % parts
+        )
+        if multi_arch:
+            manifest_headers = {'Accept': ', '.join(
+                (MEDIA_MANIFEST_V2,) + MANIFEST_LIST_TYPES)}
+        else:
+            manifest_headers = {'Accept': MEDIA_MANIFEST_V2}
+        r = session.head(url, headers=manifest_headers, timeout=30)
+        if r.status_code in (403, 404):
+            return None
+        r.raise_for_status()
+        return r.headers.get('Docker-Content-Digest')
 
     @classmethod
     def _image_to_url(cls, image):
@@ -459,8 +784,8 @@ class BaseImageUploader(object):
         return url
 
     @classmethod
-    def _discover_tag_from_inspect(cls, i, image, tag_from_label=None,
-                                   fallback_tag=None):
+    def _discover_tag_label(cls, i, image, tag_from_label=None,
+                            fallback_tag=None):
         labels = i.get('Labels', {})
 
         label_keys = ', '.join(labels.keys())
@@ -493,6 +818,13 @@ class BaseImageUploader(object):
                         'Image %s has no label %s. Available labels: %s' %
                         (image, tag_from_label, label_keys)
                     )
+        return tag_label
+
+    @classmethod
+    def _discover_tag_from_inspect(cls, i, image, tag_from_label=None,
+                                   fallback_tag=None):
+        tag_label = cls._discover_tag_label(i, image, tag_from_label,
+                                            fallback_tag)
 
         # confirm the tag exists by checking for an entry in RepoTags
         repo_tags = i.get('RepoTags', [])
@@ -503,22 +835,54 @@ class BaseImageUploader(object):
             )
         return tag_label
 
+    @classmethod
+    def _discover_tag(cls, image_url, image, tag_from_label=None,
+                      fallback_tag=None, session=None):
+        """Return the tag an image label refers to
+
+        Only the manifest and config are fetched to read the labels, then
+        the tag is confirmed with a HEAD of its manifest. The tags of the
+        repository are only listed to report a missing tag.
+        """
+        i = cls._inspect(image_url, session=session, tags=False)
+        if 'RepoTags' in i:
+            # the tags are already known
+            return cls._discover_tag_from_inspect(i, image, tag_from_label,
+                                                  fallback_tag)
+        tag_label = cls._discover_tag_label(i, image, tag_from_label,
+                                            fallback_tag)
+        if tag_label == i.get('Tag'):
+            return tag_label
+
+        name = image_url.path.rpartition(':')[0] or image_url.path
+        tag_url = parse.urlparse('docker://%s%s:%s' % (
+            image_url.netloc, name, tag_label))
+        if cls._fetch_manifest_digest(tag_url, session):
+            return tag_label
+        repo_tags = cls._fetch_tags(tag_url, session)
+        raise ImageUploaderException(
+            'Image %s has no tag %s.\nAvailable tags: %s' %
+            (image, tag_label, ', '.join(repo_tags))
+        )
+
     def discover_image_tags(self, images, tag_from_label=None):
         image_urls = [self._image_to_url(i) for i in images]
 
         # prime self.insecure_registries by testing every image
-        for url in image_urls:
-            self.is_insecure_registry(url.netloc)
+        self.prime_insecure_registries(url.netloc for url in image_urls)
 
         discover_args = []
         for image in images:
             discover_args.append((image, tag_from_label))
-        p = futures.ThreadPoolExecutor(max_workers=16)
 
+        # more workers than the pooled connections of a registry session
+        # would only wait for a connection
+        workers = max(1, min(self.session_pool_size, len(images)))
         versioned_images = {}
-        for image, versioned_image in p.map(discover_tag_from_inspect,
-                                            discover_args):
-            versioned_images[image] = versioned_image
+        with futures.ThreadPoolExecutor(max_workers=workers) as p:
+            for image, versioned_image in p.map(discover_tag_from_inspect,
+                                                discover_args):
+                versioned_images[image] = versioned_image
         return versioned_images
 
     def discover_image_tag(self, image, tag_from_label=None,
@@ -527,9 +891,8 @@ class BaseImageUploader(object):
         self.is_insecure_registry(image_url.netloc)
         session = self.authenticate(
             image_url, username=username, password=password)
-        i = self._inspect(image_url, session)
-        return self._discover_tag_from_inspect(i, image, tag_from_label,
-                                               fallback_tag)
+        return self._discover_tag(image_url, image, tag_from_label,
+                                  fallback_tag, session=session)
 
     def filter_images_with_labels(self, images, labels,
                                   username=None, password=None):
@@ -558,22 +921,138 @@ class BaseImageUploader(object):
             self._image_to_url(task.push_destination).netloc)
         self.upload_tasks.append((self, task))
 
-    def is_insecure_registry(self, registry_host):
-        if registry_host in self.secure_registries:
+    @classmethod
+    def is_insecure_registry(cls, registry_host):
+        if registry_host in cls.secure_registries:
             return False
-        if registry_host in self.insecure_registries:
+        if registry_host in cls.insecure_registries:
+            return True
+        cached = image_cache.read_json(
+            'registries', registry_host, cls.registry_probe_cache_ttl)
+        if cached is not None:
+            insecure = cached.get('insecure')
+        else:
+            insecure = cls._probe_insecure_registry(registry_host)
+            if insecure is not None:
+                image_cache.write_json('registries', registry_host,
+                                       {'insecure': insecure})
+        if insecure:
+            cls.insecure_registries.add(registry_host)
             return True
+        cls.secure_registries.add(registry_host)
+        return False
+
+    @classmethod
+    def _probe_insecure_registry(cls, registry_host):
+        """Return whether a registry serves plain http
+
+        Returns None when the registry could not be reached.
+        """
         try:
-            requests.get('https://%s/v2' % registry_host, timeout=30)
+            requests.get('https://%s/v2' % registry_host,
+                         timeout=cls.registry_probe_timeout)
         except requests.exceptions.SSLError:
-            self.insecure_registries.add(registry_host)
             return True
         except Exception:
             # for any other error assume it is a secure registry, because:
             # - it is secure registry
             # - the host is not accessible
-            pass
-        self.secure_registries.add(registry_host)
+            return None
+        return False
+
+    @classmethod
+    def prime_insecure_registries(cls, registry_hosts):
+        """Probe every unknown registry host concurrently"""
+        hosts = set(registry_hosts) - cls.secure_registries - \
+            cls.insecure_registries
+        if not hosts:
+            return
+        workers = min(16, len(hosts))
+        with futures.ThreadPoolExecutor(max_workers=workers) as p:
+            list(p.map(cls.is_insecure_registry, hosts))
+
+    @classmethod
+    def _blob_key(cls, image_url, digest):
+        return (image_url.netloc, image_url.path.split(':')[0], digest)
+
+    @classmethod
+    def _registry_blob_added(cls, image_url, digest):
+        key = cls._blob_key(image_url, digest)
+        cls.registry_blobs.add(key)
+        cls.missing_blobs.pop(key, None)
+
+    @classmethod
+    def _forget_registry_blobs(cls, image_url):
+        """Forget the blobs known to exist in a registry image"""
+        image = cls._blob_key(image_url, None)[:2]
+        for key in list(cls.registry_blobs):
+            if key[:2] == image:
+                cls.registry_blobs.discard(key)
+
+    @classmethod
+    def _registry_blob_known(cls, image_url, digest):
+        """Return True or False if the blob presence is known, else None"""
+        key = cls._blob_key(image_url, digest)
+        if key in cls.registry_blobs:
+            image_metrics.cache('registry_blobs', True)
+            return True
+        missing_time = cls.missing_blobs.get(key)
+        if missing_time and time.time() - missing_time < cls.missing_blobs_ttl:
+            image_metrics.cache('registry_blobs', True)
+            return False
+        image_metrics.cache('registry_blobs', False)
+        return None
+
+    @classmethod
+    def _registry_blobs_exist(cls, image_url, digests, session):
+        """Return the digests which exist in the registry image
+
+        Digests not already in the blob presence cache are checked with
+        concurrent HEAD calls, and the results are added to the cache.
+        """
+        existing = set()
+        check_digests = []
+        for digest in digests:
+            known = cls._registry_blob_known(image_url, digest)
+            if known:
+                existing.add(digest)
+            elif known is None and digest not in check_digests:
+                check_digests.append(digest)
+        return existing | cls._registry_blobs_check(
+            image_url, check_digests, session)
+
+    @classmethod
+    def _registry_blobs_check(cls, image_url, digests, session):
+        """Check for blobs with concurrent HEAD calls
+
+        Returns the digests which exist, and adds the results to the blob
+        presence cache.
+        """
+        if not digests:
+            return set()
+
+        def blob_exists(digest):
+            return cls._registry_blob_exists(image_url, digest, session)
+
+        workers = min(8, len(digests))
+        with futures.ThreadPoolExecutor(max_workers=workers) as p:
+            results = list(p.map(blob_exists, digests))
+        return set(d for d, exists in zip(digests, results) if exists)
+
+    @classmethod
+    def _registry_blob_exists(cls, image_url, digest, session):
+        """Check for a blob with a HEAD call and cache the result"""
+        image, tag = cls._image_tag_from_url(image_url)
+        parts = {
+            'image': image,
+            'tag': tag,
+            'digest': digest
+        }
+        blob_url = cls._build_url(image_url, CALL_BLOB % parts)
+        if session.head(blob_url, timeout=30).status_code == 200:
+            cls._registry_blob_added(image_url, digest)
+            return True
+        cls.missing_blobs[cls._blob_key(image_url, digest)] = time.time()
         return False
 
     @classmethod
@@ -603,6 +1082,8 @@ class BaseImageUploader(object):
 
         for layer in source_layers:
             if layer in image_layers:
+                if cls._registry_blob_known(target_image_url, layer):
+                    continue
                 existing_name = image_layers[layer].path.split(':')[0][1:]
                 LOG.info('Cross repository blob mount %s from %s' %
                          (layer, existing_name))
@@ -613,6 +1094,8 @@ class BaseImageUploader(object):
                 r = session.post(url, data=data, timeout=30)
                 r.raise_for_status()
                 LOG.debug('%s %s' % (r.status_code, r.reason))
+                if r.status_code == 201:
+                    cls._registry_blob_added(target_image_url, layer)
 
 
 class DockerImageUploader(BaseImageUploader):
@@ -903,7 +1386,222 @@ class SkopeoImageUploader(BaseImageUploader):
 class PythonImageUploader(BaseImageUploader):
     """Upload images using a direct implementation of the registry API"""
 
-    def upload_image(self, task):
+    # Layer copies are scheduled on a single executor shared by every image,
+    # so each unique layer is copied once with a global concurrency limit.
+    # The copies scheduled are only shared within one run_tasks call
+    layer_workers = max(4, processutils.get_worker_count())
+    session_pool_size = max(16, layer_workers)
+    layer_executor = None
+    layer_jobs = {}
+    layer_jobs_lock = threading.Lock()
+
+    # Compressed layers copied to each registry, keyed by (registry,
+    # uncompressed diff_id), with the image each was copied to. Local
+    # layers with a known diff_id are mounted instead of compressed again
+    diff_id_layers = {}
+
+    # Concurrency of each stage of uploading modified images. Images are
+    # pipelined through the stages, so some images are pulled and pushed
+    # while others are modified
+    modify_pull_workers = 4
+    modify_workers = max(2, processutils.get_worker_count() // 2)
+    modify_push_workers = 4
+
+    # Parsed containers-storage metadata, indexed by image name and layer
+    # digest, shared by every image until the metadata file changes
+    containers_index = {}
+    containers_index_lock = threading.Lock()
+
+    # Size of the chunks layers are read and uploaded in
+    chunk_size = 2 ** 20
+
+    # gzip level of layers compressed from local storage, and the number
+    # of blocks of a layer compressed in parallel
+    layer_compress_level = DEFAULT_COMPRESS_LEVEL
+    layer_compress_workers = processutils.get_worker_count()
+    compress_executor = None
+
+    # Layers up to this size are uploaded with a single request instead of
+    # a chunked upload
+    monolithic_upload_size = 2 ** 22
+
+    # os/architecture[/variant] platforms copied from manifest lists, or
+    # PLATFORMS_ALL. When empty, manifest lists are not requested, so only
+    # the platform the source registry defaults to is copied
+    platforms = set()
+
+    @classmethod
+    def init_registries_cache(cls):
+        super(PythonImageUploader, cls).init_registries_cache()
+        with cls.layer_jobs_lock:
+            cls.layer_jobs.clear()
+            cls.diff_id_layers.clear()
+        cls._containers_changed()
+
+    @classmethod
+    def init_run_cache(cls):
+        """Forget the layers copied and found by an earlier run
+
+        The registries and export directories may have changed since, so
+        a finished copy is no proof the layer still exists.
+        """
+        super(PythonImageUploader, cls).init_run_cache()
+        with cls.layer_jobs_lock:
+            cls.layer_jobs.clear()
+            cls.diff_id_layers.clear()
+
+    @classmethod
+    def init_platforms(cls, platforms=None):
+        """Set the platforms copied from manifest lists
+
+        Platforms are given as os/architecture, optionally with a
+        /variant, or just the architecture for linux. Every platform is
+        copied when PLATFORMS_ALL is given, and only the default platform
+        of the source registry when none are given.
+        """
+        cls.platforms.clear()
+        for platform in platforms or ():
+            if platform == PLATFORMS_ALL:
+                cls.platforms.add(platform)
+                continue
+            parts = platform.split('/')
+            if len(parts) == 1:
+                parts.insert(0, 'linux')
+            if len(parts) > 3:
+                raise ImageUploaderException(
+                    'Invalid platform: %s' % platform)
+            parts[1] = PLATFORM_ARCHITECTURES.get(parts[1], parts[1])
+            cls.platforms.add('/'.join(parts))
+
+    @classmethod
+    def init_compression(cls, compress_level=None, compress_workers=None):
+        if compress_level is None:
+            compress_level = DEFAULT_COMPRESS_LEVEL
+        if compress_workers is None:
+            compress_workers = processutils.get_worker_count()
+        if compress_level not in range(0, 10):
+            raise ImageUploaderException(
+                'Invalid compress level %s, must be 0 to 9' % compress_level)
+        if compress_workers < 1:
+            raise ImageUploaderException(
+                'Invalid compress workers %s' % compress_workers)
+        with cls.layer_jobs_lock:
+            cls.layer_compress_level = compress_level
+            if compress_workers != cls.layer_compress_workers:
+                cls.layer_compress_workers = compress_workers
+                if cls.compress_executor:
+                    cls.compress_executor.shutdown(wait=False)
+                cls.compress_executor = None
+
+    @classmethod
+    def _compress_executor(cls):
+        with cls.layer_jobs_lock:
+            if cls.compress_executor is None:
+                cls.compress_executor = futures.ThreadPoolExecutor(
+                    max_workers=cls.layer_compress_workers)
+            return cls.compress_executor
+
+    @classmethod
+    def _layer_executor(cls):
+        with cls.layer_jobs_lock:
+            if cls.layer_executor is None:
+                cls.layer_executor = futures.ThreadPoolExecutor(
+                    max_workers=cls.layer_workers)
+            return cls.layer_executor
+
+    @classmethod
+    def _schedule_layer_copy(cls, source_url, target_url, layer):
+        """Schedule a registry to registry layer copy
+
+        Returns a future for the copy and the target url it is copied to.
+        When another image already scheduled a copy of the same layer to
+        the same registry, that copy is returned instead of a new one.
+        The copy authenticates when it runs, since it may wait in the queue
+        for longer than the lifetime of a token.
+        """
+        executor = cls._layer_executor()
+        return cls._schedule_layer_job(
+            cls.layer_jobs, target_url, layer, functools.partial(
+                executor.submit, cls._copy_layer_registry_to_registry,
+                source_url, target_url, layer=layer))
+
+    @classmethod
+    def _schedule_layer_job(cls, jobs, target_url, layer, submit):
+        """Return the job which copies a layer, calling submit if there is none
+
+        jobs maps (registry, digest) to a (job, target url) tuple, and
+        submit starts a copy and returns its future. A failed copy is
+        forgotten, so the next image which needs the layer tries again.
+        """
+        key = (target_url.netloc, layer['digest'])
+        with cls.layer_jobs_lock:
+            if key in jobs:
+                return jobs[key]
+            job = submit()
+            jobs[key] = (job, target_url)
+
+        def forget_failed(f):
+            if f.cancelled() or f.exception():
+                with cls.layer_jobs_lock:
+                    jobs.pop(key, None)
+
+        job.add_done_callback(forget_failed)
+        return job, target_url
+
+    @classmethod
+    def _manifest_layers(cls, manifest):
+        """Return the layers of an image manifest and its config digest
+
+        Schema 1 manifests list their layers last first and have no config
+        blob, so the config digest is None.
+        """
+        if manifest.get('schemaVersion', 2) == 1:
+            layers = list(reversed([{'digest': l['blobSum']}
+                                    for l in manifest['fsLayers']]))
+            return layers, None
+        return manifest['layers'], manifest['config']['digest']
+
+    @classmethod
+    def _unknown_layers(cls, target_url, layers):
+        """Return the digests of layers to check for in the target
+
+        Every layer is checked before any is copied, so the copies of
+        existing layers are answered by the blob presence cache. Export
+        registries are not checked, nor are blobs already in the cache.
+        """
+        if target_url.netloc in cls.export_registries:
+            return []
+        digests = []
+        for layer in layers:
+            digest = layer['digest']
+            if digest not in digests and \
+                    cls._registry_blob_known(target_url, digest) is None:
+                digests.append(digest)
+        return digests
+
+    @classmethod
+    def _layer_mounts(cls, target_url, layers, copy_target_urls):
+        """Return the layers which were copied for another image
+
+        A layer copy shared with another image uploads to that image, so
+        the (digest, copy target url) of each is cross repo mounted into
+        target_url once the copy completes.
+        """
+        target_image, target_tag = cls._image_tag_from_url(target_url)
+        mounts = []
+        for layer, copy_target_url in zip(layers, copy_target_urls):
+            copy_image, copy_tag = cls._image_tag_from_url(copy_target_url)
+            if copy_image != target_image:
+                mounts.append((layer['digest'], copy_target_url))
+        return mounts
+
+    def upload_image(self, task, stages=None):
+        """Upload an image, modifying it first when it has a modify_role
+
+        Modified images are uploaded in pull, modify and push stages. When
+        stages is passed it maps each stage to a semaphore limiting how
+        many images run that stage at once.
+        """
         t = task
         LOG.info('imagename: %s' % t.image_name)
 
@@ -912,54 +1610,62 @@ class PythonImageUploader(BaseImageUploader):
         if t.dry_run:
             return []
 
-        target_session = self.authenticate(
-            t.target_image_url)
+        with pipeline_stage(stages, 'pull'):
+            target_session = self.authenticate(
+                t.target_image_url)
 
-        self._detect_target_export(t.target_image_url, target_session)
+            self._detect_target_export(t.target_image_url, target_session)
 
-        if t.modify_role:
-            if self._image_exists(
-                    t.target_image, target_session):
-                LOG.warning('Skipping upload for modified image %s' %
-                            t.target_image)
-                return []
-            copy_target_url = t.target_image_source_tag_url
-        else:
-            copy_target_url = t.target_image_url
+            if t.modify_role:
+                if self._image_exists(
+                        t.target_image, target_session):
+                    LOG.warning('Skipping upload for modified image %s' %
+                                t.target_image)
+                    return []
+                copy_target_url = t.target_image_source_tag_url
+            else:
+                copy_target_url = t.target_image_url
 
-        source_session = self.authenticate(
-            t.source_image_url)
+            source_session = self.authenticate(
+                t.source_image_url)
 
-        manifest_str = self._fetch_manifest(
-            t.source_image_url,
-            session=source_session
-        )
-        manifest = json.loads(manifest_str)
-        source_layers = [l['digest'] for l in manifest['layers']]
+            manifest_str = self._fetch_manifest(
+                t.source_image_url,
+                session=source_session,
+                multi_arch=bool(self.platforms) and not t.modify_role
+            )
+            manifest = json.loads(manifest_str)
+            # the layers of manifest lists are copied per platform
+            source_layers = [l['digest']
+                             for l in manifest.get('layers', [])]
 
-        self._cross_repo_mount(
-            copy_target_url, self.image_layers, source_layers,
-            session=target_session)
-        to_cleanup = []
+            self._cross_repo_mount(
+                copy_target_url, self.image_layers, source_layers,
+                session=target_session)
+            to_cleanup = []
 
-        # Copy unmodified images from source to target
-        self._copy_registry_to_registry(
-            t.source_image_url,
-            copy_target_url,
-            source_manifest=manifest_str,
-            source_session=source_session,
-            target_session=target_session
-        )
+            # Copy unmodified images from source to target
+            self._copy_registry_to_registry(
+                t.source_image_url,
+                copy_target_url,
+                source_manifest=manifest_str,
+                source_session=source_session,
+                target_session=target_session
+            )
+
+            if not t.modify_role:
+                LOG.warning('Completed upload for image %s' % t.image_name)
+                for layer in source_layers:
+                    self.image_layers.setdefault(layer, t.target_image_url)
+                return to_cleanup
 
-        if not t.modify_role:
-            LOG.warning('Completed upload for image %s' % t.image_name)
-        else:
             # Copy ummodified from target to local
             self._copy_registry_to_local(t.target_image_source_tag_url)
 
             if t.cleanup in (CLEANUP_FULL, CLEANUP_PARTIAL):
                 to_cleanup.append(t.target_image_source_tag)
 
+        with pipeline_stage(stages, 'modify'):
             self.run_modify_playbook(
                 t.modify_role,
                 t.modify_vars,
@@ -970,6 +1676,7 @@ class PythonImageUploader(BaseImageUploader):
             if t.cleanup == CLEANUP_FULL:
                 to_cleanup.append(t.target_image)
 
+        with pipeline_stage(stages, 'push'):
             # cross-repo mount the unmodified image to the modified image
             self._cross_repo_mount(
                 t.target_image_url, self.image_layers, source_layers,
@@ -982,12 +1689,10 @@ class PythonImageUploader(BaseImageUploader):
                 session=target_session
             )
 
-            for layer in source_layers:
-                self.image_layers.setdefault(layer, t.target_image_url)
-            LOG.warning('Completed modify and upload for image %s' %
-                        t.image_name)
         for layer in source_layers:
             self.image_layers.setdefault(layer, t.target_image_url)
+        LOG.warning('Completed modify and upload for image %s' %
+                    t.image_name)
         return to_cleanup
 
     @classmethod
@@ -1027,7 +1732,7 @@ class PythonImageUploader(BaseImageUploader):
         wait=tenacity.wait_random_exponential(multiplier=1, max=10),
         stop=tenacity.stop_after_attempt(5)
     )
-    def _fetch_manifest(cls, url, session):
+    def _fetch_manifest(cls, url, session, multi_arch=False):
         image, tag = cls._image_tag_from_url(url)
         parts = {
             'image': image,
@@ -1036,7 +1741,11 @@ class PythonImageUploader(BaseImageUploader):
         url = cls._build_url(
             url, CALL_MANIFEST % parts
         )
-        manifest_headers = {'Accept': MEDIA_MANIFEST_V2}
+        if multi_arch:
+            manifest_headers = {'Accept': ', '.join(
+                (MEDIA_MANIFEST_V2,) + MANIFEST_LIST_TYPES)}
+        else:
+            manifest_headers = {'Accept': MEDIA_MANIFEST_V2}
         r = session.get(url, headers=manifest_headers, timeout=30)
         if r.status_code in (403, 404):
             raise ImageNotFoundException('Not found image: %s' %
@@ -1044,6 +1753,86 @@ class PythonImageUploader(BaseImageUploader):
         r.raise_for_status()
         return r.text
 
+    @classmethod
+    @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        reraise=True,
+        retry=tenacity.retry_if_exception_type(
+            requests.exceptions.RequestException
+        ),
+        wait=tenacity.wait_random_exponential(multiplier=1, max=10),
+        stop=tenacity.stop_after_attempt(5)
+    )
+    def _fetch_platform_manifest(cls, url, entry, session):
+        """Fetch the manifest a manifest list entry references by digest
+
+        The manifest is returned exactly as fetched, since the list refers
+        to it by the digest of its content.
+        """
+        image, tag = cls._image_tag_from_url(url)
+        parts = {
+            'image': image,
+            'tag': entry['digest']
+        }
+        manifest_url = cls._build_url(
+            url, CALL_MANIFEST % parts
+        )
+        manifest_headers = {'Accept': entry['mediaType']}
+        r = session.get(manifest_url, headers=manifest_headers, timeout=30)
+        if r.status_code in (403, 404):
+            raise ImageNotFoundException('Not found image: %s' %
+                                         manifest_url)
+        r.raise_for_status()
+        digest = 'sha256:%s' % hashlib.sha256(r.content).hexdigest()
+        if digest != entry['digest']:
+            raise ImageUploaderException(
+                'Manifest digest %s does not match %s' % (
+                    digest, entry['digest']))
+        return r.content.decode('utf-8')
+
+    @classmethod
+    def _is_manifest_list(cls, manifest):
+        if manifest.get('mediaType') in MANIFEST_LIST_TYPES:
+            return True
+        # the mediaType of an OCI index is optional
+        return 'manifests' in manifest and 'layers' not in manifest
+
+    @classmethod
+    def _select_platforms(cls, manifest_list):
+        """Return the manifest list entries for the configured platforms
+
+        Without configured platforms a registry may still return a list,
+        for example when it can't convert an OCI index, so the platform of
+        this host is selected.
+        """
+        if PLATFORMS_ALL in cls.platforms:
+            return list(manifest_list['manifests'])
+        platforms = cls.platforms
+        if not platforms:
+            machine = os.uname()[4]
+            platforms = set(['linux/%s' % PLATFORM_ARCHITECTURES.get(
+                machine, machine)])
+        entries = []
+        for entry in manifest_list['manifests']:
+            platform = entry.get('platform', {})
+            name = '%s/%s' % (platform.get('os'),
+                              platform.get('architecture'))
+            names = [name]
+            if platform.get('variant'):
+                names.append('%s/%s' % (name, platform['variant']))
+            if platforms.intersection(names):
+                entries.append(entry)
+                if not cls.platforms:
+                    break
+        if not entries:
+            raise ImageUploaderException(
+                'No manifest for platforms %s, available platforms: %s' % (
+                    ', '.join(sorted(platforms)),
+                    ', '.join('%s/%s' % (
+                        e.get('platform', {}).get('os'),
+                        e.get('platform', {}).get('architecture'))
+                        for e in manifest_list['manifests'])))
+        return entries
+
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
         reraise=True,
@@ -1066,14 +1855,6 @@ class PythonImageUploader(BaseImageUploader):
         return r.headers['Location']
 
     @classmethod
-    @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
-        reraise=True,
-        retry=tenacity.retry_if_exception_type(
-            requests.exceptions.RequestException
-        ),
-        wait=tenacity.wait_random_exponential(multiplier=1, max=10),
-        stop=tenacity.stop_after_attempt(5)
-    )
     def _layer_stream_registry(cls, digest, source_url, calc_digest,
                                session):
         LOG.debug('Fetching layer: %s' % digest)
@@ -1085,15 +1866,55 @@ class PythonImageUploader(BaseImageUploader):
         }
         source_blob_url = cls._build_url(
             source_url, CALL_BLOB % parts)
-        chunk_size = 2 ** 20
-        with session.get(
-                source_blob_url, stream=True, timeout=30) as blob_req:
-            blob_req.raise_for_status()
-            for data in blob_req.iter_content(chunk_size):
-                if not data:
-                    break
-                calc_digest.update(data)
-                yield data
+        registry = parse.urlparse(source_blob_url).netloc
+        started = time.time()
+        length = 0
+        attempt = 0
+        while True:
+            # calc_digest holds the state of every byte already yielded, so
+            # a failed download is resumed from that offset
+            headers = {}
+            if length:
+                headers['Range'] = 'bytes=%d-' % length
+            try:
+                waited = time.time()
+                with session.get(source_blob_url, stream=True, timeout=30,
+                                 headers=headers) as blob_req:
+                    blob_req.raise_for_status()
+                    skip = 0
+                    if length and blob_req.status_code != 206:
+                        # range not supported, discard what was yielded
+                        skip = length
+                    for data in blob_req.iter_content(cls.chunk_size):
+                        if not data:
+                            break
+                        if skip:
+                            discard = min(skip, len(data))
+                            data = data[discard:]
+                            skip -= discard
+                            if not data:
+                                continue
+                        cls._throttle(source_blob_url, RATE_LIMIT_BYTES,
+                                      len(data))
+                        # only the time waiting for the registry counts
+                        # towards the transfer rate, not the consumer
+                        image_metrics.transfer(registry, 'pull', len(data),
+                                               time.time() - waited)
+                        calc_digest.update(data)
+                        length += len(data)
+                        yield data
+                        waited = time.time()
+                elapsed = time.time() - started
+                LOG.info('Fetched layer %s, %s bytes in %.1f seconds' % (
+                    digest, length, elapsed))
+                return
+            except requests.exceptions.RequestException as e:
+                attempt += 1
+                if attempt >= 5:
+                    raise
+                LOG.warning('Fetching layer %s failed at offset %s, '
+                            'resuming: %s' % (digest, length, e))
+                time.sleep(min(10, 2 ** attempt))
 
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
@@ -1108,6 +1929,17 @@ class PythonImageUploader(BaseImageUploader):
                                          layer,
                                          source_session=None,
                                          target_session=None):
+        export = target_url.netloc in cls.export_registries
+        if export:
+            layer['mediaType'] = MEDIA_BLOB_COMPRESSED
+            if image_export.export_existing(target_url, layer):
+                return
+        # Sessions which are not passed are looked up on every attempt, so
+        # a retry gets a new token when the previous one expired
+        if source_session is None:
+            source_session = cls.authenticate(source_url)
+        if target_session is None:
+            target_session = cls.authenticate(target_url)
         if cls._target_layer_exists_registry(target_url, layer, [layer],
                                              target_session):
             return
@@ -1115,9 +1947,31 @@ class PythonImageUploader(BaseImageUploader):
         digest = layer['digest']
         LOG.debug('Uploading layer: %s' % digest)
 
+        if export and image_cache.blob_path(digest):
+            # Exported layers are written once, to the blob cache, then
+            # linked into the export directory without hashing them again
+            if not image_cache.blob_exists(digest):
+                calc_digest = hashlib.sha256()
+                for data in image_cache.cache_stream(
+                        digest,
+                        cls._layer_stream_registry(
+                            digest, source_url, calc_digest, source_session),
+                        calc_digest):
+                    pass
+            blob_path = image_cache.blob_file(digest)
+            if blob_path:
+                return image_export.export_file(target_url, layer, blob_path)
+
         calc_digest = hashlib.sha256()
-        layer_stream = cls._layer_stream_registry(
-            digest, source_url, calc_digest, source_session)
+        if image_cache.blob_exists(digest):
+            layer_stream = image_cache.blob_stream(
+                digest, calc_digest, cls.chunk_size)
+        else:
+            layer_stream = image_cache.cache_stream(
+                digest,
+                cls._layer_stream_registry(
+                    digest, source_url, calc_digest, source_session),
+                calc_digest)
         return cls._copy_stream_to_registry(target_url, layer, calc_digest,
                                             layer_stream, target_session)
 
@@ -1143,47 +1997,15 @@ class PythonImageUploader(BaseImageUploader):
         cls._assert_scheme(source_url, 'docker')
         cls._assert_scheme(target_url, 'docker')
 
-        image, tag = cls._image_tag_from_url(source_url)
-        parts = {
-            'image': image,
-            'tag': tag
-        }
-
         manifest = json.loads(source_manifest)
-        v1manifest = manifest.get('schemaVersion', 2) == 1
-        # config = json.loads(manifest['history'][0]['v1Compatibility'])
-        if v1manifest:
-            layers = list(reversed([{'digest': l['blobSum']}
-                                    for l in manifest['fsLayers']]))
-            config_str = None
-        else:
-            layers = manifest['layers']
-            config_digest = manifest['config']['digest']
-            LOG.debug('Uploading config with digest: %s' % config_digest)
-
-            parts['digest'] = config_digest
-            source_config_url = cls._build_url(
-                source_url, CALL_BLOB % parts)
-
-            r = source_session.get(source_config_url, timeout=30)
-            r.raise_for_status()
-            config_str = r.text
-
-        # Upload all layers
-        copy_jobs = []
-        p = futures.ThreadPoolExecutor(max_workers=4)
-        for layer in layers:
-            copy_jobs.append(p.submit(
-                cls._copy_layer_registry_to_registry,
-                source_url, target_url,
-                layer=layer,
+        if cls._is_manifest_list(manifest):
+            return cls._copy_manifest_list_to_registry(
+                source_url, target_url, manifest, source_manifest,
                 source_session=source_session,
-                target_session=target_session
-            ))
-        for job in copy_jobs:
-            image = job.result()
-            if image:
-                LOG.debug('Upload complete for layer: %s' % image)
+                target_session=target_session)
+        config_str = cls._copy_layers_to_registry(
+            source_url, target_url, manifest, source_session,
+            target_session)
         cls._copy_manifest_config_to_registry(
             target_url=target_url,
             manifest_str=source_manifest,
@@ -1191,6 +2013,104 @@ class PythonImageUploader(BaseImageUploader):
             target_session=target_session
         )
 
+    @classmethod
+    def _copy_manifest_list_to_registry(cls, source_url, target_url,
+                                        manifest_list, manifest_list_str,
+                                        source_session=None,
+                                        target_session=None):
+        """Copy the selected platforms of a manifest list, then the list
+
+        Platforms are copied in parallel, and their layers go through the
+        layer scheduler, so layers shared between platforms are copied
+        once. The list is pushed last, when every manifest it references
+        exists in the target.
+        """
+        entries = cls._select_platforms(manifest_list)
+
+        def copy_platform(entry):
+            manifest_str = cls._fetch_platform_manifest(
+                source_url, entry, source_session)
+            config_str = cls._copy_layers_to_registry(
+                source_url, target_url, json.loads(manifest_str),
+                source_session, target_session)
+            cls._copy_platform_manifest_to_registry(
+                target_url, entry, manifest_str, config_str, target_session)
+
+        with futures.ThreadPoolExecutor(max_workers=len(entries)) as p:
+            list(p.map(copy_platform, entries))
+        cls._copy_manifest_list_entries_to_registry(
+            target_url, manifest_list, manifest_list_str, entries,
+            target_session)
+
+    @classmethod
+    def _copy_layers_to_registry(cls, source_url, target_url, manifest,
+                                 source_session, target_session):
+        """Copy the config and layers of a manifest, returning the config"""
+        layers, config_digest = cls._manifest_layers(manifest)
+        config_str = None
+        if config_digest:
+            config_str = cls._fetch_config(
+                source_url, config_digest, source_session)
+
+        cls._registry_blobs_check(
+            target_url, cls._unknown_layers(target_url, layers),
+            target_session)
+
+        # Upload all layers
+        copy_jobs = [
+            cls._schedule_layer_copy(source_url, target_url, layer)
+            for layer in layers
+        ]
+        for job, job_target_url in copy_jobs:
+            image = job.result()
+            if image:
+                LOG.debug('Upload complete for layer: %s' % image)
+        for digest, job_target_url in cls._layer_mounts(
+                target_url, layers, [u for j, u in copy_jobs]):
+            cls._cross_repo_mount(
+                target_url, {digest: job_target_url}, [digest],
+                session=target_session)
+        cls._record_diff_ids(target_url, layers, config_str)
+        return config_str
+
+    @classmethod
+    def _record_diff_ids(cls, target_url, layers, config_str):
+        """Record the compressed layers of an image copied to target_url
+
+        The image config lists the uncompressed diff_id of each layer in
+        manifest order.
+        """
+        if not config_str:
+            return
+        config = json.loads(config_str)
+        diff_ids = config.get('rootfs', {}).get('diff_ids', [])
+        if len(diff_ids) != len(layers):
+            return
+        with cls.layer_jobs_lock:
+            for diff_id, layer in zip(diff_ids, layers):
+                known = {'digest': layer['digest']}
+                for key in ('size', 'mediaType'):
+                    if key in layer:
+                        known[key] = layer[key]
+                cls.diff_id_layers[(target_url.netloc, diff_id)] = (
+                    known, target_url)
+
+    @classmethod
+    def _fetch_config(cls, source_url, config_digest, session):
+        LOG.debug('Uploading config with digest: %s' % config_digest)
+        image, tag = cls._image_tag_from_url(source_url)
+        parts = {
+            'image': image,
+            'tag': tag,
+            'digest': config_digest
+        }
+        source_config_url = cls._build_url(
+            source_url, CALL_BLOB % parts)
+
+        r = session.get(source_config_url, timeout=30)
+        r.raise_for_status()
+        return r.text
+
     @classmethod
     def _copy_manifest_config_to_registry(cls, target_url,
                                           manifest_str,
@@ -1199,11 +2119,16 @@ class PythonImageUploader(BaseImageUploader):
 
         manifest = json.loads(manifest_str)
         if config_str is not None:
-            manifest['config']['size'] = len(config_str)
-            manifest['config']['mediaType'] = MEDIA_CONFIG
-            manifest['mediaType'] = MEDIA_MANIFEST_V2
             manifest_type = MEDIA_MANIFEST_V2
-            manifest_str = json.dumps(manifest, indent=3)
+            config = dict(manifest['config'], size=len(config_str),
+                          mediaType=MEDIA_CONFIG)
+            # the manifest is only serialized again when it changes, so an
+            # unchanged copy has the digest of the source manifest
+            if config != manifest['config'] or \
+                    manifest.get('mediaType') != MEDIA_MANIFEST_V2:
+                manifest['config'] = config
+                manifest['mediaType'] = MEDIA_MANIFEST_V2
+                manifest_str = json.dumps(manifest, indent=3)
         else:
             if 'signatures' in manifest:
                 manifest_type = MEDIA_MANIFEST_V1_SIGNED
@@ -1218,33 +2143,99 @@ class PythonImageUploader(BaseImageUploader):
                 manifest_type,
                 config_str
             )
+            cls.inspect_cache.pop(target_url.geturl(), None)
             return
 
         if config_str is not None:
-            config_digest = manifest['config']['digest']
-            # Upload the config json as a blob
-            upload_url = cls._upload_url(
+            cls._copy_config_to_registry(
+                target_url, manifest['config']['digest'], config_str,
+                target_session)
+
+        image, tag = cls._image_tag_from_url(target_url)
+        cls._put_manifest(target_url, tag, manifest_str, manifest_type,
+                          target_session)
+
+    @classmethod
+    def _copy_platform_manifest_to_registry(cls, target_url, entry,
+                                            manifest_str, config_str,
+                                            session):
+        """Copy a manifest of a manifest list, referenced by its digest"""
+        if target_url.netloc in cls.export_registries:
+            image_export.export_manifest_config(
                 target_url,
-                session=target_session)
-            r = target_session.put(
-                upload_url,
-                timeout=30,
-                params={
-                    'digest': config_digest
-                },
-                data=config_str.encode('utf-8'),
-                headers={
-                    'Content-Length': str(len(config_str)),
-                    'Content-Type': 'application/octet-stream'
-                }
+                manifest_str,
+                entry['mediaType'],
+                config_str,
+                tagged=False
+            )
+            return
+
+        manifest = json.loads(manifest_str)
+        cls._copy_config_to_registry(
+            target_url, manifest['config']['digest'], config_str, session)
+        cls._put_manifest(target_url, entry['digest'], manifest_str,
+                          entry['mediaType'], session)
+
+    @classmethod
+    def _copy_manifest_list_entries_to_registry(cls, target_url,
+                                                manifest_list,
+                                                manifest_list_str, entries,
+                                                session):
+        """Push a manifest list which references the copied entries
+
+        The list is only changed, which changes its digest, when some
+        platforms were not selected.
+        """
+        if len(entries) < len(manifest_list['manifests']):
+            manifest_list = dict(manifest_list, manifests=entries)
+            manifest_list_str = json.dumps(manifest_list, indent=3)
+        if 'mediaType' in manifest_list:
+            manifest_type = manifest_list['mediaType']
+        else:
+            manifest_type = MEDIA_OCI_INDEX
+
+        if target_url.netloc in cls.export_registries:
+            image_export.export_manifest_config(
+                target_url,
+                manifest_list_str,
+                manifest_type,
+                None
             )
-            r.raise_for_status(),
+            cls.inspect_cache.pop(target_url.geturl(), None)
+            return
 
-        # Upload the manifest
+        image, tag = cls._image_tag_from_url(target_url)
+        cls._put_manifest(target_url, tag, manifest_list_str, manifest_type,
+                          session)
+
+    @classmethod
+    def _copy_config_to_registry(cls, target_url, config_digest, config_str,
+                                 session):
+        # Upload the config json as a blob
+        upload_url = cls._upload_url(
+            target_url,
+            session=session)
+        r = session.put(
+            upload_url,
+            timeout=30,
+            params={
+                'digest': config_digest
+            },
+            data=config_str.encode('utf-8'),
+            headers={
+                'Content-Length': str(len(config_str)),
+                'Content-Type': 'application/octet-stream'
+            }
+        )
+        r.raise_for_status()
+
+    @classmethod
+    def _put_manifest(cls, target_url, reference, manifest_str,
+                      manifest_type, session):
         image, tag = cls._image_tag_from_url(target_url)
         parts = {
             'image': image,
-            'tag': tag
+            'tag': reference
         }
         manifest_url = cls._build_url(
             target_url, CALL_MANIFEST % parts)
@@ -1252,7 +2243,7 @@ class PythonImageUploader(BaseImageUploader):
         LOG.debug('Uploading manifest of type %s to: %s' % (
             manifest_type, manifest_url))
 
-        r = target_session.put(
+        r = session.put(
             manifest_url,
             timeout=30,
             data=manifest_str.encode('utf-8'),
@@ -1262,8 +2253,13 @@ class PythonImageUploader(BaseImageUploader):
         )
         if r.status_code == 400:
             LOG.error(r.text)
+            if 'BLOB_UNKNOWN' in r.text:
+                # the registry lost blobs since they were found, check
+                # them again the next time
+                cls._forget_registry_blobs(target_url)
             raise ImageUploaderException('Pushing manifest failed')
         r.raise_for_status()
+        cls.inspect_cache.pop(target_url.geturl(), None)
 
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
@@ -1296,20 +2292,13 @@ class PythonImageUploader(BaseImageUploader):
     @classmethod
     def _target_layer_exists_registry(cls, target_url, layer, check_layers,
                                       session):
-        image, tag = cls._image_tag_from_url(target_url)
-        parts = {
-            'image': image,
-            'tag': tag
-        }
-        # Do a HEAD call for the supplied digests
-        # to see if the layer is already in the registry
+        # Check the supplied digests, in order of preference, to see if the
+        # layer is already in the registry
+        check_layers = [l for l in check_layers if l]
+        existing = cls._registry_blobs_exist(
+            target_url, [l['digest'] for l in check_layers], session)
         for l in check_layers:
-            if not l:
-                continue
-            parts['digest'] = l['digest']
-            blob_url = cls._build_url(
-                target_url, CALL_BLOB % parts)
-            if session.head(blob_url, timeout=30).status_code == 200:
+            if l['digest'] in existing:
                 LOG.debug('Layer already exists: %s' % l['digest'])
                 layer['digest'] = l['digest']
                 if 'size' in l:
@@ -1330,26 +2319,142 @@ class PythonImageUploader(BaseImageUploader):
         overlay_path = cls._containers_file_path(
             'overlay', layer_id, 'diff'
         )
-        cmd = [
-            'tar-split', 'asm',
-            '--input', tar_split_path,
-            '--path', overlay_path,
-            '--compress'
-        ]
-        LOG.debug(' '.join(cmd))
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        tar_stream = cls._tar_split_asm(tar_split_path, overlay_path)
+        try:
+            for data in cls._compress_stream(tar_stream):
+                calc_digest.update(data)
+                yield data
+        except (IOError, OSError, ValueError, KeyError) as e:
+            raise ImageUploaderException('Extracting layer failed: %s' % e)
+        finally:
+            # close the metadata and overlay files when the consumer stops
+            # early
+            tar_stream.close()
 
-        chunk_size = 2 ** 20
+    @classmethod
+    def _tar_split_asm(cls, tar_split_path, overlay_path):
+        """Reassemble the layer tar of a containers-storage layer
+
+        The tar-split metadata is a gzipped stream of json entries. Segment
+        entries hold the raw tar headers and padding, and file entries name
+        a file in overlay_path whose contents follow the header. This
+        produces the same tar as the tar-split asm command.
+        """
+        root = os.path.realpath(overlay_path)
+        with gzip.open(tar_split_path, 'rb') as metadata:
+            for line in metadata:
+                if not line.strip():
+                    continue
+                entry = json.loads(line.decode('utf-8'))
+                if entry['type'] == TAR_SPLIT_SEGMENT:
+                    if entry.get('payload'):
+                        yield base64.b64decode(entry['payload'])
+                    continue
+                size = entry.get('size', 0)
+                if entry['type'] != TAR_SPLIT_FILE or not size:
+                    continue
+                if 'name_raw' in entry:
+                    path = cls._tar_split_path(
+                        six.b(root), base64.b64decode(entry['name_raw']))
+                else:
+                    path = cls._tar_split_path(root, entry['name'])
+                with open(path, 'rb') as f:
+                    while size > 0:
+                        data = f.read(min(size, cls.chunk_size))
+                        if not data:
+                            raise ImageUploaderException(
+                                'Extracting layer failed, %s is shorter '
+                                'than its tar entry' % entry.get('name'))
+                        size -= len(data)
+                        yield data
 
-        while True:
-            data = p.stdout.read(chunk_size)
-            if not data:
-                break
-            calc_digest.update(data)
-            yield data
-        p.wait()
-        if p.returncode != 0:
-            raise ImageUploaderException('Extracting layer failed')
+    @classmethod
+    def _tar_split_path(cls, root, name):
+        """Return the path of a tar entry name in a layer diff directory
+
+        Like the tar-split asm command, absolute names are joined under root
+        rather than replacing it. Names which resolve to a path outside of
+        root are rejected, so a layer can not include other host files.
+        """
+        sep = six.b(os.sep) if isinstance(root, bytes) else os.sep
+        path = os.path.realpath(os.path.join(root, name.lstrip(sep)))
+        if not path.startswith(root.rstrip(sep) + sep):
+            raise ImageUploaderException(
+                'Extracting layer failed, %r is outside of the layer' % name)
+        return path
+
+    @classmethod
+    def _compress_stream(cls, stream):
+        """Gzip a stream of data into chunks of about chunk_size
+
+        With more than one layer_compress_workers, blocks of chunk_size are
+        deflated concurrently like pigz does. Each block ends with a sync
+        flush and can refer to the end of the previous block, so the
+        blocks join into one valid gzip stream.
+        """
+        level = cls.layer_compress_level
+        workers = cls.layer_compress_workers
+        if workers <= 1:
+            compressor = zlib.compressobj(
+                level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            for block in cls._stream_blocks(stream):
+                data = compressor.compress(block)
+                if data:
+                    yield data
+            yield compressor.flush()
+            return
+
+        executor = cls._compress_executor()
+        crc = 0
+        size = 0
+        previous = six.b('')
+        pending = collections.deque()
+        yield GZIP_HEADER
+        for block in cls._stream_blocks(stream):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            pending.append(executor.submit(
+                cls._deflate_block, level, block,
+                previous[-DEFLATE_WINDOW:]))
+            previous = block
+            # keep enough blocks queued for every worker, without reading
+            # far ahead of the upload
+            if len(pending) > workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+        yield DEFLATE_END + struct.pack(
+            '<II', crc & 0xffffffff, size & 0xffffffff)
+
+    @classmethod
+    def _stream_blocks(cls, stream):
+        """Regroup a stream of data into blocks of chunk_size"""
+        buf = []
+        buf_size = 0
+        for data in stream:
+            buf.append(data)
+            buf_size += len(data)
+            while buf_size >= cls.chunk_size:
+                data = six.b('').join(buf)
+                yield data[:cls.chunk_size]
+                buf = [data[cls.chunk_size:]]
+                buf_size = len(buf[0])
+        if buf_size:
+            yield six.b('').join(buf)
+
+    @classmethod
+    def _deflate_block(cls, level, block, window):
+        if window and six.PY3:
+            # python 2 can not preset the dictionary, which only costs
+            # some compression at the start of each block
+            compressor = zlib.compressobj(
+                level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                zlib.Z_DEFAULT_STRATEGY, zdict=window)
+        else:
+            compressor = zlib.compressobj(
+                level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(
+            zlib.Z_SYNC_FLUSH)
 
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
@@ -1363,16 +2468,36 @@ class PythonImageUploader(BaseImageUploader):
     def _copy_layer_local_to_registry(cls, target_url,
                                       session, layer, layer_entry):
 
-        # Do a HEAD call for the compressed-diff-digest and diff-digest
-        # to see if the layer is already in the registry
+        # Do a HEAD call for the known compressed layer, the
+        # compressed-diff-digest and diff-digest to see if the layer is
+        # already in the registry
         check_layers = []
         compressed_digest = layer_entry.get('compressed-diff-digest')
+        known = cls.diff_id_layers.get(
+            (target_url.netloc, layer_entry.get('diff-digest')))
+        if known:
+            # an unchanged layer of an image copied to this registry,
+            # which may have been compressed to a different digest
+            known_layer, known_url = known
+            cls._cross_repo_mount(
+                target_url, {known_layer['digest']: known_url},
+                [known_layer['digest']], session=session)
+            check_layers.append(dict(known_layer))
         if compressed_digest:
             check_layers.append({
                 'digest': compressed_digest,
                 'size': layer_entry.get('compressed-size'),
                 'mediaType': MEDIA_BLOB_COMPRESSED,
             })
+        if target_url.netloc in cls.export_registries:
+            for check_layer in check_layers:
+                stored = {
+                    'digest': check_layer['digest'],
+                    'mediaType': MEDIA_BLOB_COMPRESSED,
+                }
+                if image_export.export_existing(target_url, stored):
+                    layer.update(stored)
+                    return
 
         digest = layer_entry.get('diff-digest')
         if digest:
@@ -1389,10 +2514,108 @@ class PythonImageUploader(BaseImageUploader):
         LOG.debug('Uploading layer: %s' % layer_id)
 
         calc_digest = hashlib.sha256()
-        layer_stream = cls._layer_stream_local(layer_id, calc_digest)
+        if compressed_digest and image_cache.blob_exists(compressed_digest):
+            # The layer was pulled as a blob which is still cached, so it
+            # does not need to be reassembled and compressed again
+            layer['digest'] = compressed_digest
+            if target_url.netloc in cls.export_registries:
+                blob_path = image_cache.blob_file(compressed_digest)
+                if blob_path:
+                    layer['mediaType'] = MEDIA_BLOB_COMPRESSED
+                    return image_export.export_file(
+                        target_url, layer, blob_path)
+            layer['size'] = layer_entry.get('compressed-size')
+            layer_stream = image_cache.blob_stream(
+                compressed_digest, calc_digest, cls.chunk_size)
+        else:
+            layer_stream = cls._layer_stream_local(layer_id, calc_digest)
         return cls._copy_stream_to_registry(target_url, layer, calc_digest,
                                             layer_stream, session)
 
+    @classmethod
+    def _upload_chunk(cls, upload_url, chunk, offset, session):
+        chunk_length = len(chunk)
+        cls._throttle(upload_url, RATE_LIMIT_BYTES, chunk_length)
+        started = time.time()
+        r = session.patch(
+            upload_url,
+            timeout=30,
+            data=chunk,
+            headers={
+                'Content-Length': str(chunk_length),
+                'Content-Range': '%d-%d' % (
+                    offset, offset + chunk_length - 1),
+                'Content-Type': 'application/octet-stream'
+            }
+        )
+        r.raise_for_status()
+        image_metrics.transfer(parse.urlparse(upload_url).netloc, 'push',
+                               chunk_length, time.time() - started)
+        return r
+
+    @classmethod
+    @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        reraise=True,
+        retry=tenacity.retry_if_exception(
+            lambda e: isinstance(e, requests.exceptions.RequestException) and
+            not isinstance(e, UploadResumeException)
+        ),
+        wait=tenacity.wait_random_exponential(multiplier=1, max=10),
+        stop=tenacity.stop_after_attempt(5)
+    )
+    def _resume_upload_chunk(cls, upload_url, chunk, offset, session):
+        # Ask the upload session how much it has received, then upload the
+        # remainder of the chunk from there
+        r = session.get(upload_url, timeout=30)
+        r.raise_for_status()
+        upload_url = r.headers.get('Location', upload_url)
+        received = 0
+        upload_range = r.headers.get('Range')
+        if upload_range:
+            end = int(upload_range.split('-')[-1])
+            if end:
+                received = end + 1
+
+        chunk_length = len(chunk)
+        if received < offset or received > offset + chunk_length:
+            # not retried here, the layer copy restarts the whole layer
+            raise UploadResumeException(
+                'Can not resume upload at offset %s, received %s' %
+                (offset, received))
+        LOG.debug('Resuming upload at offset %s' % received)
+        if received == offset + chunk_length:
+            return r
+        return cls._upload_chunk(
+            upload_url, chunk[received - offset:], received, session)
+
+    @classmethod
+    def _copy_data_to_registry(cls, target_url, layer, calc_digest, data,
+                               session):
+        layer_digest = 'sha256:%s' % calc_digest.hexdigest()
+        LOG.debug('Calculated layer digest: %s' % layer_digest)
+        upload_url = cls._upload_url(target_url, session)
+        cls._throttle(upload_url, RATE_LIMIT_BYTES, len(data))
+        started = time.time()
+        upload_resp = session.put(
+            upload_url,
+            timeout=30,
+            params={
+                'digest': layer_digest
+            },
+            data=data,
+            headers={
+                'Content-Length': str(len(data)),
+                'Content-Type': 'application/octet-stream'
+            }
+        )
+        upload_resp.raise_for_status()
+        image_metrics.transfer(parse.urlparse(upload_url).netloc, 'push',
+                               len(data), time.time() - started)
+        cls._registry_blob_added(target_url, layer_digest)
+        layer['digest'] = layer_digest
+        layer['size'] = len(data)
+        return layer_digest
+
     @classmethod
     def _copy_stream_to_registry(cls, target_url, layer, calc_digest,
                                  layer_stream, session):
@@ -1403,28 +2626,39 @@ class PythonImageUploader(BaseImageUploader):
         export = target_url.netloc in cls.export_registries
         if export:
             return image_export.export_stream(
-                target_url, layer, layer_stream)
+                target_url, layer, layer_stream, calc_digest)
+
+        if layer.get('size') and layer['size'] <= cls.monolithic_upload_size:
+            # Small blobs are read into memory and uploaded with a single
+            # PUT, unless they turn out to be larger than the manifest said
+            data = []
+            for chunk in layer_stream:
+                data.append(chunk)
+                length += len(chunk)
+                if length > cls.monolithic_upload_size:
+                    break
+            else:
+                return cls._copy_data_to_registry(
+                    target_url, layer, calc_digest, six.b('').join(data),
+                    session)
+            layer_stream = itertools.chain(data, layer_stream)
+            length = 0
 
         for chunk in layer_stream:
             if not chunk:
                 break
 
-            chunk_length = len(chunk)
             upload_url = cls._upload_url(
                 target_url, session, upload_resp)
-            upload_resp = session.patch(
-                upload_url,
-                timeout=30,
-                data=chunk,
-                headers={
-                    'Content-Length': str(chunk_length),
-                    'Content-Range': '%d-%d' % (
-                        length, length + chunk_length - 1),
-                    'Content-Type': 'application/octet-stream'
-                }
-            )
-            upload_resp.raise_for_status()
-            length += chunk_length
+            try:
+                upload_resp = cls._upload_chunk(
+                    upload_url, chunk, length, session)
+            except requests.exceptions.RequestException as e:
+                LOG.warning('Uploading chunk at offset %s failed, '
+                            'resuming: %s' % (length, e))
+                upload_resp = cls._resume_upload_chunk(
+                    upload_url, chunk, length, session)
+            length += len(chunk)
 
         layer_digest = 'sha256:%s' % calc_digest.hexdigest()
         LOG.debug('Calculated layer digest: %s' % layer_digest)
@@ -1438,6 +2672,7 @@ class PythonImageUploader(BaseImageUploader):
             },
         )
         upload_resp.raise_for_status()
+        cls._registry_blob_added(target_url, layer_digest)
         layer['digest'] = layer_digest
         layer['size'] = length
         return layer_digest
@@ -1457,17 +2692,11 @@ class PythonImageUploader(BaseImageUploader):
 
         name = '%s%s' % (source_url.netloc, source_url.path)
         image, manifest, config_str = cls._image_manifest_config(name)
-        all_layers = cls._containers_json('overlay-layers', 'layers.json')
-        layers_by_digest = {}
-        for l in all_layers:
-            if 'diff-digest' in l:
-                layers_by_digest[l['diff-digest']] = l
-            if 'compressed-diff-digest' in l:
-                layers_by_digest[l['compressed-diff-digest']] = l
+        layers_by_digest = cls._containers_layers()
 
         # Upload all layers
         copy_jobs = []
-        p = futures.ThreadPoolExecutor(max_workers=4)
+        p = cls._layer_executor()
         for layer in manifest['layers']:
             layer_entry = layers_by_digest[layer['digest']]
 
@@ -1512,17 +2741,68 @@ class PythonImageUploader(BaseImageUploader):
     def _containers_json(cls, *path):
         return json.loads(cls._containers_file(*path))
 
+    @classmethod
+    def _containers_changed(cls):
+        """Discard every containers-storage index"""
+        with cls.containers_index_lock:
+            cls.containers_index.clear()
+
+    @classmethod
+    def _containers_file_signature(cls, *path):
+        # containers-storage replaces its metadata files with a rename, so
+        # the inode changes even when the mtime does not
+        st = os.stat(cls._containers_file_path(*path))
+        return st.st_ino, st.st_size, st.st_mtime
+
+    @classmethod
+    def _containers_index(cls, build_index, *path):
+        """Return the index of a containers-storage json file
+
+        The index is built by build_index from the parsed file, and only
+        built again when the file has changed since.
+        """
+        signature = cls._containers_file_signature(*path)
+        with cls.containers_index_lock:
+            cached = cls.containers_index.get(path)
+            if cached and cached[0] == signature:
+                return cached[1]
+            index = build_index(cls._containers_json(*path))
+            cls.containers_index[path] = (signature, index)
+            return index
+
+    @classmethod
+    def _containers_images(cls):
+        """Return containers-storage images indexed by name"""
+        def build_index(all_images):
+            images = {}
+            for i in all_images:
+                for n in i.get('names', []):
+                    images.setdefault(n, i)
+            return images
+        return cls._containers_index(
+            build_index, 'overlay-images', 'images.json')
+
+    @classmethod
+    def _containers_layers(cls):
+        """Return containers-storage layers indexed by digest
+
+        Each layer is indexed by both its diff-digest and its
+        compressed-diff-digest.
+        """
+        def build_index(all_layers):
+            layers = {}
+            for l in all_layers:
+                if 'diff-digest' in l:
+                    layers[l['diff-digest']] = l
+                if 'compressed-diff-digest' in l:
+                    layers[l['compressed-diff-digest']] = l
+            return layers
+        return cls._containers_index(
+            build_index, 'overlay-layers', 'layers.json')
+
     @classmethod
     def _image_manifest_config(cls, name):
-        image = None
-        images = cls._containers_json('overlay-images', 'images.json')
-        for i in images:
-            for n in i.get('names', []):
-                if name == n:
-                    image = i
-                    break
-            if image:
-                break
+        image = cls._containers_images().get(name)
         if not image:
             raise ImageNotFoundException('Not found image: %s' % name)
         image_id = image['id']
@@ -1536,10 +2816,10 @@ class PythonImageUploader(BaseImageUploader):
         return image, manifest, config_str
 
     @classmethod
-    def _inspect(cls, image_url, session=None):
+    def _inspect(cls, image_url, session=None, tags=True):
         if image_url.scheme == 'docker':
             return super(PythonImageUploader, cls)._inspect(
-                image_url, session=session)
+                image_url, session=session, tags=tags)
         if image_url.scheme != 'containers-storage':
             raise ImageUploaderException('Inspect not implemented for %s' %
                                          image_url.geturl())
@@ -1597,23 +2877,141 @@ class PythonImageUploader(BaseImageUploader):
             image_url = parse.urlparse('containers-storage:%s' % image)
             self._delete(image_url)
 
+    def sync_tasks(self):
+        """Remove the upload tasks of images which are already in sync
+
+        The source and target manifest digests of every image are compared
+        with concurrent HEAD calls, and only images which differ are kept.
+        Modified images are always kept, since they are skipped later when
+        the modified image exists. For dry runs, the layers and bytes the
+        remaining images would copy are logged and returned.
+        """
+        def check(args):
+            uploader, task = args
+            if task.modify_role:
+                return True
+            return not self._image_in_sync(
+                task.source_image_url, task.target_image_url,
+                self.authenticate(task.source_image_url),
+                self.authenticate(task.target_image_url))
+
+        tasks = self.upload_tasks
+        workers = min(16, len(tasks))
+        with futures.ThreadPoolExecutor(max_workers=workers) as p:
+            changed = list(p.map(check, tasks))
+        self.upload_tasks = [t for t, c in zip(tasks, changed) if c]
+        LOG.warning('%d of %d images are already in sync' % (
+            len(tasks) - len(self.upload_tasks), len(tasks)))
+
+        summary = {
+            'images': len(self.upload_tasks),
+            'layers': 0,
+            'bytes': 0
+        }
+        dry_run_tasks = [t for u, t in self.upload_tasks
+                         if t.dry_run and not t.modify_role]
+        if not dry_run_tasks:
+            return summary
+
+        def missing_layers(task):
+            manifest = json.loads(self._fetch_manifest(
+                task.source_image_url,
+                session=self.authenticate(task.source_image_url)))
+            layers = dict((l['digest'], l.get('size', 0))
+                          for l in manifest.get('layers', []))
+            existing = self._registry_blobs_exist(
+                task.target_image_url, list(layers),
+                self.authenticate(task.target_image_url))
+            return [(task.target_image_url.netloc, digest, size)
+                    for digest, size in layers.items()
+                    if digest not in existing]
+
+        workers = min(16, len(dry_run_tasks))
+        with futures.ThreadPoolExecutor(max_workers=workers) as p:
+            missing = set(itertools.chain.from_iterable(
+                p.map(missing_layers, dry_run_tasks)))
+        summary['layers'] = len(missing)
+        summary['bytes'] = sum(size for netloc, digest, size in missing)
+        LOG.warning('Sync would copy %(images)d images, %(layers)d layers, '
+                    '%(bytes)d bytes' % summary)
+        return summary
+
+    def _modify_executor(self):
+        """Return an executor and stage semaphores for modified images
+
+        The executor has enough workers for every stage to be busy, with
+        the stage semaphores limiting the concurrency of each stage.
+        """
+        stages = {
+            'pull': threading.BoundedSemaphore(self.modify_pull_workers),
+            'modify': threading.BoundedSemaphore(self.modify_workers),
+            'push': threading.BoundedSemaphore(self.modify_push_workers),
+        }
+        executor = futures.ThreadPoolExecutor(
+            max_workers=(self.modify_pull_workers + self.modify_workers +
+                         self.modify_push_workers))
+        return executor, stages
+
+    @classmethod
+    def _image_in_sync(cls, source_url, target_url, source_session,
+                       target_session):
+        """Return whether the target has the manifest of the source
+
+        When only some platforms of a manifest list are copied, the list
+        pushed to the target has a different digest, so the digests of
+        the selected platform manifests are compared instead.
+        """
+        multi_arch = bool(cls.platforms)
+        source_digest = cls._fetch_manifest_digest(
+            source_url, source_session, multi_arch=multi_arch)
+        if not source_digest:
+            return False
+        target_digest = cls._fetch_manifest_digest(
+            target_url, target_session, multi_arch=multi_arch)
+        if source_digest == target_digest:
+            return True
+        if not multi_arch or not target_digest:
+            return False
+
+        source_manifest = json.loads(cls._fetch_manifest(
+            source_url, session=source_session, multi_arch=True))
+        if not cls._is_manifest_list(source_manifest):
+            return False
+        try:
+            target_manifest = json.loads(cls._fetch_manifest(
+                target_url, session=target_session, multi_arch=True))
+        except ImageNotFoundException:
+            return False
+        selected = set(e['digest']
+                       for e in cls._select_platforms(source_manifest))
+        copied = set(e['digest']
+                     for e in target_manifest.get('manifests', []))
+        return selected == copied
+
     def run_tasks(self):
+        self.init_run_cache()
+        if self.sync:
+            self.sync_tasks()
         if not self.upload_tasks:
             return
         local_images = []
 
-        # Pull a single image first, to avoid duplicate pulls of the
-        # same base layers
-        uploader, first_task = self.upload_tasks.pop()
-        result = uploader.upload_image(first_task)
-        local_images.extend(result)
-
-        # workers will be half the CPU count, to a minimum of 2
+        # workers will be half the CPU count, to a minimum of 2. Layers
+        # shared between images are only copied once by the layer scheduler
+        # so images do not need to be serialized to avoid duplicate pulls
         workers = max(2, processutils.get_worker_count() // 2)
         p = futures.ThreadPoolExecutor(max_workers=workers)
+        modify_p, stages = self._modify_executor()
 
-        for result in p.map(upload_task, self.upload_tasks):
-            local_images.extend(result)
+        jobs = []
+        for uploader, task in self.upload_tasks:
+            if task.modify_role and not task.dry_run:
+                jobs.append(modify_p.submit(
+                    upload_task, (uploader, task), stages))
+            else:
+                jobs.append(p.submit(upload_task, (uploader, task)))
+        for job in jobs:
+            local_images.extend(job.result())
         LOG.info('result %s' % local_images)
 
         # Do cleanup after all the uploads so common layers don't get deleted
@@ -1621,6 +3019,67 @@ class PythonImageUploader(BaseImageUploader):
         self.cleanup(local_images)
 
 
+class TokenBucket(object):
+    """Limit the rate of an activity shared between threads
+
+    Up to one second of the rate is allowed as a burst. Consuming more than
+    is available waits for the tokens to be replenished, so the average
+    rate is kept for amounts larger than the bucket too.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount=1):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimitedAdapter(requests_adapters.HTTPAdapter):
+    """HTTP adapter which applies an uploader's requests per second limit
+
+    The latency of every request is also recorded in the image metrics.
+    """
+
+    def __init__(self, uploader, **kwargs):
+        self.uploader = uploader
+        super(RateLimitedAdapter, self).__init__(**kwargs)
+
+    def grow_pool(self, maxsize):
+        """Replace the connection pools when maxsize is larger
+
+        Requests in progress finish with the connections of the old pools.
+        """
+        if maxsize > self._pool_maxsize:
+            self.init_poolmanager(self._pool_connections, maxsize,
+                                  block=self._pool_block)
+
+    def send(self, request, **kwargs):
+        self.uploader._throttle(request.url, RATE_LIMIT_REQUESTS)
+        url = parse.urlparse(request.url)
+        kind = image_metrics.request_kind(url.path)
+        started = time.time()
+        try:
+            r = super(RateLimitedAdapter, self).send(request, **kwargs)
+        except requests.exceptions.RequestException:
+            image_metrics.request(url.netloc, request.method, kind, 0,
+                                  error=True)
+            raise
+        image_metrics.request(url.netloc, request.method, kind,
+                              time.time() - started)
+        return r
+
+
 class UploadTask(object):
 
     def __init__(self, image_name, pull_source, push_destination,
@@ -1660,16 +3119,29 @@ class UploadTask(object):
             self.target_image_source_tag)
 
 
-def upload_task(args):
+def upload_task(args, stages=None):
     uploader, task = args
-    return uploader.upload_image(task)
+    if task.dry_run:
+        return uploader.upload_image(task)
+    with image_metrics.image_timer(task.image_name):
+        if stages:
+            return uploader.upload_image(task, stages)
+        return uploader.upload_image(task)
+
+
+@contextlib.contextmanager
+def pipeline_stage(stages, stage):
+    if not stages:
+        yield
+        return
+    with stages[stage]:
+        yield
 
 
 def discover_tag_from_inspect(args):
     image, tag_from_label = args
     image_url = BaseImageUploader._image_to_url(image)
     session = BaseImageUploader.authenticate(image_url)
-    i = BaseImageUploader._inspect(image_url, session=session)
     if ':' in image_url.path:
         # break out the tag from the url to be the fallback tag
         path = image.rpartition(':')
@@ -1677,5 +3149,5 @@ def discover_tag_from_inspect(args):
         image = path[0]
     else:
         fallback_tag = None
-    return image, BaseImageUploader._discover_tag_from_inspect(
-        i, image, tag_from_label, fallback_tag)
+    return image, BaseImageUploader._discover_tag(
+        image_url, image, tag_from_label, fallback_tag, session=session)
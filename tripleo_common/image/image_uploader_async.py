@@ -0,0 +1,274 @@
+#   Copyright 2019 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+# This module uses asyncio syntax so it is only imported on python 3
+
+import asyncio
+from concurrent import futures
+import functools
+import json
+import requests
+
+from oslo_concurrency import processutils
+from oslo_log import log as logging
+from tripleo_common.image import image_metrics
+from tripleo_common.image import image_uploader
+
+
+LOG = logging.getLogger(__name__)
+
+
+class RequestScheduler(object):
+    """Run blocking registry calls for coroutines on one event loop
+
+    Calls run on a single bounded executor, and at most host_connections
+    calls run concurrently against any one registry host. Coroutines
+    waiting for a host do not hold a thread, so any number of calls can be
+    queued without creating more threads.
+    """
+
+    def __init__(self, loop, workers, host_connections):
+        self.loop = loop
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self.host_connections = host_connections
+        self.semaphores = {}
+        # Layer copies keyed by (target registry, digest)
+        self.layer_tasks = {}
+
+    def semaphore(self, host):
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.host_connections)
+        return self.semaphores[host]
+
+    async def call(self, hosts, func, *args, **kwargs):
+        # host limits are acquired in a fixed order so calls which use
+        # several hosts can not deadlock each other
+        acquired = []
+        try:
+            for host in sorted(set(hosts)):
+                semaphore = self.semaphore(host)
+                await semaphore.acquire()
+                acquired.append(semaphore)
+            return await self.loop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs))
+        finally:
+            for semaphore in acquired:
+                semaphore.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class AsyncPythonImageUploader(image_uploader.PythonImageUploader):
+    """Upload images with coroutines on a single asyncio event loop
+
+    Every image, layer and tag discovery is a coroutine, and the registry
+    calls of PythonImageUploader are run by a RequestScheduler instead of
+    a thread pool per image. Layers are still streamed from the source
+    registry to the target by one call, so a slow upload slows the
+    download of the same layer rather than buffering it.
+    """
+
+    # Total concurrent registry calls, and concurrent calls per registry
+    request_workers = max(16, processutils.get_worker_count() * 2)
+    host_connections = 8
+
+    def _run(self, coro_func, *args):
+        loop = asyncio.new_event_loop()
+        scheduler = RequestScheduler(
+            loop, self.request_workers, self.host_connections)
+        try:
+            return loop.run_until_complete(coro_func(scheduler, *args))
+        finally:
+            scheduler.shutdown()
+            loop.close()
+
+    def discover_image_tags(self, images, tag_from_label=None):
+        image_urls = [self._image_to_url(i) for i in images]
+
+        # prime self.insecure_registries by testing every image
+        self.prime_insecure_registries(url.netloc for url in image_urls)
+        return self._run(self._discover_image_tags, images, image_urls,
+                         tag_from_label)
+
+    async def _discover_image_tags(self, scheduler, images, image_urls,
+                                   tag_from_label):
+        versioned_images = await asyncio.gather(*[
+            scheduler.call([url.netloc],
+                           image_uploader.discover_tag_from_inspect,
+                           (image, tag_from_label))
+            for image, url in zip(images, image_urls)
+        ])
+        return dict(versioned_images)
+
+    def run_tasks(self):
+        self.init_run_cache()
+        if self.sync:
+            self.sync_tasks()
+        if not self.upload_tasks:
+            return
+        modify_p, stages = self._modify_executor()
+        try:
+            local_images = self._run(self._upload_images, modify_p, stages)
+        finally:
+            modify_p.shutdown(wait=True)
+        LOG.info('result %s' % local_images)
+
+        # Do cleanup after all the uploads so common layers don't get deleted
+        # repeatedly
+        self.cleanup(local_images)
+
+    async def _upload_images(self, scheduler, modify_p, stages):
+        results = await asyncio.gather(*[
+            self._upload_image(scheduler, task, modify_p, stages)
+            for uploader, task in self.upload_tasks
+        ])
+        local_images = []
+        for result in results:
+            local_images.extend(result)
+        return local_images
+
+    async def _upload_image(self, scheduler, task, modify_p, stages):
+        t = task
+        if t.dry_run or t.modify_role:
+            # modified images are built with buildah, which does not
+            # belong on the event loop or the request executor. They are
+            # limited by the same stages as in PythonImageUploader
+            return await scheduler.loop.run_in_executor(
+                modify_p, image_uploader.upload_task, (self, t), stages)
+
+        LOG.info('imagename: %s' % t.image_name)
+        with image_metrics.image_timer(t.image_name):
+            await self._copy_image_async(scheduler, t)
+        LOG.warning('Completed upload for image %s' % t.image_name)
+        return []
+
+    async def _copy_image_async(self, scheduler, t):
+        attempt = 0
+        while True:
+            try:
+                await self._copy_registry_to_registry_async(
+                    scheduler, t.source_image_url, t.target_image_url)
+                break
+            except requests.exceptions.RequestException as e:
+                attempt += 1
+                if attempt >= 5:
+                    raise
+                LOG.warning('Upload for image %s failed, retrying: %s' %
+                            (t.image_name, e))
+                await asyncio.sleep(min(10, 2 ** attempt))
+
+    async def _copy_registry_to_registry_async(self, scheduler, source_url,
+                                               target_url):
+        self._assert_scheme(source_url, 'docker')
+        self._assert_scheme(target_url, 'docker')
+        source_host = source_url.netloc
+        target_host = target_url.netloc
+
+        target_session = await scheduler.call(
+            [target_host], self.authenticate, target_url)
+        await scheduler.call(
+            [target_host], self._detect_target_export, target_url,
+            target_session)
+        source_session = await scheduler.call(
+            [source_host], self.authenticate, source_url)
+        manifest_str = await scheduler.call(
+            [source_host], self._fetch_manifest, source_url,
+            session=source_session, multi_arch=bool(self.platforms))
+
+        manifest = json.loads(manifest_str)
+        if self._is_manifest_list(manifest):
+            # every platform is copied at once, then the list is pushed
+            # when all the manifests it references exist
+            entries = self._select_platforms(manifest)
+            await asyncio.gather(*[
+                self._copy_platform_async(
+                    scheduler, source_url, target_url, entry,
+                    source_session, target_session)
+                for entry in entries
+            ])
+            await scheduler.call(
+                [target_host], self._copy_manifest_list_entries_to_registry,
+                target_url, manifest, manifest_str, entries, target_session)
+            return
+
+        config_str = await self._copy_layers_async(
+            scheduler, source_url, target_url, manifest, source_session,
+            target_session)
+        await scheduler.call(
+            [target_host], self._copy_manifest_config_to_registry,
+            target_url=target_url,
+            manifest_str=manifest_str,
+            config_str=config_str,
+            target_session=target_session)
+
+    async def _copy_platform_async(self, scheduler, source_url, target_url,
+                                   entry, source_session, target_session):
+        manifest_str = await scheduler.call(
+            [source_url.netloc], self._fetch_platform_manifest, source_url,
+            entry, source_session)
+        config_str = await self._copy_layers_async(
+            scheduler, source_url, target_url, json.loads(manifest_str),
+            source_session, target_session)
+        await scheduler.call(
+            [target_url.netloc], self._copy_platform_manifest_to_registry,
+            target_url, entry, manifest_str, config_str, target_session)
+
+    async def _copy_layers_async(self, scheduler, source_url, target_url,
+                                 manifest, source_session, target_session):
+        """Copy the config and layers of a manifest, returning the config"""
+        source_host = source_url.netloc
+        target_host = target_url.netloc
+        layers, config_digest = self._manifest_layers(manifest)
+        config_str = None
+        if config_digest:
+            config_str = await scheduler.call(
+                [source_host], self._fetch_config, source_url,
+                config_digest, source_session)
+
+        await asyncio.gather(*[
+            scheduler.call([target_host], self._registry_blob_exists,
+                           target_url, digest, target_session)
+            for digest in self._unknown_layers(target_url, layers)
+        ])
+
+        copies = [
+            self._schedule_layer_copy_async(
+                scheduler, source_url, target_url, layer)
+            for layer in layers
+        ]
+        await asyncio.gather(*[copy for copy, copy_target_url in copies])
+
+        for digest, copy_target_url in self._layer_mounts(
+                target_url, layers, [u for c, u in copies]):
+            await scheduler.call(
+                [target_host], self._cross_repo_mount, target_url,
+                {digest: copy_target_url}, [digest],
+                session=target_session)
+        self._record_diff_ids(target_url, layers, config_str)
+        return config_str
+
+    def _schedule_layer_copy_async(self, scheduler, source_url, target_url,
+                                   layer):
+        """Schedule a registry to registry layer copy on the event loop"""
+        def submit():
+            return scheduler.loop.create_task(scheduler.call(
+                [source_url.netloc, target_url.netloc],
+                self._copy_layer_registry_to_registry,
+                source_url, target_url,
+                layer=layer
+            ))
+        return self._schedule_layer_job(
+            scheduler.layer_tasks, target_url, layer, submit)
@@ -121,7 +121,8 @@ def set_neutron_driver(pd, mapping_args):
 
 
 def container_images_prepare_multi(environment, roles_data, dry_run=False,
-                                   cleanup=image_uploader.CLEANUP_FULL):
+                                   cleanup=image_uploader.CLEANUP_FULL,
+                                   sync=False):
     """Perform multiple container image prepares and merge result
 
     Given the full heat environment and roles data, perform multiple image
@@ -132,6 +133,7 @@ def container_images_prepare_multi(environment, roles_data, dry_run=False,
 
     :param environment: Heat environment for deployment
     :param roles_data: Roles file data used to filter services
+    :param sync: only upload images whose manifest differs from the target
     :returns: dict containing merged container image parameters from all
               prepare operations
     """
@@ -181,7 +183,9 @@ def container_images_prepare_multi(environment, roles_data, dry_run=False,
             modify_role=modify_role,
             modify_vars=modify_vars,
             modify_only_with_labels=modify_only_with_labels,
-            mirrors=mirrors
+            mirrors=mirrors,
+            rate_limit_bytes=cip_entry.get('rate_limit_bytes'),
+            rate_limit_requests=cip_entry.get('rate_limit_requests')
         )
         env_params.update(prepare_data['image_params'])
 
@@ -194,7 +198,13 @@ def container_images_prepare_multi(environment, roles_data, dry_run=False,
                     [f.name],
                     dry_run=dry_run,
                     cleanup=cleanup,
-                    mirrors=mirrors
+                    mirrors=mirrors,
+                    rate_limit_bytes=cip_entry.get('rate_limit_bytes'),
+                    rate_limit_requests=cip_entry.get('rate_limit_requests'),
+                    compress_level=cip_entry.get('modify_compress_level'),
+                    compress_workers=cip_entry.get('modify_compress_workers'),
+                    sync=sync,
+                    platforms=cip_entry.get('platforms')
                 )
                 uploader.upload()
     return env_params
@@ -217,7 +227,8 @@ def container_images_prepare(template_file=DEFAULT_TEMPLATE_FILE,
                              output_images_file=None, tag_from_label=None,
                              append_tag=None, modify_role=None,
                              modify_vars=None, modify_only_with_labels=None,
-                             mirrors=None):
+                             mirrors=None, rate_limit_bytes=None,
+                             rate_limit_requests=None):
     """Perform container image preparation
 
     :param template_file: path to Jinja2 file containing all image entries
@@ -244,6 +255,10 @@ def container_images_prepare(template_file=DEFAULT_TEMPLATE_FILE,
     :param modify_only_with_labels: only modify the container images with the
                                     given labels
     :param mirrors: dict of registry netloc values to mirror urls
+    :param rate_limit_bytes: bytes per second limit for each registry host
+                             during tag discovery and label filtering
+    :param rate_limit_requests: requests per second limit for each registry
+                                host during tag discovery and label filtering
     :returns: dict with entries for the supplied output_env_file or
               output_images_file
     """
@@ -273,9 +288,15 @@ def container_images_prepare(template_file=DEFAULT_TEMPLATE_FILE,
     result = builder.container_images_from_template(
         filter=ffunc, **mapping_args)
 
-    manager = image_uploader.ImageUploadManager(mirrors=mirrors)
+    manager = image_uploader.ImageUploadManager(
+        mirrors=mirrors,
+        rate_limit_bytes=rate_limit_bytes,
+        rate_limit_requests=rate_limit_requests
+    )
     uploader = manager.uploader('docker')
     images = [i.get('imagename', '') for i in result]
+    if tag_from_label or modify_only_with_labels:
+        manager.init_uploaders()
 
     if tag_from_label:
         image_version_tags = uploader.discover_image_tags(
@@ -343,8 +364,9 @@ def detect_insecure_registries(params):
     """
     insecure = set()
     uploader = image_uploader.ImageUploadManager().uploader('docker')
-    for image in params.values():
-        host = image.split('/')[0]
+    hosts = set(image.split('/')[0] for image in params.values())
+    uploader.prime_insecure_registries(hosts)
+    for host in hosts:
         if uploader.is_insecure_registry(host):
             insecure.add(host)
     if not insecure:
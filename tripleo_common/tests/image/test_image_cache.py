@@ -0,0 +1,161 @@
+#   Copyright 2019 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import hashlib
+import os
+import shutil
+import six
+import tempfile
+
+from tripleo_common.image import image_cache
+from tripleo_common.tests import base
+
+
+def digest_stream(data, calc_digest):
+    for chunk in data:
+        calc_digest.update(chunk)
+        yield chunk
+
+
+class TestImageCache(base.TestCase):
+    def setUp(self):
+        super(TestImageCache, self).setUp()
+        cache_dir = image_cache.CACHE_DIR
+        temp_cache_dir = tempfile.mkdtemp()
+
+        def restore_cache_dir():
+            shutil.rmtree(temp_cache_dir)
+            image_cache.CACHE_DIR = cache_dir
+
+        image_cache.CACHE_DIR = temp_cache_dir
+        self.addCleanup(restore_cache_dir)
+
+        self.blob_data = [six.b('The '), six.b('Blob')]
+        calc_digest = hashlib.sha256()
+        calc_digest.update(six.b('The Blob'))
+        self.blob_digest = 'sha256:' + calc_digest.hexdigest()
+
+    def test_cache_dir(self):
+        self.assertEqual(
+            os.path.join(image_cache.CACHE_DIR, 'blobs'),
+            image_cache.cache_dir('blobs')
+        )
+        self.assertTrue(os.path.isdir(image_cache.cache_dir('blobs')))
+
+        image_cache.CACHE_DIR = None
+        self.assertIsNone(image_cache.cache_dir('blobs'))
+        self.assertIsNone(image_cache.blob_path(self.blob_digest))
+        self.assertFalse(image_cache.blob_exists(self.blob_digest))
+
+    def test_cache_stream(self):
+        self.assertFalse(image_cache.blob_exists(self.blob_digest))
+
+        calc_digest = hashlib.sha256()
+        layer_stream = image_cache.cache_stream(
+            self.blob_digest,
+            digest_stream(self.blob_data, calc_digest),
+            calc_digest
+        )
+        self.assertEqual(self.blob_data, list(layer_stream))
+        self.assertTrue(image_cache.blob_exists(self.blob_digest))
+        self.assertEqual(
+            [self.blob_digest],
+            os.listdir(image_cache.cache_dir('blobs'))
+        )
+        # readable by the web server when linked into image-serve
+        self.assertEqual(
+            0o644,
+            os.stat(image_cache.blob_path(self.blob_digest)).st_mode & 0o777
+        )
+
+        calc_digest = hashlib.sha256()
+        self.assertEqual(
+            six.b('The Blob'),
+            six.b('').join(image_cache.blob_stream(
+                self.blob_digest, calc_digest))
+        )
+        self.assertEqual(self.blob_digest,
+                         'sha256:' + calc_digest.hexdigest())
+
+    def test_cache_stream_wrong_digest(self):
+        calc_digest = hashlib.sha256()
+        layer_stream = image_cache.cache_stream(
+            'sha256:1234',
+            digest_stream(self.blob_data, calc_digest),
+            calc_digest
+        )
+        self.assertEqual(self.blob_data, list(layer_stream))
+        self.assertFalse(image_cache.blob_exists('sha256:1234'))
+        self.assertEqual([], os.listdir(image_cache.cache_dir('blobs')))
+
+    def test_cache_stream_incomplete(self):
+        calc_digest = hashlib.sha256()
+        layer_stream = image_cache.cache_stream(
+            self.blob_digest,
+            digest_stream(self.blob_data, calc_digest),
+            calc_digest
+        )
+        next(layer_stream)
+        layer_stream.close()
+        self.assertFalse(image_cache.blob_exists(self.blob_digest))
+        self.assertEqual([], os.listdir(image_cache.cache_dir('blobs')))
+
+    def test_cache_stream_disabled(self):
+        image_cache.CACHE_DIR = None
+        calc_digest = hashlib.sha256()
+        layer_stream = image_cache.cache_stream(
+            self.blob_digest,
+            digest_stream(self.blob_data, calc_digest),
+            calc_digest
+        )
+        self.assertEqual(self.blob_data, list(layer_stream))
+
+    def test_evict(self):
+        blob_dir = image_cache.cache_dir('blobs')
+        for i, digest in enumerate(('sha256:aaaa', 'sha256:bbbb',
+                                    'sha256:cccc')):
+            path = os.path.join(blob_dir, digest)
+            with open(path, 'wb') as f:
+                f.write(six.b('1234'))
+            os.utime(path, (i, i))
+
+        image_cache.evict(max_size=8)
+        self.assertEqual(
+            ['sha256:bbbb', 'sha256:cccc'],
+            sorted(os.listdir(blob_dir))
+        )
+
+        image_cache.evict(max_size=0)
+        self.assertEqual([], os.listdir(blob_dir))
+
+    def test_read_write_json(self):
+        self.assertIsNone(image_cache.read_json('inspect', 'sha256:1234', 60))
+
+        image_cache.write_json('inspect', 'sha256:1234', {'foo': 'bar'})
+        self.assertEqual(
+            {'foo': 'bar'},
+            image_cache.read_json('inspect', 'sha256:1234', 60)
+        )
+
+        # expired entries are removed
+        path = os.path.join(image_cache.cache_dir('inspect'),
+                            'sha256:1234.json')
+        os.utime(path, (0, 0))
+        self.assertIsNone(image_cache.read_json('inspect', 'sha256:1234', 60))
+        self.assertFalse(os.path.exists(path))
+
+        image_cache.CACHE_DIR = None
+        image_cache.write_json('inspect', 'sha256:1234', {'foo': 'bar'})
+        self.assertIsNone(image_cache.read_json('inspect', 'sha256:1234', 60))
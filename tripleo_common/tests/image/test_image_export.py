@@ -16,13 +16,17 @@
 import hashlib
 import io
 import json
+import mock
 import os
 import shutil
 import six
 from six.moves.urllib.parse import urlparse
 import tempfile
+import threading
+import time
 import zlib
 
+from tripleo_common.image import image_cache
 from tripleo_common.image import image_export
 from tripleo_common.image import image_uploader
 from tripleo_common.tests import base
@@ -104,21 +108,119 @@ class TestImageExport(base.TestCase):
         with open(blob_path, 'rb') as f:
             self.assertEqual(blob_compressed, f.read())
 
+        # the image blob is a link to the blob store
+        store_path = os.path.join(image_export.IMAGE_EXPORT_DIR,
+                                  'blobs/sha256', compressed_digest[7:])
+        self.assertEqual(store_path,
+                         image_export.blob_store_path(compressed_digest))
+        self.assertTrue(os.path.samefile(store_path, blob_path))
+        self.assertEqual([compressed_digest[7:]],
+                         os.listdir(os.path.dirname(store_path)))
+
+        # another image links the stored blob without reading the stream
+        other_url = urlparse('docker://localhost:8787/t/nova-compute:latest')
+        layer = {
+            'digest': compressed_digest
+        }
+        self.assertEqual(
+            compressed_digest,
+            image_export.export_stream(other_url, layer, None)
+        )
+        self.assertEqual(len(blob_compressed), layer['size'])
+        other_blob_path = os.path.join(
+            image_export.IMAGE_EXPORT_DIR,
+            'v2/t/nova-compute/blobs/%s.gz' % compressed_digest)
+        self.assertTrue(os.path.samefile(store_path, other_blob_path))
+
+    def test_export_existing(self):
+        target_url = urlparse('docker://localhost:8787/t/nova-api:latest')
+        layer = {
+            'digest': 'sha256:1234'
+        }
+        self.assertIsNone(image_export.export_existing(target_url, layer))
+
+        store_path = image_export.blob_store_path('sha256:1234')
+        image_export.make_dir(os.path.dirname(store_path))
+        with open(store_path, 'w') as f:
+            f.write('blob')
+        self.assertEqual('sha256:1234',
+                         image_export.export_existing(target_url, layer))
+        self.assertEqual(4, layer['size'])
+        blob_path = os.path.join(image_export.IMAGE_EXPORT_DIR,
+                                 'v2/t/nova-api/blobs/sha256:1234.gz')
+        self.assertTrue(os.path.samefile(store_path, blob_path))
+
+    def test_export_file(self):
+        source_path = os.path.join(image_export.IMAGE_EXPORT_DIR, 'source')
+        with open(source_path, 'wb') as f:
+            f.write(six.b('The Blob'))
+
+        target_url = urlparse('docker://localhost:8787/t/nova-api:latest')
+        layer = {
+            'digest': 'sha256:1234'
+        }
+        self.assertEqual(
+            'sha256:1234',
+            image_export.export_file(target_url, layer, source_path)
+        )
+        self.assertEqual(8, layer['size'])
+
+        # the blob is hard linked to the source through the blob store
+        blob_path = os.path.join(image_export.IMAGE_EXPORT_DIR,
+                                 'v2/t/nova-api/blobs/sha256:1234.gz')
+        self.assertTrue(os.path.samefile(source_path, blob_path))
+        self.assertTrue(os.path.samefile(
+            image_export.blob_store_path('sha256:1234'), blob_path))
+        self.assertEqual(
+            ['sha256:1234.gz'],
+            os.listdir(os.path.dirname(blob_path))
+        )
+
+    @mock.patch('os.link', side_effect=OSError('cross-device link'))
+    def test_export_file_copy(self, mock_link):
+        source_path = os.path.join(image_export.IMAGE_EXPORT_DIR, 'source')
+        with open(source_path, 'wb') as f:
+            f.write(six.b('The Blob'))
+
+        target_url = urlparse('docker://localhost:8787/t/nova-api:latest')
+        layer = {
+            'digest': 'sha256:1234'
+        }
+        image_export.export_file(target_url, layer, source_path)
+
+        blob_path = os.path.join(image_export.IMAGE_EXPORT_DIR,
+                                 'v2/t/nova-api/blobs/sha256:1234.gz')
+        self.assertFalse(os.path.samefile(source_path, blob_path))
+        with open(blob_path, 'rb') as f:
+            self.assertEqual(six.b('The Blob'), f.read())
+
+    def test_copy_file(self):
+        source_path = os.path.join(image_export.IMAGE_EXPORT_DIR, 'source')
+        target_path = os.path.join(image_export.IMAGE_EXPORT_DIR, 'target')
+        data = six.b('The Blob') * 100000
+        with open(source_path, 'wb') as f:
+            f.write(data)
+
+        image_export.copy_file(source_path, target_path)
+        with open(target_path, 'rb') as f:
+            self.assertEqual(data, f.read())
+
     def test_cross_repo_mount(self):
         target_url = urlparse('docker://localhost:8787/t/nova-api:latest')
         other_url = urlparse('docker://localhost:8787/t/nova-compute:latest')
+        digest = 'sha256:' + hashlib.sha256(six.b('blob')).hexdigest()
         image_layers = {
-            'sha256:1234': other_url
+            digest: other_url
         }
         source_layers = [
-            'sha256:1234', 'sha256:6789'
+            digest, 'sha256:6789'
         ]
         source_blob_dir = os.path.join(image_export.IMAGE_EXPORT_DIR,
                                        'v2/t/nova-compute/blobs')
-        source_blob_path = os.path.join(source_blob_dir, 'sha256:1234.gz')
+        source_blob_path = os.path.join(source_blob_dir, '%s.gz' % digest)
         target_blob_dir = os.path.join(image_export.IMAGE_EXPORT_DIR,
                                        'v2/t/nova-api/blobs')
-        target_blob_path = os.path.join(target_blob_dir, 'sha256:1234.gz')
+        target_blob_path = os.path.join(target_blob_dir, '%s.gz' % digest)
 
         # call with missing source, no change
         image_export.cross_repo_mount(target_url, image_layers, source_layers)
@@ -136,6 +238,62 @@ class TestImageExport(base.TestCase):
         with open(target_blob_path, 'r') as f:
             self.assertEqual('blob', f.read())
 
+        # the existing source was added to the blob store, so it is mounted
+        # without being in image_layers
+        store_path = image_export.blob_store_path(digest)
+        self.assertTrue(os.path.samefile(store_path, target_blob_path))
+        other_url = urlparse('docker://localhost:8787/t/heat-api:latest')
+        image_export.cross_repo_mount(other_url, {}, source_layers)
+        self.assertTrue(os.path.samefile(store_path, os.path.join(
+            image_export.IMAGE_EXPORT_DIR,
+            'v2/t/heat-api/blobs/%s.gz' % digest)))
+
+    def test_store_existing(self):
+        target_url = urlparse('docker://localhost:8787/t/nova-api:latest')
+        digest = 'sha256:' + hashlib.sha256(six.b('The Blob')).hexdigest()
+        blob_dir = os.path.join(image_export.IMAGE_EXPORT_DIR,
+                                'v2/t/nova-api/blobs')
+        blob_path = os.path.join(blob_dir, '%s.gz' % digest)
+        store_path = image_export.blob_store_path(digest)
+        image_export.make_dir(blob_dir)
+
+        # a partial blob from an interrupted export is removed
+        with open(blob_path, 'wb') as f:
+            f.write(six.b('The'))
+        self.assertIsNone(
+            image_export.export_existing(target_url, {'digest': digest}))
+        self.assertFalse(os.path.exists(blob_path))
+        self.assertFalse(os.path.exists(store_path))
+
+        # a complete blob is added to the blob store
+        with open(blob_path, 'wb') as f:
+            f.write(six.b('The Blob'))
+        layer = {'digest': digest}
+        self.assertEqual(
+            digest, image_export.export_existing(target_url, layer))
+        self.assertEqual(8, layer['size'])
+        self.assertTrue(os.path.samefile(store_path, blob_path))
+
+    def test_write_file(self):
+        path = os.path.join(image_export.IMAGE_EXPORT_DIR, 'index.json')
+        with open(path, 'w') as f:
+            f.write('old')
+        with mock.patch('os.fsync') as mock_fsync:
+            image_export.write_file(path, 'new')
+        mock_fsync.assert_called_once()
+        with open(path, 'r') as f:
+            self.assertEqual('new', f.read())
+        self.assertEqual(0o644, os.stat(path).st_mode & 0o777)
+        self.assertEqual(['index.json'],
+                         os.listdir(image_export.IMAGE_EXPORT_DIR))
+
+        with mock.patch('os.rename', side_effect=OSError):
+            self.assertRaises(OSError, image_export.write_file, path, 'bad')
+        with open(path, 'r') as f:
+            self.assertEqual('new', f.read())
+        self.assertEqual(['index.json'],
+                         os.listdir(image_export.IMAGE_EXPORT_DIR))
+
     def test_export_manifest_config(self):
         target_url = urlparse('docker://localhost:8787/t/nova-api:latest')
         config_str = '{"config": {}}'
@@ -195,3 +353,237 @@ Header set ETag "%s"
             self.assertEqual(manifest_str, f.read())
         with open(manifest_htaccess_path, 'r') as f:
             self.assertEqual(expected_htaccess, f.read())
+
+    def test_export_manifest_config_untagged(self):
+        target_url = urlparse('docker://localhost:8787/t/nova-api:latest')
+        manifest_str = json.dumps({
+            'config': {'digest': 'sha256:1234'},
+            'layers': [],
+        })
+        manifest_digest = 'sha256:%s' % hashlib.sha256(
+            manifest_str.encode('utf-8')).hexdigest()
+
+        # a platform manifest of a manifest list is only found by digest
+        image_export.export_manifest_config(
+            target_url, manifest_str,
+            image_uploader.MEDIA_OCI_MANIFEST, '{}', tagged=False
+        )
+        manifests_path = os.path.join(
+            image_export.IMAGE_EXPORT_DIR, 'v2/t/nova-api/manifests')
+        self.assertEqual([manifest_digest], os.listdir(manifests_path))
+        self.assertTrue(os.path.isfile(os.path.join(
+            manifests_path, manifest_digest, 'index.json')))
+        self.assertFalse(os.path.exists(os.path.join(
+            image_export.IMAGE_EXPORT_DIR, 'v2/t/nova-api/tags')))
+
+    def test_add_tag(self):
+        manifests_path = os.path.join(
+            image_export.IMAGE_EXPORT_DIR, 'v2/t/nova-api/manifests')
+        tags_list_path = os.path.join(
+            image_export.IMAGE_EXPORT_DIR, 'v2/t/nova-api/tags/list')
+
+        def tags():
+            with open(tags_list_path, 'r') as f:
+                return json.load(f)
+
+        self._export_image(
+            'docker://localhost:8787/t/nova-api:latest', ['aaaa'])
+        self._export_image(
+            'docker://localhost:8787/t/nova-api:1.0', ['aaaa'])
+        self.assertEqual({'name': 't/nova-api', 'tags': ['latest', '1.0']},
+                         tags())
+        self.assertEqual(0o644, os.stat(tags_list_path).st_mode & 0o777)
+
+        # existing tags are not listed or written again
+        with mock.patch('os.listdir') as mock_listdir:
+            with mock.patch('os.rename') as mock_rename:
+                image_export.add_tag('t/nova-api', 'latest')
+        mock_listdir.assert_not_called()
+        mock_rename.assert_not_called()
+
+        # tags are added concurrently without losing any
+        threads = [
+            threading.Thread(target=image_export.add_tag,
+                             args=('t/nova-api', str(i)))
+            for i in range(10)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(
+            ['latest', '1.0'] + [str(i) for i in range(10)],
+            tags()['tags'][:2] + sorted(tags()['tags'][2:], key=int))
+
+        # a missing list is rebuilt from the tag symlinks
+        os.remove(tags_list_path)
+        os.symlink(os.path.join(manifests_path, 'sha256:1234'),
+                   os.path.join(manifests_path, 'old'))
+        image_export.add_tag('t/nova-api', 'old')
+        self.assertEqual(['1.0', 'latest', 'old'], tags()['tags'])
+        self.assertEqual(['list'], [
+            f for f in os.listdir(os.path.dirname(tags_list_path))
+            if f != '.lock'])
+
+    def _export_image(self, url, layers_data):
+        url = urlparse(url)
+        layers = []
+        for data in layers_data:
+            layer = {'digest': 'sha256:unknown'}
+            image_export.export_stream(url, layer, [six.b(data)])
+            layers.append({'digest': layer['digest']})
+        manifest_str = json.dumps({
+            'config': {'digest': 'sha256:1234'},
+            'layers': layers
+        })
+        image_export.export_manifest_config(
+            url, manifest_str,
+            'application/vnd.docker.distribution.manifest.v2+json',
+            '{"config": {}}')
+        return [l['digest'] for l in layers]
+
+    def test_collect_garbage(self):
+        image_dir = os.path.join(image_export.IMAGE_EXPORT_DIR, 'v2/t')
+        a, b = self._export_image(
+            'docker://localhost:8787/t/nova-api:latest', ['aaaa', 'bbbb'])
+        self._export_image(
+            'docker://localhost:8787/t/nova-compute:latest', ['aaaa', 'cc'])
+        # nova-api:latest now uses a new manifest without layer b
+        self._export_image(
+            'docker://localhost:8787/t/nova-api:latest', ['aaaa', 'dddddd'])
+        # a stored blob which no image uses
+        orphan_path = image_export.blob_store_path('sha256:5678')
+        with open(orphan_path, 'w') as f:
+            f.write('orphan')
+
+        self.assertEqual(['t/nova-api', 't/nova-compute'],
+                         image_export.image_repos())
+        manifests_dir = os.path.join(image_dir, 'nova-api/manifests')
+        self.assertEqual(3, len(os.listdir(manifests_dir)))
+
+        # nothing is collected within the grace period
+        self.assertEqual(
+            {'t/nova-api': 0, 't/nova-compute': 0, 'blobs': 0},
+            image_export.collect_garbage())
+
+        # a dry run reports without deleting
+        result = image_export.collect_garbage(grace_period=-60,
+                                              dry_run=True)
+        self.assertEqual(['t/nova-api', 't/nova-compute', 'blobs'],
+                         list(result.keys()))
+        self.assertEqual(0, result['t/nova-compute'])
+        self.assertEqual(6, result['blobs'])
+        # layer b and the replaced manifest
+        latest = os.path.basename(
+            os.readlink(os.path.join(manifests_dir, 'latest')))
+        old_manifest_dir = [
+            os.path.join(manifests_dir, f) for f in os.listdir(manifests_dir)
+            if f not in ('latest', latest)][0]
+        self.assertEqual(
+            4 + sum(os.path.getsize(os.path.join(old_manifest_dir, f))
+                    for f in os.listdir(old_manifest_dir)),
+            result['t/nova-api'])
+        self.assertTrue(os.path.exists(image_export.blob_store_path(b)))
+        self.assertTrue(os.path.exists(orphan_path))
+
+        self.assertEqual(
+            result, image_export.collect_garbage(grace_period=-60))
+        self.assertFalse(os.path.exists(image_export.blob_store_path(b)))
+        self.assertFalse(os.path.exists(
+            os.path.join(image_dir, 'nova-api/blobs/%s.gz' % b)))
+        self.assertFalse(os.path.exists(orphan_path))
+        self.assertEqual(2, len(os.listdir(manifests_dir)))
+
+        # referenced blobs are kept
+        self.assertTrue(os.path.exists(image_export.blob_store_path(a)))
+        self.assertEqual(
+            3, len(os.listdir(os.path.join(image_dir, 'nova-api/blobs'))))
+        self.assertEqual(
+            3, len(os.listdir(os.path.join(image_dir, 'nova-compute/blobs'))))
+
+        # collecting again finds nothing
+        self.assertEqual(
+            {'t/nova-api': 0, 't/nova-compute': 0, 'blobs': 0},
+            image_export.collect_garbage(grace_period=-60))
+
+    def test_collect_garbage_cached_blob(self):
+        cache_dir = image_cache.CACHE_DIR
+        image_cache.CACHE_DIR = tempfile.mkdtemp()
+        self.addCleanup(setattr, image_cache, 'CACHE_DIR', cache_dir)
+        self.addCleanup(shutil.rmtree, image_cache.CACHE_DIR)
+
+        a, b = self._export_image(
+            'docker://localhost:8787/t/nova-api:latest', ['aaaa', 'bbbb'])
+        # both layers were exported from the blob cache
+        for digest in (a, b):
+            os.link(image_export.blob_store_path(digest),
+                    image_cache.blob_path(digest))
+        self._export_image(
+            'docker://localhost:8787/t/nova-api:latest', ['aaaa'])
+
+        # the cache link does not keep layer b in the store
+        result = image_export.collect_garbage(grace_period=-60, dry_run=True)
+        self.assertEqual(0, result['blobs'])
+        self.assertTrue(os.path.exists(image_cache.blob_path(b)))
+        self.assertEqual(
+            result, image_export.collect_garbage(grace_period=-60))
+        self.assertFalse(os.path.exists(image_export.blob_store_path(b)))
+        self.assertFalse(os.path.exists(image_cache.blob_path(b)))
+
+        # a cached layer which is still used is kept
+        self.assertTrue(os.path.exists(image_export.blob_store_path(a)))
+        self.assertTrue(os.path.exists(image_cache.blob_path(a)))
+
+        # an unrelated cached blob is not evicted
+        c = self._export_image(
+            'docker://localhost:8787/t/nova-compute:latest', ['cc'])[0]
+        with open(image_cache.blob_path(c), 'w') as f:
+            f.write('cc')
+        self._export_image(
+            'docker://localhost:8787/t/nova-compute:latest', ['aaaa'])
+        image_export.collect_garbage(grace_period=-60)
+        self.assertFalse(os.path.exists(image_export.blob_store_path(c)))
+        self.assertTrue(os.path.exists(image_cache.blob_path(c)))
+
+    def test_collect_garbage_shared_layer(self):
+        image_dir = os.path.join(image_export.IMAGE_EXPORT_DIR, 'v2/t')
+        a, b = self._export_image(
+            'docker://localhost:8787/t/nova-api:latest', ['aaaa', 'bbbb'])
+        self._export_image(
+            'docker://localhost:8787/t/nova-compute:latest', ['aaaa', 'cc'])
+        # only nova-api stops using layer a
+        self._export_image(
+            'docker://localhost:8787/t/nova-api:latest', ['bbbb'])
+        compute_blob = os.path.join(image_dir, 'nova-compute/blobs/%s.gz' % a)
+        self.assertEqual(3, os.stat(compute_blob).st_nlink)
+
+        result = image_export.collect_garbage(grace_period=-60, dry_run=True)
+        self.assertEqual(0, result['blobs'])
+        self.assertEqual(0, result['t/nova-compute'])
+        self.assertEqual(
+            result, image_export.collect_garbage(grace_period=-60))
+
+        # the layer is still in the store and used by nova-compute
+        self.assertFalse(os.path.exists(
+            os.path.join(image_dir, 'nova-api/blobs/%s.gz' % a)))
+        self.assertTrue(os.path.exists(image_export.blob_store_path(a)))
+        self.assertTrue(os.path.exists(compute_blob))
+        self.assertEqual(2, os.stat(compute_blob).st_nlink)
+
+        # a layer only nova-api used is freed from the store too, although
+        # removing its image link changed it after it expired
+        b, e = self._export_image(
+            'docker://localhost:8787/t/nova-api:latest', ['bbbb', 'eeeee'])
+        self._export_image(
+            'docker://localhost:8787/t/nova-api:latest', ['bbbb'])
+        expired = time.time()
+        time.sleep(0.05)
+        grace_period = time.time() - expired
+
+        result = image_export.collect_garbage(
+            grace_period=grace_period, dry_run=True)
+        self.assertTrue(os.path.exists(image_export.blob_store_path(e)))
+        self.assertEqual(
+            result, image_export.collect_garbage(grace_period=grace_period))
+        self.assertFalse(os.path.exists(image_export.blob_store_path(e)))
+        self.assertTrue(os.path.exists(image_export.blob_store_path(a)))
@@ -0,0 +1,130 @@
+#   Copyright 2019 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import json
+import mock
+import os
+import shutil
+import tempfile
+
+from tripleo_common.image import image_metrics
+from tripleo_common.tests import base
+
+
+class TestImageMetrics(base.TestCase):
+    def setUp(self):
+        super(TestImageMetrics, self).setUp()
+        image_metrics.reset()
+        self.addCleanup(image_metrics.reset)
+
+        image_metrics.request('quay.io', 'HEAD', 'blob', 0.02)
+        image_metrics.request('quay.io', 'HEAD', 'blob', 0.04)
+        image_metrics.request('quay.io', 'HEAD', 'blob', 0.2)
+        image_metrics.request('quay.io', 'HEAD', 'blob', 60)
+        image_metrics.request('quay.io', 'HEAD', 'blob', 0, error=True)
+        image_metrics.transfer('quay.io', 'pull', 1000, 0.5)
+        image_metrics.transfer('quay.io', 'pull', 1000, 1.5)
+        image_metrics.cache('blobs', True)
+        image_metrics.cache('blobs', True)
+        image_metrics.cache('blobs', True)
+        image_metrics.cache('blobs', False)
+        with mock.patch('time.time', side_effect=[10, 14]):
+            with image_metrics.image_timer('t/nova-api:latest'):
+                pass
+
+    def test_request_kind(self):
+        kind = image_metrics.request_kind
+        self.assertEqual('manifest', kind('/v2/t/foo/manifests/1'))
+        self.assertEqual('upload', kind('/v2/t/foo/blobs/uploads/'))
+        self.assertEqual('blob', kind('/v2/t/foo/blobs/sha256:1'))
+        self.assertEqual('tags', kind('/v2/t/foo/tags/list'))
+        self.assertEqual('ping', kind('/v2/'))
+        self.assertEqual('auth', kind('/token'))
+
+    def test_summary(self):
+        summary = image_metrics.summary()
+        head = summary['requests']['quay.io']['HEAD blob']
+        self.assertEqual(4, head['count'])
+        self.assertEqual(1, head['errors'])
+        self.assertEqual(60, head['max'])
+        self.assertEqual(0.05, head['p50'])
+        self.assertEqual(60, head['p99'])
+        self.assertEqual(1, head['buckets']['0.025'])
+        self.assertEqual(1, head['buckets']['+Inf'])
+        self.assertEqual(
+            {'bytes': 2000, 'seconds': 2.0, 'bytes_per_second': 1000.0},
+            summary['transfers']['quay.io']['pull'])
+        self.assertEqual(
+            {'hits': 3, 'misses': 1, 'hit_rate': 0.75},
+            summary['caches']['blobs'])
+        self.assertEqual({'t/nova-api:latest': 4}, summary['images'])
+
+        image_metrics.reset()
+        summary = image_metrics.summary()
+        self.assertEqual({}, summary['requests'])
+        self.assertEqual({}, summary['images'])
+
+    def test_write(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        path = os.path.join(tmpdir, 'metrics.json')
+        image_metrics.write_json(path)
+        with open(path) as f:
+            self.assertEqual(
+                4, json.load(f)['requests']['quay.io']['HEAD blob']['count'])
+
+        path = os.path.join(tmpdir, 'metrics.prom')
+        image_metrics.write_textfile(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertIn(
+            'tripleo_image_prepare_request_seconds_bucket{kind="blob",'
+            'le="0.05",method="HEAD",registry="quay.io"} 2', lines)
+        self.assertIn(
+            'tripleo_image_prepare_request_seconds_bucket{kind="blob",'
+            'le="+Inf",method="HEAD",registry="quay.io"} 4', lines)
+        self.assertIn(
+            'tripleo_image_prepare_request_seconds_count{kind="blob",'
+            'method="HEAD",registry="quay.io"} 4', lines)
+        self.assertIn(
+            'tripleo_image_prepare_transfer_bytes_total{direction="pull",'
+            'registry="quay.io"} 2000', lines)
+        self.assertIn(
+            'tripleo_image_prepare_cache_hits_total{cache="blobs"} 3', lines)
+        self.assertIn(
+            'tripleo_image_prepare_image_seconds{image="t/nova-api:latest"} '
+            '4.000000', lines)
+
+    @mock.patch('socket.socket')
+    def test_send_statsd(self, mock_socket):
+        sock = mock_socket.return_value
+        with mock.patch.object(image_metrics, 'STATSD_PACKET_SIZE', 200):
+            image_metrics.send_statsd('localhost:9125')
+
+        lines = []
+        for call in sock.sendto.call_args_list:
+            packet, address = call[0]
+            self.assertEqual(('localhost', 9125), address)
+            self.assertLessEqual(len(packet), 200)
+            lines.extend(packet.decode('utf-8').split('\n'))
+        self.assertGreater(sock.sendto.call_count, 1)
+        self.assertEqual(image_metrics.statsd_lines(), lines)
+        self.assertIn('tripleo.image_prepare.request.quay_io.HEAD_blob.'
+                      'count:4|c', lines)
+        self.assertIn('tripleo.image_prepare.transfer.quay_io.pull.'
+                      'bytes_per_second:1000|g', lines)
+        self.assertIn('tripleo.image_prepare.image:4000|ms', lines)
+        sock.close.assert_called_once_with()
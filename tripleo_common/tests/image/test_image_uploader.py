@@ -13,6 +13,10 @@
 #   under the License.
 #
 
+import base64
+import collections
+from concurrent import futures
+import gzip
 import hashlib
 import io
 import json
@@ -21,15 +25,21 @@ import operator
 import os
 import requests
 from requests_mock.contrib import fixture as rm_fixture
+import shutil
 import six
 from six.moves.urllib.parse import urlparse
+import tarfile
 import tempfile
+import threading
+import time
 import urllib3
 import zlib
 
 from oslo_concurrency import processutils
 from tripleo_common.image.exception import ImageNotFoundException
 from tripleo_common.image.exception import ImageUploaderException
+from tripleo_common.image import image_cache
+from tripleo_common.image import image_export
 from tripleo_common.image import image_uploader
 from tripleo_common.tests import base
 from tripleo_common.tests.image import fakes
@@ -47,6 +57,18 @@ filedata = six.u(
 """)
 
 
+def use_temp_cache_dir(test):
+    cache_dir = image_cache.CACHE_DIR
+    temp_cache_dir = tempfile.mkdtemp()
+
+    def restore_cache_dir():
+        shutil.rmtree(temp_cache_dir)
+        image_cache.CACHE_DIR = cache_dir
+
+    image_cache.CACHE_DIR = temp_cache_dir
+    test.addCleanup(restore_cache_dir)
+
+
 class TestImageUploadManager(base.TestCase):
     def setUp(self):
         super(TestImageUploadManager, self).setUp()
@@ -139,6 +161,22 @@ class TestImageUploadManager(base.TestCase):
             manager.get_push_destination({'push_destination': None})
         )
 
+    def test_init_uploaders(self):
+        uploader = image_uploader.BaseImageUploader
+        self.addCleanup(uploader.init_rate_limits)
+        manager = image_uploader.ImageUploadManager(
+            self.filelist, rate_limit_bytes=1000, rate_limit_requests=5)
+        manager.init_uploaders()
+        self.assertEqual({'bytes': 1000, 'requests': 5},
+                         uploader.rate_limits)
+
+        # creating another manager does not replace the settings in use
+        other = image_uploader.ImageUploadManager(self.filelist)
+        self.assertEqual({'bytes': 1000, 'requests': 5},
+                         uploader.rate_limits)
+        other.init_uploaders()
+        self.assertEqual({}, uploader.rate_limits)
+
     def test_get_uploader_docker(self):
         manager = image_uploader.ImageUploadManager(self.filelist)
         uploader = manager.get_uploader('docker')
@@ -164,6 +202,7 @@ class TestBaseImageUploader(base.TestCase):
         self.uploader.init_registries_cache()
         self.uploader._inspect.retry.sleep = mock.Mock()
         self.requests = self.useFixture(rm_fixture.Fixture())
+        use_temp_cache_dir(self)
 
     def test_is_insecure_registry_known(self):
         self.assertFalse(
@@ -205,6 +244,51 @@ class TestBaseImageUploader(base.TestCase):
             self.requests.request_history[0].url
         )
 
+    def test_is_insecure_registry_cached(self):
+        self.requests.get(
+            'https://192.0.2.0:8787/v2',
+            exc=requests.exceptions.SSLError('ouch'))
+        self.requests.get(
+            'https://192.0.2.1:8787/v2',
+            exc=requests.exceptions.ConnectTimeout('ouch'))
+        self.assertTrue(
+            self.uploader.is_insecure_registry('192.0.2.0:8787'))
+        self.assertFalse(
+            self.uploader.is_insecure_registry('192.0.2.1:8787'))
+        self.assertEqual(2, self.requests.call_count)
+
+        # detected registries are cached on disk, unreachable registries
+        # are probed again
+        self.uploader.init_registries_cache()
+        self.assertTrue(
+            self.uploader.is_insecure_registry('192.0.2.0:8787'))
+        self.assertFalse(
+            self.uploader.is_insecure_registry('192.0.2.1:8787'))
+        self.assertEqual(3, self.requests.call_count)
+        self.assertEqual(
+            'https://192.0.2.1:8787/v2',
+            self.requests.request_history[2].url
+        )
+
+    def test_prime_insecure_registries(self):
+        self.requests.get(
+            'https://192.0.2.0:8787/v2',
+            exc=requests.exceptions.SSLError('ouch'))
+        self.requests.get(
+            'https://192.0.2.1:8787/v2',
+            exc=requests.exceptions.SSLError('ouch'))
+        self.requests.get('https://192.0.2.2:8787/v2', status_code=200)
+        self.uploader.prime_insecure_registries([
+            'docker.io', '192.0.2.0:8787', '192.0.2.1:8787',
+            '192.0.2.2:8787', '192.0.2.0:8787'
+        ])
+        self.assertEqual(3, self.requests.call_count)
+        self.assertEqual(
+            set(['192.0.2.0:8787', '192.0.2.1:8787']),
+            self.uploader.insecure_registries
+        )
+        self.assertIn('192.0.2.2:8787', self.uploader.secure_registries)
+
     @mock.patch('tripleo_common.image.image_uploader.'
                 'BaseImageUploader.authenticate')
     @mock.patch('tripleo_common.image.image_uploader.'
@@ -340,7 +424,8 @@ class TestBaseImageUploader(base.TestCase):
 
     @mock.patch('concurrent.futures.ThreadPoolExecutor')
     def test_discover_image_tags(self, mock_pool):
-        mock_pool.return_value.map.return_value = (
+        pool = mock_pool.return_value.__enter__.return_value
+        pool.map.return_value = (
             ('docker.io/t/foo', 'a'),
             ('docker.io/t/bar', 'b'),
             ('docker.io/t/baz', 'c')
@@ -358,7 +443,9 @@ class TestBaseImageUploader(base.TestCase):
             },
             self.uploader.discover_image_tags(images, 'rdo_release')
         )
-        mock_pool.return_value.map.assert_called_once_with(
+        # workers are bounded by the images and the session pool size
+        mock_pool.assert_called_once_with(max_workers=3)
+        pool.map.assert_called_once_with(
             image_uploader.discover_tag_from_inspect,
             [
                 ('docker.io/t/foo', 'rdo_release'),
@@ -366,6 +453,87 @@ class TestBaseImageUploader(base.TestCase):
                 ('docker.io/t/baz', 'rdo_release')
             ])
 
+    def test_discover_tag(self):
+        req = self.requests
+        session = requests.Session()
+        url = urlparse('docker://docker.io/t/foo:latest')
+        discover = image_uploader.BaseImageUploader._discover_tag
+
+        manifest = req.get(
+            'https://registry-1.docker.io/v2/t/foo/manifests/latest',
+            json={
+                'schemaVersion': 2,
+                'config': {'mediaType': 'text/html', 'digest': 'abcdef'},
+                'layers': []
+            },
+            headers={'Docker-Content-Digest': 'sha256:eeeeee'})
+        config = req.get(
+            'https://registry-1.docker.io/v2/t/foo/blobs/abcdef',
+            json={
+                'created': '2018-10-02T11:13:45.567533229Z',
+                'config': {'Labels': {'rdo_version': 'a', 'version': 'b'}},
+                'architecture': 'amd64',
+                'os': 'linux',
+            })
+        head_a = req.head(
+            'https://registry-1.docker.io/v2/t/foo/manifests/a',
+            headers={'Docker-Content-Digest': 'sha256:aaaaaa'})
+        head_b = req.head(
+            'https://registry-1.docker.io/v2/t/foo/manifests/b',
+            status_code=404)
+        tags = req.get(
+            'https://registry-1.docker.io/v2/t/foo/tags/list',
+            json={'tags': ['a', 'latest']})
+
+        # the tag is confirmed with a HEAD instead of listing tags
+        self.assertEqual(
+            'a', discover(url, 'docker.io/t/foo', 'rdo_version',
+                          session=session))
+        self.assertEqual(1, manifest.call_count)
+        self.assertEqual(1, config.call_count)
+        self.assertEqual(1, head_a.call_count)
+        self.assertEqual(0, tags.call_count)
+
+        # the inspected tag needs no HEAD
+        self.assertEqual(
+            'latest', discover(url, 'docker.io/t/foo', 'missing',
+                               fallback_tag='latest', session=session))
+        self.assertEqual(1, head_a.call_count)
+        self.assertEqual(0, tags.call_count)
+
+        # tags are only listed to report a missing tag
+        e = self.assertRaises(
+            ImageUploaderException, discover, url, 'docker.io/t/foo',
+            'version', session=session)
+        self.assertIn('Available tags: a, latest', str(e))
+        self.assertEqual(1, head_b.call_count)
+        self.assertEqual(1, tags.call_count)
+        self.assertEqual(1, manifest.call_count)
+
+    def test_fetch_tags(self):
+        req = self.requests
+        session = requests.Session()
+        url = urlparse('docker://docker.io/t/foo:latest')
+        tags_url = 'https://registry-1.docker.io/v2/t/foo/tags/list'
+
+        req.get(tags_url + '?n=2', complete_qs=True,
+                json={'tags': ['a', 'b']},
+                headers={'Link': '</v2/t/foo/tags/list?n=2&last=b>; '
+                                 'rel="next"'})
+        req.get(tags_url + '?n=2&last=b', complete_qs=True,
+                json={'tags': ['c', 'd']},
+                headers={'Link': '</v2/t/foo/tags/list?n=2&last=d>; '
+                                 'rel="next"'})
+        req.get(tags_url + '?n=2&last=d', complete_qs=True,
+                json={'tags': ['e']})
+
+        with mock.patch.object(image_uploader.BaseImageUploader,
+                               'tags_page_size', 2):
+            self.assertEqual(
+                ['a', 'b', 'c', 'd', 'e'],
+                image_uploader.BaseImageUploader._fetch_tags(url, session))
+        self.assertEqual(3, req.call_count)
+
     @mock.patch('tripleo_common.image.image_uploader.'
                 'BaseImageUploader._inspect')
     def test_images_match(self, mock_inspect):
@@ -395,6 +563,7 @@ class TestBaseImageUploader(base.TestCase):
         # no auth required
         req.get('https://registry-1.docker.io/v2/', status_code=200)
         self.assertNotIn('Authorization', auth(url1).headers)
+        self.uploader.init_registries_cache()
 
         # missing 'www-authenticate' header
         req.get('https://registry-1.docker.io/v2/', status_code=401)
@@ -419,6 +588,64 @@ class TestBaseImageUploader(base.TestCase):
             auth(url1).headers['Authorization']
         )
 
+    def test_authenticate_cached(self):
+        req = self.requests
+        auth = image_uploader.BaseImageUploader.authenticate
+        url1 = urlparse('docker://docker.io/t/nova-api:latest')
+        url2 = urlparse('docker://docker.io/t/nova-compute:latest')
+
+        headers = {
+            'www-authenticate': 'Bearer '
+                                'realm="https://auth.docker.io/token",'
+                                'service="registry.docker.io"'
+        }
+        req.get('https://registry-1.docker.io/v2/', status_code=401,
+                headers=headers)
+        token = req.get('https://auth.docker.io/token',
+                        json={"token": "asdf1234", "expires_in": 300})
+
+        # the session is reused for the same scope
+        session = auth(url1)
+        self.assertIs(session, auth(url1))
+        self.assertEqual(1, token.call_count)
+
+        # the challenge is reused for another scope on the same registry,
+        # and the sessions share a connection pool
+        session2 = auth(url2)
+        self.assertIsNot(session, session2)
+        self.assertEqual(2, token.call_count)
+        self.assertEqual(1, req.call_count - token.call_count)
+        self.assertIs(session.get_adapter('https://registry-1.docker.io'),
+                      session2.get_adapter('https://registry-1.docker.io'))
+
+        # a new token is fetched when the token is about to expire
+        with mock.patch('time.time', return_value=time.time() + 295):
+            self.assertIsNot(session, auth(url1))
+        self.assertEqual(3, token.call_count)
+
+    def test_session_pool_grows(self):
+        base = image_uploader.BaseImageUploader
+        python = image_uploader.PythonImageUploader
+        url = urlparse('docker://192.0.2.0:8787/t/nova-api:latest')
+        self.addCleanup(base.init_registries_cache)
+        base.auth_challenges['192.0.2.0:8787'] = (None, {})
+
+        # discovery creates the session with the smaller pool
+        session = base.authenticate(url)
+        adapter = session.get_adapter('https://192.0.2.0:8787')
+        self.assertEqual(base.session_pool_size, adapter._pool_maxsize)
+
+        # a class with a larger pool grows it, also for cached sessions
+        with mock.patch.object(python, 'session_pool_size', 64):
+            self.assertIs(session, python.authenticate(url))
+        self.assertEqual(64, adapter._pool_maxsize)
+        self.assertEqual(
+            64, adapter.poolmanager.connection_pool_kw['maxsize'])
+
+        # and a smaller pool never shrinks it
+        base._session('192.0.2.0:8787')
+        self.assertEqual(64, adapter._pool_maxsize)
+
     def test_authenticate_with_no_service(self):
         req = self.requests
         auth = image_uploader.BaseImageUploader.authenticate
@@ -436,6 +663,68 @@ class TestBaseImageUploader(base.TestCase):
             auth(url1).headers['Authorization']
         )
 
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    def test_token_bucket(self, mock_time, mock_sleep):
+        mock_time.return_value = 100
+        bucket = image_uploader.TokenBucket(10)
+
+        # one second of the rate is allowed as a burst
+        bucket.consume(10)
+        mock_sleep.assert_not_called()
+        bucket.consume(5)
+        mock_sleep.assert_called_once_with(0.5)
+
+        # tokens are replenished up to the rate, then larger amounts wait
+        mock_sleep.reset_mock()
+        mock_time.return_value = 102
+        bucket.consume(30)
+        mock_sleep.assert_called_once_with(2.0)
+
+    @mock.patch('tripleo_common.image.image_uploader.TokenBucket')
+    def test_throttle(self, mock_bucket):
+        uploader = image_uploader.BaseImageUploader
+        self.addCleanup(uploader.init_rate_limits)
+
+        # no limits by default
+        uploader._throttle('https://192.0.2.0:8787/v2/', 'bytes', 100)
+        mock_bucket.assert_not_called()
+
+        uploader.init_rate_limits(rate_limit_bytes=1000)
+        uploader._throttle('https://192.0.2.0:8787/v2/a', 'bytes', 100)
+        uploader._throttle('https://192.0.2.0:8787/v2/b', 'bytes', 200)
+        uploader._throttle('https://192.0.2.1:8787/v2/a', 'bytes', 300)
+        uploader._throttle('https://192.0.2.0:8787/v2/a', 'requests')
+        self.assertEqual([mock.call(1000), mock.call(1000)],
+                         mock_bucket.call_args_list)
+        mock_bucket.return_value.consume.assert_has_calls([
+            mock.call(100), mock.call(200), mock.call(300)
+        ])
+
+    @mock.patch('tripleo_common.image.image_metrics.request')
+    @mock.patch('requests.adapters.HTTPAdapter.send')
+    def test_rate_limited_adapter(self, mock_send, mock_request):
+        uploader = mock.Mock()
+        adapter = image_uploader.RateLimitedAdapter(uploader)
+        request = mock.Mock(url='https://192.0.2.0:8787/v2/', method='GET')
+        self.assertEqual(mock_send.return_value,
+                         adapter.send(request, timeout=30))
+        uploader._throttle.assert_called_once_with(
+            'https://192.0.2.0:8787/v2/', 'requests')
+        mock_send.assert_called_once_with(request, timeout=30)
+        mock_request.assert_called_once_with(
+            '192.0.2.0:8787', 'GET', 'ping', mock.ANY)
+
+        # failed requests are counted as errors
+        mock_request.reset_mock()
+        mock_send.side_effect = requests.exceptions.ConnectionError()
+        request = mock.Mock(url='https://192.0.2.0:8787/v2/t/foo/blobs/1',
+                            method='HEAD')
+        self.assertRaises(requests.exceptions.ConnectionError,
+                          adapter.send, request, timeout=30)
+        mock_request.assert_called_once_with(
+            '192.0.2.0:8787', 'HEAD', 'blob', 0, error=True)
+
     def test_build_url(self):
         url1 = urlparse('docker://docker.io/t/nova-api:latest')
         url2 = urlparse('docker://registry-1.docker.io/t/nova-api:latest')
@@ -541,6 +830,83 @@ class TestBaseImageUploader(base.TestCase):
             inspect(url1, session=session)
         )
 
+    def test_inspect_cached(self):
+        req = self.requests
+        session = requests.Session()
+        inspect = image_uploader.BaseImageUploader._inspect
+
+        url1 = urlparse('docker://docker.io/t/nova-api:latest')
+        url2 = urlparse('docker://docker.io/t/nova-api:other')
+        manifest_resp = {
+            'schemaVersion': 2,
+            'config': {
+                'mediaType': 'text/html',
+                'digest': 'abcdef'
+            },
+            'layers': [
+                {'digest': 'aaa'},
+            ]
+        }
+        manifest_headers = {'Docker-Content-Digest': 'sha256:eeeeee'}
+        config_resp = {
+            'created': '2018-10-02T11:13:45.567533229Z',
+            'config': {
+                'Labels': {
+                    'kolla_version': '7.0.0'
+                }
+            },
+            'architecture': 'amd64',
+            'os': 'linux',
+        }
+        tags = req.get(
+            'https://registry-1.docker.io/v2/t/nova-api/tags/list',
+            json={'tags': ['latest', 'other']})
+        config = req.get(
+            'https://registry-1.docker.io/v2/t/nova-api/blobs/abcdef',
+            json=config_resp)
+        manifest1 = req.get(
+            'https://registry-1.docker.io/v2/t/nova-api/manifests/latest',
+            json=manifest_resp, headers=manifest_headers)
+        manifest2 = req.get(
+            'https://registry-1.docker.io/v2/t/nova-api/manifests/other',
+            json=manifest_resp, headers=manifest_headers)
+
+        i = inspect(url1, session=session)
+        self.assertEqual({'kolla_version': '7.0.0'}, i['Labels'])
+        self.assertEqual(['aaa'], i['Layers'])
+
+        # second call is answered from memory
+        self.assertEqual(i, inspect(url1, session=session))
+        self.assertEqual(1, manifest1.call_count)
+        self.assertEqual(1, tags.call_count)
+        self.assertEqual(1, config.call_count)
+
+        # including calls which don't need the tags
+        self.assertEqual(i, inspect(url1, session=session, tags=False))
+        self.assertEqual(1, manifest1.call_count)
+
+        # a different tag for the same manifest digest uses the details
+        # cached on disk, and only lists the tags when they are needed
+        i2 = inspect(url2, session=session, tags=False)
+        self.assertEqual('other', i2['Tag'])
+        self.assertEqual({'kolla_version': '7.0.0'}, i2['Labels'])
+        self.assertNotIn('RepoTags', i2)
+        self.assertEqual(1, manifest2.call_count)
+        self.assertEqual(1, tags.call_count)
+        self.assertEqual(1, config.call_count)
+
+        i2 = inspect(url2, session=session)
+        self.assertEqual(['latest', 'other'], i2['RepoTags'])
+        self.assertEqual(2, manifest2.call_count)
+        self.assertEqual(2, tags.call_count)
+        self.assertEqual(1, config.call_count)
+
+        # expired results are fetched again
+        with mock.patch.object(image_uploader.BaseImageUploader,
+                               'inspect_cache_ttl', 0):
+            inspect(url1, session=session)
+        self.assertEqual(2, manifest1.call_count)
+
     def test_inspect_v1_manifest(self):
         req = self.requests
         session = requests.Session()
@@ -1247,7 +1613,9 @@ class TestPythonImageUploader(base.TestCase):
         u._copy_registry_to_registry.retry.sleep = mock.Mock()
         u._copy_registry_to_local.retry.sleep = mock.Mock()
         u._copy_local_to_registry.retry.sleep = mock.Mock()
+        u._resume_upload_chunk.retry.sleep = mock.Mock()
         self.requests = self.useFixture(rm_fixture.Fixture())
+        use_temp_cache_dir(self)
 
     @mock.patch('tripleo_common.image.image_uploader.'
                 'PythonImageUploader.authenticate')
@@ -1313,7 +1681,7 @@ class TestPythonImageUploader(base.TestCase):
         ])
 
         _fetch_manifest.assert_called_once_with(
-            source_url, session=source_session)
+            source_url, session=source_session, multi_arch=False)
 
         _cross_repo_mount.assert_called_once_with(
             target_url,
@@ -1419,7 +1787,7 @@ class TestPythonImageUploader(base.TestCase):
         ])
 
         _fetch_manifest.assert_called_once_with(
-            source_url, session=source_session)
+            source_url, session=source_session, multi_arch=False)
 
         _cross_repo_mount.assert_has_calls([
             mock.call(
@@ -1468,6 +1836,75 @@ class TestPythonImageUploader(base.TestCase):
             session=target_session
         )
 
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_local_to_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.run_modify_playbook')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_registry_to_local')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_registry_to_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._cross_repo_mount')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_manifest',
+                return_value='{"layers": []}')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._image_exists', return_value=False)
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._detect_target_export')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.authenticate')
+    def test_run_tasks_modify_pipeline(
+            self, authenticate, _detect_target_export, _image_exists,
+            _fetch_manifest, _cross_repo_mount, _copy_registry_to_registry,
+            _copy_registry_to_local, run_modify_playbook,
+            _copy_local_to_registry):
+        running = collections.Counter()
+        max_running = collections.Counter()
+        overlap = set()
+        lock = threading.Lock()
+
+        def stage(name):
+            def run(*args, **kwargs):
+                with lock:
+                    running[name] += 1
+                    max_running[name] = max(max_running[name],
+                                            running[name])
+                    overlap.add(frozenset(s for s in running if running[s]))
+                time.sleep(0.02)
+                with lock:
+                    running[name] -= 1
+            return run
+
+        _copy_registry_to_local.side_effect = stage('pull')
+        run_modify_playbook.side_effect = stage('modify')
+        _copy_local_to_registry.side_effect = stage('push')
+
+        for i in range(6):
+            self.uploader.add_upload_task(image_uploader.UploadTask(
+                image_name='t/nova-api-%s:latest' % i,
+                pull_source='docker.io',
+                push_destination='localhost:8787',
+                append_tag='-modified',
+                modify_role='add-foo-plugin',
+                modify_vars={},
+                dry_run=False,
+                cleanup='none'
+            ))
+        with mock.patch.object(image_uploader.PythonImageUploader,
+                               'modify_pull_workers', 2):
+            with mock.patch.object(image_uploader.PythonImageUploader,
+                                   'modify_workers', 1):
+                self.uploader.run_tasks()
+
+        self.assertEqual(6, run_modify_playbook.call_count)
+        self.assertEqual(6, _copy_local_to_registry.call_count)
+        self.assertEqual(2, max_running['pull'])
+        self.assertEqual(1, max_running['modify'])
+        # images are pulled while another image is modified
+        self.assertIn(frozenset(['pull', 'modify']), overlap)
+
     def test_fetch_manifest(self):
         url = urlparse('docker://docker.io/t/nova-api:tripleo-current')
         manifest = '{"layers": []}'
@@ -1488,6 +1925,94 @@ class TestPythonImageUploader(base.TestCase):
             }
         )
 
+    def test_fetch_manifest_digest(self):
+        url = urlparse('docker://docker.io/t/nova-api:tripleo-current')
+        session = mock.Mock()
+        session.head.return_value.status_code = 200
+        session.head.return_value.headers = {
+            'Docker-Content-Digest': 'sha256:1234'
+        }
+        self.assertEqual(
+            'sha256:1234',
+            self.uploader._fetch_manifest_digest(url, session)
+        )
+        session.head.assert_called_once_with(
+            'https://registry-1.docker.io/v2/t/'
+            'nova-api/manifests/tripleo-current',
+            timeout=30,
+            headers={
+                'Accept': 'application/vnd.docker.distribution'
+                          '.manifest.v2+json, '
+                          'application/vnd.docker.distribution'
+                          '.manifest.list.v2+json, '
+                          'application/vnd.oci.image.index.v1+json'
+            }
+        )
+
+        session.head.return_value.status_code = 404
+        self.assertIsNone(
+            self.uploader._fetch_manifest_digest(url, session))
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._registry_blobs_exist')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_manifest')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_manifest_digest')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.authenticate')
+    def test_sync_tasks(self, authenticate, _fetch_manifest_digest,
+                        _fetch_manifest, _registry_blobs_exist):
+        digests = {
+            'docker.io/t/nova-api': 'sha256:aaaa',
+            'localhost:8787/t/nova-api': 'sha256:aaaa',
+            'docker.io/t/nova-compute': 'sha256:bbbb',
+            'localhost:8787/t/nova-compute': 'sha256:cccc',
+            'docker.io/t/heat-api': 'sha256:dddd',
+        }
+        _fetch_manifest_digest.side_effect = (
+            lambda url, session, multi_arch: (
+                digests.get(url.netloc + url.path.split(':')[0])))
+        _fetch_manifest.side_effect = lambda url, session: json.dumps({
+            'layers': [
+                {'digest': 'sha256:1111', 'size': 10},
+                {'digest': 'sha256:2222', 'size': 20},
+                {'digest': 'sha256:%s' % url.path, 'size': 5},
+            ]
+        })
+        _registry_blobs_exist.return_value = set(['sha256:1111'])
+
+        def add_task(image, dry_run=True, modify_role=None):
+            self.uploader.add_upload_task(image_uploader.UploadTask(
+                image_name=image,
+                pull_source='docker.io',
+                push_destination='localhost:8787',
+                append_tag=None,
+                modify_role=modify_role,
+                modify_vars=None,
+                dry_run=dry_run,
+                cleanup='full'
+            ))
+
+        add_task('t/nova-api:latest')
+        add_task('t/nova-compute:latest')
+        add_task('t/heat-api:latest')
+        add_task('t/nova-api:latest', modify_role='add-foo-plugin')
+
+        self.assertEqual(
+            {'images': 3, 'layers': 3, 'bytes': 30},
+            self.uploader.sync_tasks()
+        )
+        # unchanged images are skipped, modified images are always kept
+        self.assertEqual(
+            ['t/nova-compute:latest', 't/heat-api:latest',
+             't/nova-api:latest'],
+            [t.image_name for u, t in self.uploader.upload_tasks]
+        )
+        self.assertIsNotNone(self.uploader.upload_tasks[2][1].modify_role)
+        # the manifests of modified images are not fetched
+        self.assertEqual(2, _fetch_manifest.call_count)
+
     def test_upload_url(self):
         # test with previous request
         previous_request = mock.Mock()
@@ -1558,6 +2083,7 @@ class TestPythonImageUploader(base.TestCase):
         )
 
         # layer needs transferring
+        self.uploader.registry_blobs.clear()
         self.requests.head(
             'https://192.168.2.1:5000/v2/t/nova-api/blobs/sha256:aaaa',
             status_code=404
@@ -1593,83 +2119,816 @@ class TestPythonImageUploader(base.TestCase):
             layer
         )
 
-    def test_assert_scheme(self):
-        self.uploader._assert_scheme(
-            urlparse('docker://docker.io/foo/bar:latest'),
-            'docker'
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._upload_url')
+    def test_copy_layer_registry_to_registry_cached(self, _upload_url):
+        _upload_url.return_value = 'https://192.168.2.1:5000/v2/upload'
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        source_session = requests.Session()
+        target_session = requests.Session()
+
+        blob_data = six.b('The Blob')
+        calc_digest = hashlib.sha256()
+        calc_digest.update(blob_data)
+        blob_digest = 'sha256:' + calc_digest.hexdigest()
+
+        self.requests.head(
+            'https://192.168.2.1:5000/v2/t/nova-api/blobs/%s' % blob_digest,
+            status_code=404
         )
-        self.uploader._assert_scheme(
-            urlparse('containers-storage:foo/bar:latest'),
-            'containers-storage'
+        self.requests.put(
+            'https://192.168.2.1:5000/v2/upload',
         )
-        self.assertRaises(
-            ImageUploaderException,
-            self.uploader._assert_scheme,
-            urlparse('containers-storage:foo/bar:latest'),
-            'docker'
+        self.requests.patch(
+            'https://192.168.2.1:5000/v2/upload',
+        )
+        get_blob = self.requests.get(
+            'https://registry-1.docker.io/v2/t/nova-api/blobs/%s' %
+            blob_digest,
+            content=blob_data
         )
 
+        # first copy fetches from the source and populates the cache
+        layer = {'digest': blob_digest}
+        self.assertEqual(
+            blob_digest,
+            self.uploader._copy_layer_registry_to_registry(
+                source_url,
+                target_url,
+                layer,
+                source_session=source_session,
+                target_session=target_session
+            )
+        )
+        self.assertEqual(1, get_blob.call_count)
+        self.assertTrue(image_cache.blob_exists(blob_digest))
+
+        # second copy is served from the cache
+        self.uploader.registry_blobs.clear()
+        layer = {'digest': blob_digest}
+        self.assertEqual(
+            blob_digest,
+            self.uploader._copy_layer_registry_to_registry(
+                source_url,
+                target_url,
+                layer,
+                source_session=source_session,
+                target_session=target_session
+            )
+        )
+        self.assertEqual(1, get_blob.call_count)
+        self.assertEqual(len(blob_data), layer['size'])
+
     @mock.patch('tripleo_common.image.image_uploader.'
-                'PythonImageUploader._upload_url')
-    @mock.patch('tripleo_common.image.image_uploader.'
-                'PythonImageUploader.'
-                '_copy_layer_registry_to_registry')
-    def test_copy_registry_to_registry(self, _copy_layer, _upload_url):
-        source_url = urlparse('docker://docker.io/t/nova-api:latest')
-        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
-        _upload_url.return_value = 'https://192.168.2.1:5000/v2/upload'
+                'PythonImageUploader._target_layer_exists_registry',
+                return_value=False)
+    def test_copy_layer_registry_to_registry_export(self, _exists):
+        export_dir = image_export.IMAGE_EXPORT_DIR
+        temp_export_dir = tempfile.mkdtemp()
 
-        source_session = mock.Mock()
-        target_session = mock.Mock()
+        def restore_export_dir():
+            shutil.rmtree(temp_export_dir)
+            image_export.IMAGE_EXPORT_DIR = export_dir
 
-        source_session.get.return_value.text = '{}'
+        image_export.IMAGE_EXPORT_DIR = temp_export_dir
+        self.addCleanup(restore_export_dir)
 
-        manifest = json.dumps({
-            'config': {
-                'digest': 'sha256:1234'
-            },
-            'layers': [
-                {'digest': 'sha256:aaaa'},
-                {'digest': 'sha256:bbbb'},
-            ]
-        })
-        _copy_layer.side_effect = [
-            'sha256:aaaa',
-            'sha256:bbbb'
-        ]
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        self.uploader.export_registries.add('192.168.2.1:5000')
 
-        self.uploader._copy_registry_to_registry(
-            source_url, target_url, manifest,
-            source_session=source_session,
-            target_session=target_session
+        blob_data = six.b('The Blob')
+        calc_digest = hashlib.sha256()
+        calc_digest.update(blob_data)
+        blob_digest = 'sha256:' + calc_digest.hexdigest()
+        get_blob = self.requests.get(
+            'https://registry-1.docker.io/v2/t/nova-api/blobs/%s' %
+            blob_digest,
+            content=blob_data
         )
 
-        source_session.get.assert_called_once_with(
-            'https://registry-1.docker.io/v2/t/nova-api/blobs/sha256:1234',
-            timeout=30
+        # the layer is cached, then the cached blob is linked into the
+        # export directory
+        layer = {'digest': blob_digest}
+        self.assertEqual(
+            blob_digest,
+            self.uploader._copy_layer_registry_to_registry(
+                source_url,
+                target_url,
+                layer,
+                source_session=requests.Session(),
+                target_session=requests.Session()
+            )
         )
-        target_manifest = {
-            'config': {
-                'digest': 'sha256:1234',
-                'size': 2,
-                'mediaType': 'application/vnd.docker.container.image.v1+json'
-            },
-            'layers': [
-                {'digest': 'sha256:aaaa'},
-                {'digest': 'sha256:bbbb'},
-            ],
-            'mediaType': 'application/vnd.docker.'
-                         'distribution.manifest.v2+json',
-        }
+        self.assertEqual(1, get_blob.call_count)
+        self.assertEqual(len(blob_data), layer['size'])
+        blob_path = os.path.join(
+            temp_export_dir, 'v2/t/nova-api/blobs/%s.gz' % blob_digest)
+        self.assertTrue(os.path.samefile(
+            image_cache.blob_path(blob_digest), blob_path))
 
-        target_session.put.assert_has_calls([
-            mock.call(
-                'https://192.168.2.1:5000/v2/upload',
-                data='{}'.encode('utf-8'),
-                headers={
-                    'Content-Length':
-                    '2',
-                    'Content-Type':
+        # another image links the cached blob without fetching it
+        target_url = urlparse(
+            'docker://192.168.2.1:5000/t/nova-compute:latest')
+        layer = {'digest': blob_digest}
+        self.uploader._copy_layer_registry_to_registry(
+            source_url,
+            target_url,
+            layer,
+            source_session=requests.Session(),
+            target_session=requests.Session()
+        )
+        self.assertEqual(1, get_blob.call_count)
+        self.assertTrue(os.path.isfile(os.path.join(
+            temp_export_dir, 'v2/t/nova-compute/blobs/%s.gz' % blob_digest)))
+
+    def test_record_diff_ids(self):
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        layers = [{
+            'digest': 'sha256:aaaa',
+            'size': 10,
+            'mediaType': image_uploader.MEDIA_BLOB_COMPRESSED,
+        }, {
+            'digest': 'sha256:bbbb',
+        }]
+        config_str = json.dumps({
+            'rootfs': {'diff_ids': ['sha256:1111', 'sha256:2222']}
+        })
+        self.uploader._record_diff_ids(target_url, layers, config_str)
+        self.assertEqual({
+            ('192.168.2.1:5000', 'sha256:1111'): (layers[0], target_url),
+            ('192.168.2.1:5000', 'sha256:2222'): (layers[1], target_url),
+        }, self.uploader.diff_id_layers)
+
+        # configs which do not match the manifest are ignored
+        self.uploader.diff_id_layers.clear()
+        self.uploader._record_diff_ids(target_url, layers[:1], config_str)
+        self.uploader._record_diff_ids(target_url, layers, None)
+        self.assertEqual({}, self.uploader.diff_id_layers)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._layer_stream_local')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._cross_repo_mount')
+    def test_copy_layer_local_to_registry_known_diff_id(
+            self, _cross_repo_mount, _layer_stream_local):
+        target_url = urlparse(
+            'docker://192.168.2.1:5000/t/nova-api:latest-modified')
+        source_tag_url = urlparse(
+            'docker://192.168.2.1:5000/t/nova-api:latest')
+        target_session = requests.Session()
+        known_layer = {
+            'digest': 'sha256:remote',
+            'size': 10,
+            'mediaType': image_uploader.MEDIA_BLOB_COMPRESSED,
+        }
+        self.uploader.diff_id_layers[
+            ('192.168.2.1:5000', 'sha256:diff')] = (
+                known_layer, source_tag_url)
+        layer_entry = {
+            'compressed-diff-digest': 'sha256:recompressed',
+            'compressed-size': 12,
+            'diff-digest': 'sha256:diff',
+            'diff-size': 20,
+            'id': 'aaaa'
+        }
+        self.requests.head(
+            'https://192.168.2.1:5000/v2/t/nova-api/blobs/sha256:remote',
+            status_code=200
+        )
+        self.requests.head(
+            'https://192.168.2.1:5000/v2/t/nova-api/blobs/'
+            'sha256:recompressed',
+            status_code=404
+        )
+        self.requests.head(
+            'https://192.168.2.1:5000/v2/t/nova-api/blobs/sha256:diff',
+            status_code=404
+        )
+
+        layer = {'digest': 'sha256:recompressed'}
+        self.assertIsNone(self.uploader._copy_layer_local_to_registry(
+            target_url, target_session, layer, layer_entry))
+        # the remote layer is used instead of compressing the layer again
+        self.assertEqual(known_layer, layer)
+        _layer_stream_local.assert_not_called()
+        _cross_repo_mount.assert_called_once_with(
+            target_url, {'sha256:remote': source_tag_url},
+            ['sha256:remote'], session=target_session)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_stream_to_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._layer_stream_local')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._target_layer_exists_registry',
+                return_value=False)
+    def test_copy_layer_local_to_registry_cached(
+            self, _exists, _layer_stream_local, _copy_stream_to_registry):
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        blob_data = six.b('The Blob')
+        calc_digest = hashlib.sha256()
+        calc_digest.update(blob_data)
+        blob_digest = 'sha256:' + calc_digest.hexdigest()
+        with open(image_cache.blob_path(blob_digest), 'wb') as f:
+            f.write(blob_data)
+
+        layer = {'digest': 'sha256:1234'}
+        layer_entry = {
+            'id': 'aaaa',
+            'compressed-diff-digest': blob_digest,
+            'compressed-size': 8,
+            'diff-digest': 'sha256:1234',
+            'diff-size': 10,
+        }
+        session = mock.Mock()
+        self.uploader._copy_layer_local_to_registry(
+            target_url, session, layer, layer_entry)
+
+        # the cached compressed blob is uploaded instead of reassembling
+        # the layer
+        _layer_stream_local.assert_not_called()
+        self.assertEqual({'digest': blob_digest, 'size': 8}, layer)
+        target, l, digest, layer_stream, s = \
+            _copy_stream_to_registry.call_args[0]
+        self.assertEqual(blob_data, six.b('').join(layer_stream))
+        self.assertEqual(blob_digest, 'sha256:' + digest.hexdigest())
+
+    @mock.patch('time.sleep')
+    def test_layer_stream_registry_resume(self, mock_sleep):
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        blob_url = ('https://registry-1.docker.io/v2/t/nova-api/'
+                    'blobs/sha256:aaaa')
+
+        def failing_content(chunk_size):
+            yield six.b('The ')
+            raise requests.exceptions.ConnectionError('ouch')
+
+        first_req = mock.MagicMock()
+        first_req.__enter__.return_value = first_req
+        first_req.status_code = 200
+        first_req.iter_content = failing_content
+        second_req = mock.MagicMock()
+        second_req.__enter__.return_value = second_req
+        second_req.status_code = 206
+        second_req.iter_content.return_value = [six.b('Blob')]
+        session = mock.Mock()
+        session.get.side_effect = [first_req, second_req]
+
+        calc_digest = hashlib.sha256()
+        self.assertEqual(
+            [six.b('The '), six.b('Blob')],
+            list(self.uploader._layer_stream_registry(
+                'sha256:aaaa', source_url, calc_digest, session))
+        )
+        expected_digest = hashlib.sha256()
+        expected_digest.update(six.b('The Blob'))
+        self.assertEqual(expected_digest.hexdigest(),
+                         calc_digest.hexdigest())
+        session.get.assert_has_calls([
+            mock.call(blob_url, stream=True, timeout=30, headers={}),
+            mock.call(blob_url, stream=True, timeout=30,
+                      headers={'Range': 'bytes=4-'}),
+        ], any_order=True)
+
+        # a server which ignores the range resends from the start
+        first_req.iter_content = failing_content
+        second_req.status_code = 200
+        second_req.iter_content.return_value = [six.b('The Blob')]
+        session.get.side_effect = [first_req, second_req]
+        calc_digest = hashlib.sha256()
+        self.assertEqual(
+            [six.b('The '), six.b('Blob')],
+            list(self.uploader._layer_stream_registry(
+                'sha256:aaaa', source_url, calc_digest, session))
+        )
+        self.assertEqual(expected_digest.hexdigest(),
+                         calc_digest.hexdigest())
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._throttle')
+    def test_layer_stream_registry_throttle(self, _throttle):
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        blob_url = ('https://registry-1.docker.io/v2/t/nova-api/'
+                    'blobs/sha256:aaaa')
+        blob_req = mock.MagicMock()
+        blob_req.__enter__.return_value = blob_req
+        blob_req.status_code = 200
+        blob_req.iter_content.return_value = [six.b('The '), six.b('Blob')]
+        session = mock.Mock()
+        session.get.return_value = blob_req
+
+        list(self.uploader._layer_stream_registry(
+            'sha256:aaaa', source_url, hashlib.sha256(), session))
+        _throttle.assert_has_calls([
+            mock.call(blob_url, 'bytes', 4),
+            mock.call(blob_url, 'bytes', 4),
+        ])
+
+        # uploaded chunks are throttled for the upload host
+        _throttle.reset_mock()
+        upload_url = 'https://192.168.2.1:5000/v2/upload'
+        self.uploader._upload_chunk(
+            upload_url, six.b('The Blob'), 0, session)
+        _throttle.assert_called_once_with(upload_url, 'bytes', 8)
+
+    def test_resume_upload_chunk(self):
+        upload_url = 'https://192.168.2.1:5000/v2/upload'
+        session = mock.Mock()
+        status = mock.Mock()
+        status.headers = {
+            'Location': 'https://192.168.2.1:5000/v2/upload?state=1',
+            'Range': '0-5'
+        }
+        session.get.return_value = status
+
+        # the first 2 bytes of the chunk were received
+        self.uploader._resume_upload_chunk(
+            upload_url, six.b('The Blob'), 4, session)
+        session.get.assert_called_once_with(upload_url, timeout=30)
+        session.patch.assert_called_once_with(
+            'https://192.168.2.1:5000/v2/upload?state=1',
+            timeout=30,
+            data=six.b('e Blob'),
+            headers={
+                'Content-Length': '6',
+                'Content-Range': '6-11',
+                'Content-Type': 'application/octet-stream'
+            }
+        )
+
+        # the whole chunk was received
+        session.patch.reset_mock()
+        status.headers['Range'] = '0-11'
+        self.assertEqual(
+            status,
+            self.uploader._resume_upload_chunk(
+                upload_url, six.b('The Blob'), 4, session)
+        )
+        session.patch.assert_not_called()
+
+        # the upload session lost data, so the layer is uploaded again
+        # without asking the session again
+        session.get.reset_mock()
+        status.headers['Range'] = '0-1'
+        self.assertRaises(
+            image_uploader.UploadResumeException,
+            self.uploader._resume_upload_chunk,
+            upload_url, six.b('The Blob'), 4, session
+        )
+        session.get.assert_called_once_with(upload_url, timeout=30)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._upload_url')
+    def test_copy_stream_to_registry_resume(self, _upload_url):
+        _upload_url.return_value = 'https://192.168.2.1:5000/v2/upload'
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        blob_data = six.b('The Blob')
+        calc_digest = hashlib.sha256()
+        calc_digest.update(blob_data)
+        blob_digest = 'sha256:' + calc_digest.hexdigest()
+
+        self.requests.patch(
+            'https://192.168.2.1:5000/v2/upload', [
+                {'exc': requests.exceptions.ConnectionError('ouch')},
+                {'status_code': 202},
+            ]
+        )
+        self.requests.get(
+            'https://192.168.2.1:5000/v2/upload',
+            headers={'Range': '0-3'},
+            status_code=204
+        )
+        self.requests.put(
+            'https://192.168.2.1:5000/v2/upload?digest=%s' % blob_digest,
+        )
+        layer = {'digest': blob_digest}
+        self.assertEqual(
+            blob_digest,
+            self.uploader._copy_stream_to_registry(
+                target_url, layer, calc_digest, iter([blob_data]),
+                requests.Session())
+        )
+        patches = [r for r in self.requests.request_history
+                   if r.method == 'PATCH']
+        self.assertEqual('0-7', patches[0].headers['Content-Range'])
+        self.assertEqual('4-7', patches[1].headers['Content-Range'])
+        self.assertEqual(six.b('Blob'), patches[1].body)
+        self.assertEqual(len(blob_data), layer['size'])
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._upload_url')
+    def test_copy_stream_to_registry_resume_lost(self, _upload_url):
+        _upload_url.return_value = 'https://192.168.2.1:5000/v2/upload'
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        blob_data = six.b('The Blob')
+        calc_digest = hashlib.sha256()
+        calc_digest.update(blob_data)
+        blob_digest = 'sha256:' + calc_digest.hexdigest()
+
+        self.requests.patch(
+            'https://192.168.2.1:5000/v2/upload', [
+                {'status_code': 202},
+                {'exc': requests.exceptions.ConnectionError('ouch')},
+            ]
+        )
+        # the session lost part of the first chunk
+        status = self.requests.get(
+            'https://192.168.2.1:5000/v2/upload',
+            headers={'Range': '0-1'},
+            status_code=204
+        )
+        # a request exception lets the layer copy retry the whole layer,
+        # without asking the session again
+        layer = {'digest': blob_digest}
+        self.assertRaises(
+            requests.exceptions.RequestException,
+            self.uploader._copy_stream_to_registry,
+            target_url, layer, calc_digest,
+            iter([six.b('The '), six.b('Blob')]), requests.Session()
+        )
+        self.assertEqual(1, status.call_count)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._upload_url')
+    def test_copy_stream_to_registry_monolithic(self, _upload_url):
+        _upload_url.return_value = 'https://192.168.2.1:5000/v2/upload'
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        blob_data = six.b('The Blob')
+        calc_digest = hashlib.sha256()
+        calc_digest.update(blob_data)
+        blob_digest = 'sha256:' + calc_digest.hexdigest()
+
+        patch = self.requests.patch('https://192.168.2.1:5000/v2/upload')
+        put = self.requests.put(
+            'https://192.168.2.1:5000/v2/upload?digest=%s' % blob_digest)
+
+        # small layer is uploaded with a single PUT
+        layer = {'digest': blob_digest, 'size': len(blob_data)}
+        self.assertEqual(
+            blob_digest,
+            self.uploader._copy_stream_to_registry(
+                target_url, layer, calc_digest,
+                iter([six.b('The '), six.b('Blob')]), requests.Session())
+        )
+        self.assertFalse(patch.called)
+        self.assertEqual(1, put.call_count)
+        self.assertEqual(blob_data, put.last_request.body)
+        self.assertEqual(len(blob_data), layer['size'])
+        _upload_url.assert_called_once_with(target_url, mock.ANY)
+
+        # layer bigger than the threshold falls back to a chunked upload
+        layer = {'digest': blob_digest, 'size': 4}
+        with mock.patch.object(image_uploader.PythonImageUploader,
+                               'monolithic_upload_size', 6):
+            self.assertEqual(
+                blob_digest,
+                self.uploader._copy_stream_to_registry(
+                    target_url, layer, calc_digest,
+                    iter([six.b('The '), six.b('Bl'), six.b('ob')]),
+                    requests.Session())
+            )
+        self.assertEqual(3, patch.call_count)
+        self.assertEqual(2, put.call_count)
+        self.assertIsNone(put.last_request.body)
+        self.assertEqual(len(blob_data), layer['size'])
+
+    def test_registry_blobs_exist(self):
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        other_url = urlparse('docker://192.168.2.1:5000/t/heat-api:latest')
+        session = requests.Session()
+        head_aaaa = self.requests.head(
+            'https://192.168.2.1:5000/v2/t/nova-api/blobs/sha256:aaaa',
+            status_code=200
+        )
+        head_bbbb = self.requests.head(
+            'https://192.168.2.1:5000/v2/t/nova-api/blobs/sha256:bbbb',
+            status_code=404
+        )
+        self.uploader._registry_blob_added(target_url, 'sha256:cccc')
+
+        self.assertEqual(
+            set(['sha256:aaaa', 'sha256:cccc']),
+            self.uploader._registry_blobs_exist(
+                target_url, ['sha256:aaaa', 'sha256:bbbb', 'sha256:cccc'],
+                session)
+        )
+        self.assertEqual(1, head_aaaa.call_count)
+        self.assertEqual(1, head_bbbb.call_count)
+
+        # results are answered from the cache
+        self.assertEqual(
+            set(['sha256:aaaa']),
+            self.uploader._registry_blobs_exist(
+                target_url, ['sha256:aaaa', 'sha256:bbbb'], session)
+        )
+        self.assertEqual(1, head_aaaa.call_count)
+        self.assertEqual(1, head_bbbb.call_count)
+        self.assertTrue(
+            self.uploader._registry_blob_known(target_url, 'sha256:aaaa'))
+        self.assertFalse(
+            self.uploader._registry_blob_known(target_url, 'sha256:bbbb'))
+        self.assertIsNone(
+            self.uploader._registry_blob_known(other_url, 'sha256:aaaa'))
+
+        # missing results expire
+        with mock.patch.object(image_uploader.PythonImageUploader,
+                               'missing_blobs_ttl', 0):
+            self.assertIsNone(
+                self.uploader._registry_blob_known(
+                    target_url, 'sha256:bbbb'))
+
+        # an upload replaces a missing result
+        self.uploader._registry_blob_added(target_url, 'sha256:bbbb')
+        self.assertTrue(
+            self.uploader._registry_blob_known(target_url, 'sha256:bbbb'))
+
+    def test_assert_scheme(self):
+        self.uploader._assert_scheme(
+            urlparse('docker://docker.io/foo/bar:latest'),
+            'docker'
+        )
+        self.uploader._assert_scheme(
+            urlparse('containers-storage:foo/bar:latest'),
+            'containers-storage'
+        )
+        self.assertRaises(
+            ImageUploaderException,
+            self.uploader._assert_scheme,
+            urlparse('containers-storage:foo/bar:latest'),
+            'docker'
+        )
+
+    def test_init_platforms(self):
+        u = image_uploader.PythonImageUploader
+        self.addCleanup(u.init_platforms)
+        u.init_platforms(['x86_64', 'linux/ppc64le', 'linux/arm64/v8'])
+        self.assertEqual(
+            set(['linux/amd64', 'linux/ppc64le', 'linux/arm64/v8']),
+            u.platforms)
+        self.assertRaises(ImageUploaderException, u.init_platforms,
+                          ['linux/arm/v7/extra'])
+
+        # managers only apply their platforms when a run starts
+        u.init_platforms(['x86_64'])
+        manager = image_uploader.ImageUploadManager(platforms=['aarch64'])
+        self.assertEqual(set(['linux/amd64']), u.platforms)
+        manager.init_uploaders()
+        self.assertEqual(set(['linux/arm64']), u.platforms)
+        image_uploader.ImageUploadManager().init_uploaders()
+        self.assertEqual(set(), u.platforms)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_manifest')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_manifest_digest')
+    def test_image_in_sync(self, _fetch_manifest_digest, _fetch_manifest):
+        u = image_uploader.PythonImageUploader
+        self.addCleanup(u.init_platforms)
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        target_url = urlparse('docker://localhost:8787/t/nova-api:latest')
+        session = mock.Mock()
+        entries = [
+            {'digest': 'sha256:%s' % arch,
+             'platform': {'os': 'linux', 'architecture': arch}}
+            for arch in ('amd64', 'ppc64le', 's390x')
+        ]
+        manifests = {
+            'docker.io': {
+                'mediaType': image_uploader.MEDIA_MANIFEST_LIST,
+                'manifests': entries
+            },
+            'localhost:8787': {
+                'mediaType': image_uploader.MEDIA_MANIFEST_LIST,
+                'manifests': entries[:2]
+            },
+        }
+        _fetch_manifest.side_effect = lambda url, session, multi_arch: (
+            json.dumps(manifests[url.netloc]))
+
+        # the default platform manifests are compared
+        _fetch_manifest_digest.side_effect = ['sha256:aaaa', 'sha256:aaaa']
+        self.assertTrue(u._image_in_sync(
+            source_url, target_url, session, session))
+        _fetch_manifest_digest.assert_called_with(
+            target_url, session, multi_arch=False)
+        _fetch_manifest_digest.side_effect = ['sha256:aaaa', 'sha256:bbbb']
+        self.assertFalse(u._image_in_sync(
+            source_url, target_url, session, session))
+        _fetch_manifest.assert_not_called()
+
+        # a filtered list is compared by its platform manifests
+        u.init_platforms(['x86_64', 'ppc64le'])
+        _fetch_manifest_digest.side_effect = ['sha256:list', 'sha256:other']
+        self.assertTrue(u._image_in_sync(
+            source_url, target_url, session, session))
+        u.init_platforms(['x86_64'])
+        _fetch_manifest_digest.side_effect = ['sha256:list', 'sha256:other']
+        self.assertFalse(u._image_in_sync(
+            source_url, target_url, session, session))
+
+        # missing images are not in sync
+        _fetch_manifest_digest.side_effect = ['sha256:list', None]
+        self.assertFalse(u._image_in_sync(
+            source_url, target_url, session, session))
+
+    def test_select_platforms(self):
+        u = image_uploader.PythonImageUploader
+        self.addCleanup(u.init_platforms)
+        manifest_list = {'manifests': [
+            {'digest': 'sha256:aaaa',
+             'platform': {'os': 'linux', 'architecture': 'amd64'}},
+            {'digest': 'sha256:bbbb',
+             'platform': {'os': 'linux', 'architecture': 'arm64',
+                          'variant': 'v8'}},
+        ]}
+        # without platforms, only the platform of this host
+        with mock.patch('os.uname', return_value=(
+                'Linux', 'host', '', '', 'aarch64')):
+            self.assertEqual(manifest_list['manifests'][1:],
+                             u._select_platforms(manifest_list))
+        u.init_platforms(['all'])
+        self.assertEqual(manifest_list['manifests'],
+                         u._select_platforms(manifest_list))
+        u.init_platforms(['linux/arm64/v8'])
+        self.assertEqual(manifest_list['manifests'][1:],
+                         u._select_platforms(manifest_list))
+        u.init_platforms(['ppc64le'])
+        self.assertRaises(ImageUploaderException,
+                          u._select_platforms, manifest_list)
+
+        self.assertTrue(u._is_manifest_list(manifest_list))
+        self.assertFalse(u._is_manifest_list({'layers': []}))
+
+    def test_fetch_platform_manifest(self):
+        url = urlparse('docker://docker.io/t/nova-api:latest')
+        manifest = six.b('{"layers": []}')
+        digest = 'sha256:%s' % hashlib.sha256(manifest).hexdigest()
+        entry = {'digest': digest,
+                 'mediaType': image_uploader.MEDIA_OCI_MANIFEST}
+        session = mock.Mock()
+        session.get.return_value.status_code = 200
+        session.get.return_value.content = manifest
+        self.assertEqual(
+            '{"layers": []}',
+            self.uploader._fetch_platform_manifest(url, entry, session))
+        session.get.assert_called_once_with(
+            'https://registry-1.docker.io/v2/t/nova-api/manifests/%s' %
+            digest,
+            timeout=30,
+            headers={'Accept': image_uploader.MEDIA_OCI_MANIFEST}
+        )
+
+        entry['digest'] = 'sha256:1234'
+        self.assertRaises(ImageUploaderException,
+                          self.uploader._fetch_platform_manifest,
+                          url, entry, session)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._upload_url',
+                return_value='https://192.168.2.1:5000/v2/upload')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._registry_blobs_exist',
+                return_value=set())
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_layer_registry_to_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_config',
+                return_value='{}')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_platform_manifest')
+    def test_copy_manifest_list_to_registry(
+            self, _fetch_platform_manifest, _fetch_config, _copy_layer,
+            _registry_blobs_exist, _upload_url):
+        self.addCleanup(self.uploader.init_platforms)
+        self.uploader.init_platforms(['x86_64', 'ppc64le'])
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        source_session = mock.Mock()
+        target_session = mock.Mock()
+
+        manifests = {}
+        entries = []
+        for arch, layer in (('amd64', 'sha256:aaaa'),
+                            ('ppc64le', 'sha256:bbbb'),
+                            ('s390x', 'sha256:cccc')):
+            manifest_str = json.dumps({
+                'config': {'digest': 'sha256:%s' % arch},
+                'layers': [{'digest': 'sha256:shared'}, {'digest': layer}]
+            })
+            digest = 'sha256:%s' % hashlib.sha256(
+                manifest_str.encode('utf-8')).hexdigest()
+            manifests[digest] = manifest_str
+            entries.append({
+                'digest': digest,
+                'mediaType': image_uploader.MEDIA_MANIFEST_V2,
+                'platform': {'os': 'linux', 'architecture': arch}
+            })
+        _fetch_platform_manifest.side_effect = (
+            lambda url, entry, session: manifests[entry['digest']])
+        manifest_list = {
+            'schemaVersion': 2,
+            'mediaType': image_uploader.MEDIA_MANIFEST_LIST,
+            'manifests': entries
+        }
+
+        self.uploader._copy_registry_to_registry(
+            source_url, target_url, json.dumps(manifest_list),
+            source_session=source_session,
+            target_session=target_session
+        )
+
+        # the layer shared by both platforms is only copied once
+        self.assertEqual(
+            ['sha256:aaaa', 'sha256:bbbb', 'sha256:shared'],
+            sorted(c[1]['layer']['digest']
+                   for c in _copy_layer.call_args_list))
+
+        put_urls = [c[0][0] for c in target_session.put.call_args_list]
+        self.assertEqual(5, len(put_urls))
+        # platform manifests are pushed unchanged by digest
+        for entry in entries[:2]:
+            url = ('https://192.168.2.1:5000/v2/t/nova-api/manifests/%s' %
+                   entry['digest'])
+            self.assertIn(url, put_urls)
+            call = target_session.put.call_args_list[put_urls.index(url)]
+            self.assertEqual(manifests[entry['digest']].encode('utf-8'),
+                             call[1]['data'])
+
+        # the list is pushed last, without the platforms not selected
+        self.assertEqual(
+            'https://192.168.2.1:5000/v2/t/nova-api/manifests/latest',
+            put_urls[-1])
+        put_list = target_session.put.call_args
+        self.assertEqual(
+            {'Content-Type': image_uploader.MEDIA_MANIFEST_LIST},
+            put_list[1]['headers'])
+        self.assertEqual(
+            entries[:2],
+            json.loads(put_list[1]['data'].decode('utf-8'))['manifests'])
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._upload_url')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.'
+                '_copy_layer_registry_to_registry')
+    def test_copy_registry_to_registry(self, _copy_layer, _upload_url):
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        _upload_url.return_value = 'https://192.168.2.1:5000/v2/upload'
+
+        source_session = mock.Mock()
+        target_session = mock.Mock()
+
+        source_session.get.return_value.text = '{}'
+
+        manifest = json.dumps({
+            'config': {
+                'digest': 'sha256:1234'
+            },
+            'layers': [
+                {'digest': 'sha256:aaaa'},
+                {'digest': 'sha256:bbbb'},
+            ]
+        })
+        _copy_layer.side_effect = [
+            'sha256:aaaa',
+            'sha256:bbbb'
+        ]
+
+        self.uploader._copy_registry_to_registry(
+            source_url, target_url, manifest,
+            source_session=source_session,
+            target_session=target_session
+        )
+
+        source_session.get.assert_called_once_with(
+            'https://registry-1.docker.io/v2/t/nova-api/blobs/sha256:1234',
+            timeout=30
+        )
+        target_manifest = {
+            'config': {
+                'digest': 'sha256:1234',
+                'size': 2,
+                'mediaType': 'application/vnd.docker.container.image.v1+json'
+            },
+            'layers': [
+                {'digest': 'sha256:aaaa'},
+                {'digest': 'sha256:bbbb'},
+            ],
+            'mediaType': 'application/vnd.docker.'
+                         'distribution.manifest.v2+json',
+        }
+
+        target_session.put.assert_has_calls([
+            mock.call(
+                'https://192.168.2.1:5000/v2/upload',
+                data='{}'.encode('utf-8'),
+                headers={
+                    'Content-Length':
+                    '2',
+                    'Content-Type':
                     'application/octet-stream'
                 },
                 params={'digest': 'sha256:1234'},
@@ -1692,6 +2951,240 @@ class TestPythonImageUploader(base.TestCase):
         )
         self.assertEqual(target_manifest, put_manifest)
 
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_manifest_config_to_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._cross_repo_mount')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.'
+                '_copy_layer_registry_to_registry')
+    def test_copy_registry_to_registry_shared_layers(
+            self, _copy_layer, _cross_repo_mount, _copy_manifest_config):
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        source_url2 = urlparse('docker://docker.io/t/nova-compute:latest')
+        target_url2 = urlparse(
+            'docker://192.168.2.1:5000/t/nova-compute:latest')
+
+        source_session = mock.Mock()
+        source_session.get.return_value.text = '{}'
+        target_session = mock.Mock()
+        _copy_layer.side_effect = lambda *args, **kwargs: (
+            kwargs['layer']['digest'])
+
+        manifest = json.dumps({
+            'config': {
+                'digest': 'sha256:1234'
+            },
+            'layers': [
+                {'digest': 'sha256:aaaa'},
+                {'digest': 'sha256:bbbb'},
+            ]
+        })
+        manifest2 = json.dumps({
+            'config': {
+                'digest': 'sha256:5678'
+            },
+            'layers': [
+                {'digest': 'sha256:aaaa'},
+                {'digest': 'sha256:cccc'},
+            ]
+        })
+
+        self.uploader._copy_registry_to_registry(
+            source_url, target_url, manifest,
+            source_session=source_session,
+            target_session=target_session
+        )
+        self.uploader._copy_registry_to_registry(
+            source_url2, target_url2, manifest2,
+            source_session=source_session,
+            target_session=target_session
+        )
+
+        # the shared layer is only copied once
+        self.assertEqual(
+            ['sha256:aaaa', 'sha256:bbbb', 'sha256:cccc'],
+            sorted(c[1]['layer']['digest']
+                   for c in _copy_layer.call_args_list)
+        )
+        # then mounted into the second image
+        _cross_repo_mount.assert_called_once_with(
+            target_url2, {'sha256:aaaa': target_url}, ['sha256:aaaa'],
+            session=target_session
+        )
+        self.assertEqual(2, _copy_manifest_config.call_count)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_config_to_registry')
+    def test_copy_manifest_config_to_registry_unchanged(self, _copy_config):
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        target_session = mock.Mock()
+        config_str = '{"config": {}}'
+        # compact, as written by buildah and most registries
+        manifest_str = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': image_uploader.MEDIA_MANIFEST_V2,
+            'config': {
+                'mediaType': image_uploader.MEDIA_CONFIG,
+                'size': len(config_str),
+                'digest': 'sha256:1234'
+            },
+            'layers': [{'digest': 'sha256:aaaa'}]
+        }, separators=(',', ':'))
+
+        self.uploader._copy_manifest_config_to_registry(
+            target_url, manifest_str, config_str,
+            target_session=target_session)
+
+        # the source bytes are pushed, so the target has the same digest
+        # as the source, which sync compares
+        target_session.put.assert_called_once_with(
+            'https://192.168.2.1:5000/v2/t/nova-api/manifests/latest',
+            data=manifest_str.encode('utf-8'),
+            headers={'Content-Type': image_uploader.MEDIA_MANIFEST_V2},
+            timeout=30)
+
+        # a manifest which needs changes is serialized again
+        target_session.reset_mock()
+        manifest = json.loads(manifest_str)
+        del manifest['config']['size']
+        self.uploader._copy_manifest_config_to_registry(
+            target_url, json.dumps(manifest), config_str,
+            target_session=target_session)
+        put_manifest = json.loads(
+            target_session.put.call_args[1]['data'].decode('utf-8'))
+        self.assertEqual(len(config_str), put_manifest['config']['size'])
+
+    def test_registry_blobs_forgotten(self):
+        u = self.uploader
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        other_url = urlparse('docker://192.168.2.1:5000/t/heat-api:latest')
+        u._registry_blob_added(target_url, 'sha256:aaaa')
+        u._registry_blob_added(other_url, 'sha256:aaaa')
+
+        # a manifest which references lost blobs is rejected
+        session = mock.Mock()
+        session.put.return_value.status_code = 400
+        session.put.return_value.text = (
+            '{"errors": [{"code": "MANIFEST_BLOB_UNKNOWN"}]}')
+        self.assertRaises(
+            ImageUploaderException, u._put_manifest, target_url, 'latest',
+            '{}', image_uploader.MEDIA_MANIFEST_V2, session)
+        self.assertIsNone(u._registry_blob_known(target_url, 'sha256:aaaa'))
+        self.assertTrue(u._registry_blob_known(other_url, 'sha256:aaaa'))
+
+        # a new run checks the registry again
+        u.run_tasks()
+        self.assertIsNone(u._registry_blob_known(other_url, 'sha256:aaaa'))
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_layer_registry_to_registry')
+    def test_schedule_layer_copy_per_run(self, _copy_layer):
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        layer = {'digest': 'sha256:aaaa'}
+
+        job, job_target_url = self.uploader._schedule_layer_copy(
+            source_url, target_url, layer)
+        job.result()
+        self.assertEqual(target_url, job_target_url)
+        self.assertEqual(
+            (job, target_url),
+            self.uploader._schedule_layer_copy(source_url, target_url, layer))
+        # sessions are looked up when the copy runs
+        _copy_layer.assert_called_once_with(
+            source_url, target_url, layer=layer)
+
+        # a later run copies the layer again
+        self.uploader.run_tasks()
+        job2, job_target_url = self.uploader._schedule_layer_copy(
+            source_url, target_url, layer)
+        job2.result()
+        self.assertIsNot(job, job2)
+        self.assertEqual(2, _copy_layer.call_count)
+
+    def test_schedule_layer_job(self):
+        u = self.uploader
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        layer = {'digest': 'sha256:aaaa'}
+        jobs = {}
+        failed = futures.Future()
+        submit = mock.Mock(return_value=failed)
+
+        self.assertEqual((failed, target_url),
+                         u._schedule_layer_job(jobs, target_url, layer,
+                                               submit))
+        self.assertEqual((failed, target_url),
+                         u._schedule_layer_job(jobs, target_url, layer,
+                                               submit))
+        submit.assert_called_once_with()
+
+        # a failed copy is forgotten
+        failed.set_exception(requests.exceptions.ConnectionError('ouch'))
+        self.assertEqual({}, jobs)
+
+    def test_manifest_layers(self):
+        u = self.uploader
+        layers = [{'digest': 'sha256:aaaa'}, {'digest': 'sha256:bbbb'}]
+        self.assertEqual(
+            (layers, 'sha256:1234'),
+            u._manifest_layers({
+                'config': {'digest': 'sha256:1234'},
+                'layers': layers
+            }))
+        self.assertEqual(
+            (layers, None),
+            u._manifest_layers({
+                'schemaVersion': 1,
+                'fsLayers': [{'blobSum': 'sha256:bbbb'},
+                             {'blobSum': 'sha256:aaaa'}]
+            }))
+
+    def test_unknown_layers(self):
+        u = self.uploader
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        u._registry_blob_added(target_url, 'sha256:aaaa')
+        layers = [{'digest': 'sha256:aaaa'}, {'digest': 'sha256:bbbb'},
+                  {'digest': 'sha256:bbbb'}]
+        self.assertEqual(['sha256:bbbb'],
+                         u._unknown_layers(target_url, layers))
+
+        u.export_registries.add('192.168.2.1:5000')
+        self.addCleanup(u.export_registries.discard, '192.168.2.1:5000')
+        self.assertEqual([], u._unknown_layers(target_url, layers))
+
+    def test_layer_mounts(self):
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        other_url = urlparse('docker://192.168.2.1:5000/t/nova-base:latest')
+        layers = [{'digest': 'sha256:aaaa'}, {'digest': 'sha256:bbbb'}]
+        self.assertEqual(
+            [('sha256:aaaa', other_url)],
+            self.uploader._layer_mounts(target_url, layers,
+                                        [other_url, target_url]))
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._target_layer_exists_registry',
+                return_value=True)
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.authenticate')
+    def test_copy_layer_registry_to_registry_authenticates(
+            self, authenticate, _target_layer_exists_registry):
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        layer = {'digest': 'sha256:aaaa'}
+        target_session = mock.Mock()
+        authenticate.side_effect = [mock.Mock(), target_session]
+
+        self.uploader._copy_layer_registry_to_registry(
+            source_url, target_url, layer=layer)
+        authenticate.assert_has_calls([
+            mock.call(source_url),
+            mock.call(target_url),
+        ])
+        _target_layer_exists_registry.assert_called_once_with(
+            target_url, layer, [layer], target_session)
+
     @mock.patch('os.environ')
     @mock.patch('subprocess.Popen')
     def test_copy_registry_to_local(self, mock_popen, mock_environ):
@@ -1721,11 +3214,14 @@ class TestPythonImageUploader(base.TestCase):
         self.assertEqual(mock_failure.communicate.call_count, 4)
         self.assertEqual(mock_success.communicate.call_count, 1)
 
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.layer_compress_workers', 1)
     @mock.patch('os.path.exists')
-    @mock.patch('subprocess.Popen')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._tar_split_asm')
     @mock.patch('tripleo_common.image.image_uploader.'
                 'PythonImageUploader._upload_url')
-    def test_copy_layer_local_to_registry(self, _upload_url, mock_popen,
+    def test_copy_layer_local_to_registry(self, _upload_url, _tar_split_asm,
                                           mock_exists):
         mock_exists.return_value = True
         _upload_url.return_value = 'https://192.168.2.1:5000/v2/upload'
@@ -1738,7 +3234,8 @@ class TestPythonImageUploader(base.TestCase):
         calc_digest.update(blob_data)
         blob_digest = 'sha256:' + calc_digest.hexdigest()
 
-        blob_compressed = zlib.compress(blob_data)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        blob_compressed = compressor.compress(blob_data) + compressor.flush()
         calc_digest = hashlib.sha256()
         calc_digest.update(blob_compressed)
         compressed_digest = 'sha256:' + calc_digest.hexdigest()
@@ -1770,10 +3267,9 @@ class TestPythonImageUploader(base.TestCase):
         )
 
         # layer needs uploading
-        mock_success = mock.Mock()
-        mock_success.stdout = io.BytesIO(blob_compressed)
-        mock_success.returncode = 0
-        mock_popen.return_value = mock_success
+        self.uploader.registry_blobs.clear()
+        self.uploader.missing_blobs.clear()
+        _tar_split_asm.return_value = (d for d in [blob_data])
 
         target_session = requests.Session()
         self.requests.head(
@@ -1803,14 +3299,10 @@ class TestPythonImageUploader(base.TestCase):
             )
         )
         # test tar-split assemble call
-        mock_popen.assert_called_once_with([
-            'tar-split', 'asm',
-            '--input',
+        _tar_split_asm.assert_called_once_with(
             '/var/lib/containers/storage/overlay-layers/aaaa.tar-split.gz',
-            '--path',
-            '/var/lib/containers/storage/overlay/aaaa/diff',
-            '--compress'
-        ], stdout=-1)
+            '/var/lib/containers/storage/overlay/aaaa/diff'
+        )
 
         # test side-effect of layer being fully populated
         self.assertEqual({
@@ -1820,6 +3312,181 @@ class TestPythonImageUploader(base.TestCase):
             layer
         )
 
+    def _make_layer(self):
+        """Write a layer tar, its tar-split metadata and its diff directory
+        """
+        layer_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, layer_dir)
+        diff_path = os.path.join(layer_dir, 'diff')
+        os.makedirs(os.path.join(diff_path, 'etc'))
+        files = {
+            'etc/motd': six.b('Welcome\n'),
+            'etc/empty': six.b(''),
+            'blob': os.urandom(65536),
+        }
+        for name, data in files.items():
+            with open(os.path.join(diff_path, name), 'wb') as f:
+                f.write(data)
+        os.symlink('motd', os.path.join(diff_path, 'etc/issue'))
+
+        tar_buf = io.BytesIO()
+        with tarfile.open(fileobj=tar_buf, mode='w',
+                          format=tarfile.PAX_FORMAT) as tar:
+            for name in ('etc', 'etc/motd', 'etc/empty', 'etc/issue',
+                         'blob'):
+                tar.add(os.path.join(diff_path, name), arcname=name,
+                        recursive=False)
+        tar_data = tar_buf.getvalue()
+
+        entries = []
+        pos = 0
+        tar_buf.seek(0)
+        with tarfile.open(fileobj=tar_buf, mode='r') as tar:
+            for member in tar.getmembers():
+                entries.append({
+                    'type': 2,
+                    'payload': base64.b64encode(
+                        tar_data[pos:member.offset_data]).decode('ascii')
+                })
+                entries.append({
+                    'type': 1,
+                    'name': member.name,
+                    'size': member.size if member.isfile() else 0,
+                })
+                pos = member.offset_data
+                if member.isfile():
+                    pos += member.size
+        entries.append({
+            'type': 2,
+            'payload': base64.b64encode(tar_data[pos:]).decode('ascii')
+        })
+        tar_split_path = os.path.join(layer_dir, 'layer.tar-split.gz')
+        with gzip.open(tar_split_path, 'wb') as f:
+            for entry in entries:
+                f.write(six.b(json.dumps(entry) + '\n'))
+        return tar_data, tar_split_path, diff_path
+
+    def test_tar_split_asm(self):
+        tar_data, tar_split_path, diff_path = self._make_layer()
+        self.assertEqual(
+            tar_data,
+            six.b('').join(self.uploader._tar_split_asm(
+                tar_split_path, diff_path))
+        )
+
+    def test_tar_split_path(self):
+        tar_data, tar_split_path, diff_path = self._make_layer()
+        root = os.path.realpath(diff_path)
+        u = self.uploader
+        motd = os.path.join(root, 'etc/motd')
+        self.assertEqual(motd, u._tar_split_path(root, 'etc/motd'))
+        self.assertEqual(motd, u._tar_split_path(root, './etc/motd'))
+        # absolute names are joined under the diff directory
+        self.assertEqual(motd, u._tar_split_path(root, '/etc/motd'))
+        self.assertEqual(motd, u._tar_split_path(root, 'etc/../etc/motd'))
+        self.assertEqual(six.b(motd),
+                         u._tar_split_path(six.b(root), six.b('/etc/motd')))
+
+        # names outside of the diff directory are rejected
+        for name in ('../../etc/passwd', 'etc/../../diff2/motd',
+                     '/..', six.b('../etc/passwd')):
+            self.assertRaises(
+                ImageUploaderException, u._tar_split_path,
+                six.b(root) if isinstance(name, bytes) else root, name)
+
+        # including through a symlink out of the diff directory
+        os.symlink('/etc', os.path.join(diff_path, 'host'))
+        self.assertRaises(ImageUploaderException,
+                          u._tar_split_path, root, 'host/passwd')
+
+    def test_compress_stream(self):
+        data = [os.urandom(3000) for i in range(20)] + [six.b('a') * 50000]
+        u = image_uploader.PythonImageUploader
+        self.addCleanup(u.init_compression)
+
+        u.init_compression(compress_workers=1)
+        with mock.patch.object(u, 'chunk_size', 8192):
+            serial = six.b('').join(u._compress_stream(iter(data)))
+        self.assertEqual(six.b('').join(data), zlib.decompress(serial, 31))
+
+        u.init_compression(compress_level=1, compress_workers=4)
+        self.assertEqual(1, u.layer_compress_level)
+        with mock.patch.object(u, 'chunk_size', 8192):
+            chunks = list(u._compress_stream(iter(data)))
+        # header, one block for every 8k of data, then the trailer
+        self.assertEqual(image_uploader.GZIP_HEADER, chunks[0])
+        self.assertEqual(2 + 14, len(chunks))
+        parallel = six.b('').join(chunks)
+        self.assertNotEqual(serial, parallel)
+        self.assertEqual(six.b('').join(data), zlib.decompress(parallel, 31))
+        with gzip.GzipFile(fileobj=io.BytesIO(parallel)) as f:
+            self.assertEqual(six.b('').join(data), f.read())
+
+        # empty layers are valid too
+        empty = six.b('').join(u._compress_stream(iter([])))
+        self.assertEqual(six.b(''), zlib.decompress(empty, 31))
+
+    def test_init_compression(self):
+        u = image_uploader.PythonImageUploader
+        self.addCleanup(u.init_compression)
+        u.init_compression(compress_level=9, compress_workers=3)
+        self.assertEqual(9, u.layer_compress_level)
+        self.assertEqual(3, u.layer_compress_workers)
+        executor = u._compress_executor()
+        self.assertIs(executor, u._compress_executor())
+
+        # changing the workers replaces the executor
+        u.init_compression(compress_workers=2)
+        self.assertEqual(image_uploader.DEFAULT_COMPRESS_LEVEL,
+                         u.layer_compress_level)
+        self.assertIsNot(executor, u._compress_executor())
+
+        self.assertRaises(ImageUploaderException, u.init_compression,
+                          compress_level=10)
+        self.assertRaises(ImageUploaderException, u.init_compression,
+                          compress_workers=0)
+
+        manager = image_uploader.ImageUploadManager(compress_level=1,
+                                                    compress_workers=5)
+        self.assertEqual(image_uploader.DEFAULT_COMPRESS_LEVEL,
+                         u.layer_compress_level)
+        manager.init_uploaders()
+        self.assertEqual(1, u.layer_compress_level)
+        self.assertEqual(5, u.layer_compress_workers)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._containers_file_path')
+    def test_layer_stream_local(self, _containers_file_path):
+        tar_data, tar_split_path, diff_path = self._make_layer()
+        _containers_file_path.side_effect = [tar_split_path, diff_path]
+
+        calc_digest = hashlib.sha256()
+        with mock.patch.object(image_uploader.PythonImageUploader,
+                               'chunk_size', 1024):
+            chunks = list(self.uploader._layer_stream_local(
+                'aaaa', calc_digest))
+        self.assertTrue(len(chunks) > 1)
+        compressed = six.b('').join(chunks)
+        self.assertEqual(tar_data, zlib.decompress(compressed, 31))
+        self.assertEqual(hashlib.sha256(compressed).hexdigest(),
+                         calc_digest.hexdigest())
+        _containers_file_path.assert_has_calls([
+            mock.call('overlay-layers', 'aaaa.tar-split.gz'),
+            mock.call('overlay', 'aaaa', 'diff'),
+        ])
+
+        # a file which changed size since the layer was committed
+        with open(os.path.join(diff_path, 'blob'), 'wb') as f:
+            f.write(six.b('The'))
+        _containers_file_path.side_effect = [tar_split_path, diff_path]
+        self.assertRaises(
+            ImageUploaderException,
+            list,
+            self.uploader._layer_stream_local('aaaa', hashlib.sha256())
+        )
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._containers_file_signature')
     @mock.patch('tripleo_common.image.image_uploader.'
                 'PythonImageUploader._image_manifest_config')
     @mock.patch('tripleo_common.image.image_uploader.'
@@ -1830,7 +3497,8 @@ class TestPythonImageUploader(base.TestCase):
                 'PythonImageUploader._upload_url')
     def test_copy_local_to_registry(self, _upload_url, _containers_json,
                                     _copy_layer_local_to_registry,
-                                    _image_manifest_config):
+                                    _image_manifest_config,
+                                    _containers_file_signature):
         source_url = urlparse('containers-storage:/t/nova-api:latest')
         target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
         target_session = requests.Session()
@@ -1955,11 +3623,15 @@ class TestPythonImageUploader(base.TestCase):
                     'overlay-layers', 'layers.json')
             )
 
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._containers_file_signature',
+                return_value=(1, 100, 1000.0))
     @mock.patch('tripleo_common.image.image_uploader.'
                 'PythonImageUploader._containers_json')
     @mock.patch('tripleo_common.image.image_uploader.'
                 'PythonImageUploader._containers_file')
-    def test_image_manifest_config(self, _containers_file, _containers_json):
+    def test_image_manifest_config(self, _containers_file, _containers_json,
+                                   _containers_file_signature):
         _containers_file.return_value = '{"config": {}}'
         images_not_found = [{
             'id': 'aaaa',
@@ -1987,6 +3659,13 @@ class TestPythonImageUploader(base.TestCase):
             self.uploader._image_manifest_config,
             '192.168.2.1:5000/t/nova-api:latest'
         )
+        # the index is only parsed again when images.json changes
+        self.assertRaises(
+            ImageNotFoundException,
+            self.uploader._image_manifest_config,
+            '192.168.2.1:5000/t/nova-api:latest'
+        )
+        _containers_file_signature.return_value = (2, 100, 1000.0)
 
         image, manifest, config_str = self.uploader._image_manifest_config(
             '192.168.2.1:5000/t/nova-api:latest'
@@ -2002,6 +3681,51 @@ class TestPythonImageUploader(base.TestCase):
         _containers_file.assert_called_once_with(
             'overlay-images', 'cccc', '=c2hhMjU2OjEyMzQ='
         )
+        _containers_file_signature.assert_called_with(
+            'overlay-images', 'images.json')
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._containers_file_signature',
+                return_value=(1, 100, 1000.0))
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._containers_json')
+    def test_containers_layers(self, _containers_json,
+                               _containers_file_signature):
+        layers = [{
+            'id': 'aaaa',
+            'compressed-diff-digest': 'sha256:aeb786',
+            'diff-digest': 'sha256:f972d1',
+        }, {
+            'id': 'bbbb',
+            'diff-digest': 'sha256:26deb2',
+        }]
+        _containers_json.return_value = layers
+        self.assertEqual({
+            'sha256:aeb786': layers[0],
+            'sha256:f972d1': layers[0],
+            'sha256:26deb2': layers[1],
+        }, self.uploader._containers_layers())
+        self.uploader._containers_layers()
+        _containers_json.assert_called_once_with(
+            'overlay-layers', 'layers.json')
+
+        # a modified file is parsed again
+        _containers_file_signature.return_value = (1, 100, 1001.0)
+        self.uploader._containers_layers()
+        self.assertEqual(2, _containers_json.call_count)
+
+    @mock.patch('os.path.exists', return_value=True)
+    @mock.patch('os.stat')
+    def test_containers_file_signature(self, mock_stat, mock_exists):
+        mock_stat.return_value = mock.Mock(
+            st_ino=1234, st_size=100, st_mtime=1000.0)
+        self.assertEqual(
+            (1234, 100, 1000.0),
+            self.uploader._containers_file_signature(
+                'overlay-layers', 'layers.json')
+        )
+        mock_stat.assert_called_once_with(
+            '/var/lib/containers/storage/overlay-layers/layers.json')
 
     @mock.patch('tripleo_common.image.image_uploader.'
                 'PythonImageUploader._image_manifest_config')
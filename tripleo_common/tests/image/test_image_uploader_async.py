@@ -0,0 +1,286 @@
+#   Copyright 2019 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import json
+import mock
+import six
+import threading
+import time
+import unittest
+
+from tripleo_common.image import image_uploader
+from tripleo_common.tests import base
+from tripleo_common.tests.image import test_image_uploader
+
+if six.PY3:
+    import asyncio
+    from tripleo_common.image import image_uploader_async
+
+
+@unittest.skipIf(six.PY2, 'asyncio uploader requires python 3')
+class TestAsyncPythonImageUploader(base.TestCase):
+
+    def setUp(self):
+        super(TestAsyncPythonImageUploader, self).setUp()
+        test_image_uploader.use_temp_cache_dir(self)
+        self.uploader = image_uploader_async.AsyncPythonImageUploader()
+        self.uploader.init_registries_cache()
+
+    def test_uploader_type(self):
+        manager = image_uploader.ImageUploadManager()
+        self.assertIsInstance(
+            manager.uploader('python-async'),
+            image_uploader_async.AsyncPythonImageUploader)
+
+    def test_scheduler_host_limit(self):
+        running = {}
+        max_running = {}
+        lock = threading.Lock()
+
+        def request(host):
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                max_running[host] = max(max_running.get(host, 0),
+                                        running[host])
+            time.sleep(0.01)
+            with lock:
+                running[host] -= 1
+            return host
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        scheduler = image_uploader_async.RequestScheduler(
+            loop, workers=8, host_connections=2)
+        self.addCleanup(scheduler.shutdown)
+
+        # this module is imported on python 2, so no async syntax here
+        calls = [loop.create_task(scheduler.call([host], request, host))
+                 for host in ['a', 'b'] * 10]
+        self.assertEqual(['a', 'b'] * 10,
+                         loop.run_until_complete(asyncio.gather(*calls)))
+        self.assertEqual({'a': 2, 'b': 2}, max_running)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.upload_image')
+    def test_run_tasks_modify_stages(self, upload_image):
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def upload(task, stages=None):
+            with image_uploader.pipeline_stage(stages, 'modify'):
+                with lock:
+                    running.append(task)
+                    max_running.append(len(running))
+                time.sleep(0.01)
+                with lock:
+                    running.remove(task)
+            return []
+
+        upload_image.side_effect = upload
+        self.uploader.modify_workers = 2
+        for i in range(6):
+            self.uploader.add_upload_task(image_uploader.UploadTask(
+                image_name='t/nova-api:%d' % i,
+                pull_source='docker.io',
+                push_destination='localhost:8787',
+                append_tag='-modified',
+                modify_role='add-foo-plugin',
+                modify_vars=None,
+                dry_run=False,
+                cleanup='full'
+            ))
+        self.uploader.run_tasks()
+
+        # modified images run the stages of PythonImageUploader
+        self.assertEqual(6, upload_image.call_count)
+        for call in upload_image.call_args_list:
+            self.assertEqual(set(['pull', 'modify', 'push']),
+                             set(call[0][1].keys()))
+        self.assertEqual(2, max(max_running))
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'discover_tag_from_inspect')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'BaseImageUploader.prime_insecure_registries')
+    def test_discover_image_tags(self, mock_prime, mock_discover):
+        mock_discover.side_effect = lambda args: (args[0], args[0] + '-1')
+        self.assertEqual(
+            {
+                'docker.io/t/nova-api': 'docker.io/t/nova-api-1',
+                'quay.io/t/nova-compute': 'quay.io/t/nova-compute-1',
+            },
+            self.uploader.discover_image_tags(
+                ['docker.io/t/nova-api', 'quay.io/t/nova-compute'],
+                'rdo_version')
+        )
+        mock_discover.assert_has_calls([
+            mock.call(('docker.io/t/nova-api', 'rdo_version')),
+            mock.call(('quay.io/t/nova-compute', 'rdo_version')),
+        ], any_order=True)
+        self.assertEqual(
+            ['docker.io', 'quay.io'],
+            sorted(mock_prime.call_args[0][0]))
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_manifest_config_to_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._cross_repo_mount')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_layer_registry_to_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._registry_blob_exists',
+                return_value=False)
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_config',
+                return_value='{"config": {}}')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_manifest')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._detect_target_export',
+                return_value=False)
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.authenticate')
+    def test_run_tasks(self, authenticate, _detect_target_export,
+                       _fetch_manifest, _fetch_config, _registry_blob_exists,
+                       _copy_layer_registry_to_registry, _cross_repo_mount,
+                       _copy_manifest_config_to_registry):
+        source_session = mock.Mock()
+        target_session = mock.Mock()
+        authenticate.side_effect = lambda url: (
+            target_session if url.netloc == 'localhost:8787'
+            else source_session)
+
+        def fetch_manifest(url, session, multi_arch=False):
+            layers = ['sha256:aaaa']
+            if 'nova-api' in url.path:
+                layers.append('sha256:bbbb')
+            else:
+                layers.append('sha256:cccc')
+            return json.dumps({
+                'config': {'digest': 'sha256:1234'},
+                'layers': [{'digest': l} for l in layers],
+            })
+
+        _fetch_manifest.side_effect = fetch_manifest
+
+        self.uploader.insecure_registries.add('localhost:8787')
+        for image in ('t/nova-api:latest', 't/nova-compute:latest'):
+            self.uploader.add_upload_task(image_uploader.UploadTask(
+                image_name=image,
+                pull_source='docker.io',
+                push_destination='localhost:8787',
+                append_tag=None,
+                modify_role=None,
+                modify_vars=None,
+                dry_run=False,
+                cleanup='full'
+            ))
+        self.uploader.run_tasks()
+
+        # the shared layer is copied once, then mounted into the other image
+        self.assertEqual(
+            ['sha256:aaaa', 'sha256:bbbb', 'sha256:cccc'],
+            sorted(c[1]['layer']['digest']
+                   for c in _copy_layer_registry_to_registry.call_args_list)
+        )
+        self.assertEqual(4, _registry_blob_exists.call_count)
+        self.assertEqual(1, _cross_repo_mount.call_count)
+        mount_url = _cross_repo_mount.call_args[0][0]
+        mount_layers = _cross_repo_mount.call_args[0][1]
+        self.assertEqual(['sha256:aaaa'], list(mount_layers.keys()))
+        self.assertNotEqual(mount_url, mount_layers['sha256:aaaa'])
+
+        self.assertEqual(2, _copy_manifest_config_to_registry.call_count)
+        _copy_manifest_config_to_registry.assert_called_with(
+            target_url=mock.ANY,
+            manifest_str=mock.ANY,
+            config_str='{"config": {}}',
+            target_session=target_session
+        )
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_manifest_list_entries_to_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_platform_manifest_to_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_layer_registry_to_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._registry_blob_exists',
+                return_value=False)
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_config',
+                return_value='{"config": {}}')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_platform_manifest')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_manifest')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._detect_target_export',
+                return_value=False)
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.authenticate')
+    def test_run_tasks_manifest_list(
+            self, authenticate, _detect_target_export, _fetch_manifest,
+            _fetch_platform_manifest, _fetch_config, _registry_blob_exists,
+            _copy_layer_registry_to_registry,
+            _copy_platform_manifest_to_registry,
+            _copy_manifest_list_entries_to_registry):
+        entries = [
+            {'digest': 'sha256:%s' % arch,
+             'mediaType': image_uploader.MEDIA_MANIFEST_V2,
+             'platform': {'os': 'linux', 'architecture': arch}}
+            for arch in ('amd64', 'ppc64le')
+        ]
+        manifest_list = {
+            'mediaType': image_uploader.MEDIA_MANIFEST_LIST,
+            'manifests': entries
+        }
+        _fetch_manifest.return_value = json.dumps(manifest_list)
+        self.addCleanup(self.uploader.init_platforms)
+        self.uploader.init_platforms([image_uploader.PLATFORMS_ALL])
+        _fetch_platform_manifest.side_effect = (
+            lambda url, entry, session: json.dumps({
+                'config': {'digest': 'sha256:1234'},
+                'layers': [{'digest': 'sha256:shared'},
+                           {'digest': entry['digest'] + '-layer'}],
+            }))
+        calls = []
+        _copy_platform_manifest_to_registry.side_effect = (
+            lambda *args: calls.append('platform'))
+        _copy_manifest_list_entries_to_registry.side_effect = (
+            lambda *args: calls.append('list'))
+
+        self.uploader.add_upload_task(image_uploader.UploadTask(
+            image_name='t/nova-api:latest',
+            pull_source='docker.io',
+            push_destination='localhost:8787',
+            append_tag=None,
+            modify_role=None,
+            modify_vars=None,
+            dry_run=False,
+            cleanup='full'
+        ))
+        self.uploader.run_tasks()
+
+        self.assertEqual(
+            ['sha256:amd64-layer', 'sha256:ppc64le-layer', 'sha256:shared'],
+            sorted(c[1]['layer']['digest']
+                   for c in _copy_layer_registry_to_registry.call_args_list)
+        )
+        # the list is pushed after every platform manifest
+        self.assertEqual(['platform', 'platform', 'list'], calls)
+        list_args = _copy_manifest_list_entries_to_registry.call_args[0]
+        self.assertEqual(entries, list_args[3])
@@ -24,6 +24,7 @@ import tempfile
 import yaml
 
 from tripleo_common import constants
+from tripleo_common.image import image_cache
 from tripleo_common.image import image_uploader
 from tripleo_common.image import kolla_builder as kb
 from tripleo_common.tests import base
@@ -550,6 +551,10 @@ class TestPrepare(base.TestCase):
     def setUp(self):
         super(TestPrepare, self).setUp()
         image_uploader.BaseImageUploader.init_registries_cache()
+        # registry probe results are not cached on disk between tests
+        patcher = mock.patch.object(image_cache, 'CACHE_DIR', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
         with tempfile.NamedTemporaryFile(delete=False) as imagefile:
             self.addCleanup(os.remove, imagefile.name)
             self.filelist = [imagefile.name]
@@ -866,6 +871,43 @@ class TestPrepare(base.TestCase):
             )
         )
 
+    @mock.patch('tripleo_common.image.kolla_builder.'
+                'detect_insecure_registries', return_value={})
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'BaseImageUploader.discover_image_tags')
+    def test_prepare_tag_from_label_rate_limits(self, mock_discover,
+                                                mock_insecure):
+        uploader = image_uploader.BaseImageUploader
+        self.addCleanup(uploader.init_rate_limits)
+
+        def discover_image_tags(images, tag_from_label):
+            # tag discovery is throttled by the entry's limits
+            self.assertEqual({'bytes': 1000, 'requests': 5},
+                             uploader.rate_limits)
+            return {'t/nova-compute': '1.0'}
+        mock_discover.side_effect = discover_image_tags
+
+        result = kb.container_images_prepare(
+            template_file=TEMPLATE_PATH,
+            output_images_file='container_images.yaml',
+            service_filter=['OS::TripleO::Services::NovaLibvirt'],
+            excludes=['libvirt'],
+            mapping_args={
+                'namespace': 't',
+                'name_prefix': '',
+                'name_suffix': '',
+                'tag': 'l',
+            },
+            tag_from_label='{version}',
+            rate_limit_bytes=1000,
+            rate_limit_requests=5
+        )
+        self.assertEqual(
+            [{'image_source': 'kolla', 'imagename': 't/nova-compute:1.0'}],
+            result['container_images.yaml'])
+        mock_discover.assert_called_once_with(
+            ['t/nova-compute:l'], '{version}')
+
     def test_get_enabled_services_empty(self):
         self.assertEqual(
             set([]),
@@ -1072,7 +1114,9 @@ class TestPrepare(base.TestCase):
                 modify_vars=None,
                 mirrors={
                     'docker.io': 'http://192.0.2.2/reg/'
-                }
+                },
+                rate_limit_bytes=None,
+                rate_limit_requests=None
             ),
             mock.call(
                 excludes=['nova', 'neutron'],
@@ -1090,7 +1134,9 @@ class TestPrepare(base.TestCase):
                 modify_vars={'foo_version': '1.0.1'},
                 mirrors={
                     'docker.io': 'http://192.0.2.2/reg/'
-                }
+                },
+                rate_limit_bytes=None,
+                rate_limit_requests=None
             )
         ])
 
@@ -1129,7 +1175,11 @@ class TestPrepare(base.TestCase):
                     'modify_role': 'add-foo-plugin',
                     'modify_only_with_labels': ['kolla_version'],
                     'modify_vars': {'foo_version': '1.0.1'},
-                    'modify_append_tag': 'modify-123'
+                    'modify_append_tag': 'modify-123',
+                    'rate_limit_bytes': 10485760,
+                    'rate_limit_requests': 20,
+                    'modify_compress_level': 1,
+                    'modify_compress_workers': 8
                 }]
             }
         }
@@ -1175,7 +1225,9 @@ class TestPrepare(base.TestCase):
                 modify_role=None,
                 modify_only_with_labels=None,
                 modify_vars=None,
-                mirrors={}
+                mirrors={},
+                rate_limit_bytes=None,
+                rate_limit_requests=None
             ),
             mock.call(
                 excludes=['nova', 'neutron'],
@@ -1191,12 +1243,20 @@ class TestPrepare(base.TestCase):
                 modify_role='add-foo-plugin',
                 modify_only_with_labels=['kolla_version'],
                 modify_vars={'foo_version': '1.0.1'},
-                mirrors={}
+                mirrors={},
+                rate_limit_bytes=10485760,
+                rate_limit_requests=20
             )
         ])
 
         mock_im.assert_called_once_with(mock.ANY, dry_run=True, cleanup='full',
-                                        mirrors={})
+                                        mirrors={},
+                                        rate_limit_bytes=10485760,
+                                        rate_limit_requests=20,
+                                        compress_level=1,
+                                        compress_workers=8,
+                                        sync=False,
+                                        platforms=None)
 
         self.assertEqual(
             {